@@ -1,8 +1,28 @@
 # Problem Set: Simulating the Spread of Disease and Virus Population Dynamics 
 
+import argparse
+import collections.abc
+import concurrent.futures
+import hashlib
+import io
+import itertools
+import json
+import math
+import multiprocessing.connection
 import numpy
+import os
+import pickle
 import random
-import pylab
+import statistics
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+# Bump whenever a change makes the same parameters and seed give different
+# results, so that cached results (see ResultCache) are not reused.
+SIMULATOR_VERSION = 6
 
 ''' 
 Begin helper code
@@ -20,6 +40,361 @@ class NoChildException(Exception):
 End helper code
 '''
 
+class DrugRegistry(object):
+    """
+    Assigns every drug name a fixed bit position, so that a set of drugs (or a
+    set of resistances) can be stored as an integer bitmask.
+    """
+    def __init__(self):
+        """
+        Initialization function, starts with no drugs registered.
+        """
+        self.bits = {}
+        self.names = []
+        self.sortedBits = {}
+
+    def getBit(self, drug):
+        """
+        Returns the bit position of a drug, registering the drug if it has not
+        been seen before.
+
+        drug: The drug (a string)
+        """
+        if drug not in self.bits:
+            self.bits[drug] = len(self.names)
+            self.names.append(drug)
+        return self.bits[drug]
+
+    def getMask(self, drugs):
+        """
+        Returns the bitmask (an integer) with the bit of every drug in drugs
+        set.
+
+        drugs: The drug names (an iterable of strings)
+        """
+        mask = 0
+        for d in drugs:
+            mask |= 1 << self.getBit(d)
+        return mask
+
+    def getNames(self, mask):
+        """
+        Returns the list of drug names whose bits are set in mask.
+        """
+        return [d for i, d in enumerate(self.names) if mask >> i & 1]
+
+    def getBits(self, mask):
+        """
+        Returns the positions of the bits set in mask (a list of integers),
+        ordered by drug name. Mutations are drawn trait by trait in this
+        order, so that a seed gives the same results whatever order the drugs
+        were registered in, which differs between processes.
+        """
+        bits = self.sortedBits.get(mask)
+        if bits is None:
+            bits = sorted((i for i in range(mask.bit_length())
+                           if mask >> i & 1), key=lambda i: self.names[i])
+            self.sortedBits[mask] = bits
+        return bits
+
+    def getNumDrugs(self):
+        """
+        Returns the number of registered drugs.
+        """
+        return len(self.names)
+
+    def toMasks(self, resistances):
+        """
+        Converts a resistances dictionary into a pair of bitmasks.
+
+        resistances: A dictionary of drug names (strings) mapping to the state
+        of resistance (True or False) to each drug.
+
+        returns: (traits, resist) where traits has a bit set for every key of
+        resistances and resist has a bit set for every drug mapping to True.
+        """
+        traits = 0
+        resist = 0
+        for d in resistances:
+            bit = 1 << self.getBit(d)
+            traits |= bit
+            if resistances[d]:
+                resist |= bit
+        return traits, resist
+
+    def toDict(self, traits, resist):
+        """
+        Converts a pair of bitmasks back into a resistances dictionary. This
+        is the inverse of toMasks().
+        """
+        return dict((d, bool(resist >> self.bits[d] & 1))
+                    for d in self.getNames(traits))
+
+drugRegistry = DrugRegistry()
+
+
+class Genotype(collections.abc.Mapping):
+    """
+    Immutable mapping of drug names (strings) to the state of resistance
+    (True or False) to each drug, shared by all virus particles with the same
+    resistances. Genotypes are interned: intern() returns the same instance
+    for equal resistances, and every genotype caches its mutants, so a
+    reproducing virus does not copy its resistances. The traits and resist
+    attributes hold the drugs and the resistances as bitmasks (see
+    DrugRegistry), and drugs holds the drug names in sorted order (a tuple).
+
+    The table of interned genotypes and the mutant caches hold genotypes
+    weakly: a genotype no virus or patient refers to any more is dropped, so
+    neither grows from trial to trial.
+    """
+    __slots__ = ("resistances", "key", "drugs", "traits", "resist", "mutants",
+                 "__weakref__")
+    table = weakref.WeakValueDictionary()
+
+    def __init__(self, resistances):
+        """
+        Initialization function, use intern() instead to share instances.
+
+        resistances: A dictionary of drug names (strings) mapping to the state
+        of resistance (True or False) to each drug.
+        """
+        self.resistances = dict((d, bool(r)) for d, r in resistances.items())
+        self.key = frozenset(self.resistances.items())
+        self.drugs = tuple(sorted(self.resistances))
+        self.traits, self.resist = drugRegistry.toMasks(self.resistances)
+        self.mutants = None
+
+    @classmethod
+    def intern(cls, resistances):
+        """
+        Returns the shared Genotype equal to resistances (a dictionary or a
+        Genotype).
+        """
+        if isinstance(resistances, Genotype):
+            return resistances
+        key = frozenset((d, bool(r)) for d, r in resistances.items())
+        genotype = cls.table.get(key)
+        if genotype is None:
+            genotype = cls(resistances)
+            cls.table[key] = genotype
+        return genotype
+
+    @classmethod
+    def fromMasks(cls, traits, resist):
+        """
+        Returns the shared Genotype with a trait for every drug in the
+        bitmask traits, resistant to the drugs in the bitmask resist.
+        """
+        return cls.intern(drugRegistry.toDict(traits, resist))
+
+    def getMasks(self):
+        """
+        Returns (traits, resist), the drugs and the resistances of this
+        genotype as bitmasks. See DrugRegistry.toMasks().
+        """
+        return self.traits, self.resist
+
+    def mutate(self, flipped):
+        """
+        Returns the shared Genotype with the resistance to every drug in
+        flipped (a sequence of drug names) switched.
+        """
+        key = tuple(flipped)
+        if self.mutants is None:
+            self.mutants = weakref.WeakValueDictionary()
+        mutant = self.mutants.get(key)
+        if mutant is None:
+            resistances = dict(self.resistances)
+            for d in flipped:
+                resistances[d] = not resistances[d]
+            mutant = Genotype.intern(resistances)
+            self.mutants[key] = mutant
+        return mutant
+
+    def __getitem__(self, drug):
+        return self.resistances[drug]
+
+    def get(self, drug, default=None):
+        return self.resistances.get(drug, default)
+
+    def __iter__(self):
+        return iter(self.resistances)
+
+    def __len__(self):
+        return len(self.resistances)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        if isinstance(other, Genotype):
+            return self is other or self.key == other.key
+        return collections.abc.Mapping.__eq__(self, other)
+
+    def __repr__(self):
+        return "Genotype(%r)" % (self.resistances,)
+
+    def __reduce__(self):
+        return (Genotype.intern, (self.resistances,))
+
+class AntitheticGenerator(object):
+    """
+    Wraps a numpy.random.Generator so that random() returns 1 - u (modulo
+    1, to stay in [0, 1)) for every uniform number u the generator draws.
+    The other distributions are drawn from the wrapped generator unchanged.
+    """
+    def __init__(self, generator):
+        """
+        generator: the numpy.random.Generator to wrap
+        """
+        self.generator = generator
+
+    def random(self, size=None):
+        """
+        Returns the reflected uniform numbers, see numpy.random.Generator.
+        """
+        return (1.0 - self.generator.random(size)) % 1.0
+
+    def __getattr__(self, name):
+        return getattr(self.generator, name)
+
+
+class RandomStream(object):
+    """
+    A stream of random numbers owned by one patient, backed by a NumPy
+    Generator (PCG64) instead of the random module.
+
+    random() serves uniform numbers in [0, 1) one at a time, as the virus
+    methods draw them, from a buffer of bufferSize numbers generated in
+    bulk, so a draw costs about as much as random.random(). Vectorized
+    engines draw arrays from getGenerator(). A stream can be reseeded, saved
+    and restored with getState() and setState(), and jumped() returns
+    independent substreams.
+
+    An antithetic stream serves 1 - u for every uniform number u of the
+    stream with the same seed, from random() and from the random() method
+    of getGenerator() (see AntitheticGenerator).
+    """
+    def __init__(self, seed=None, bufferSize=4096, bitGenerator=None,
+                 antithetic=False):
+        """
+        seed: the seed of the stream (an integer). If None, it is drawn from
+              the random module, so that random.seed() makes the stream
+              reproducible.
+        bufferSize: the number of uniform numbers generated at a time
+        bitGenerator: a numpy.random.BitGenerator to draw from instead of
+                      seeding a new one
+        antithetic: whether the uniform numbers are reflected
+        """
+        self.bufferSize = bufferSize
+        self.antithetic = antithetic
+        if bitGenerator is None:
+            self.seed(seed)
+        else:
+            self._setBitGenerator(bitGenerator, [])
+
+    def _setBitGenerator(self, bitGenerator, values):
+        """
+        Draws from bitGenerator, after serving the buffered values (a list of
+        floats).
+        """
+        self.generator = numpy.random.Generator(bitGenerator)
+        if self.antithetic:
+            self.generator = AntitheticGenerator(self.generator)
+        self.values = values
+        self.buffer = iter(values)
+        # random() is the C-level __next__ of the chained buffers
+        self.random = itertools.chain.from_iterable(self._buffers()).__next__
+
+    def _buffers(self):
+        """
+        Yields the current buffer, then one newly generated buffer at a time.
+        """
+        yield self.buffer
+        while True:
+            self.values = self.generator.random(self.bufferSize).tolist()
+            self.buffer = iter(self.values)
+            yield self.buffer
+
+    def seed(self, seed=None):
+        """
+        Restarts the stream from a seed (an integer), see __init__().
+        """
+        if seed is None:
+            seed = random.getrandbits(64)
+        self._setBitGenerator(numpy.random.PCG64(seed), [])
+
+    def getGenerator(self):
+        """
+        Returns the numpy.random.Generator of the stream (an
+        AntitheticGenerator if the stream is antithetic).
+        """
+        return self.generator
+
+    def getState(self):
+        """
+        Returns the state of the stream as a dictionary: the state of the bit
+        generator and whether the stream is antithetic (JSON-compatible
+        values), and the buffered numbers not yet served (an array).
+        """
+        remaining = self.buffer.__length_hint__()
+        return {"bitGenerator": self.generator.bit_generator.state,
+                "antithetic": self.antithetic,
+                "buffer": numpy.array(
+                    self.values[len(self.values) - remaining:], dtype=float)}
+
+    def setState(self, state):
+        """
+        Restores a state returned by getState().
+        """
+        bitState = state["bitGenerator"]
+        bitGenerator = getattr(numpy.random, bitState["bit_generator"])()
+        bitGenerator.state = bitState
+        self.antithetic = state.get("antithetic", False)
+        self._setBitGenerator(
+            bitGenerator, numpy.asarray(state["buffer"], dtype=float).tolist())
+
+    @classmethod
+    def fromState(cls, state, bufferSize=4096):
+        """
+        Creates a stream from a state returned by getState().
+        """
+        stream = cls(0, bufferSize)
+        stream.setState(state)
+        return stream
+
+    def jumped(self, jumps=1):
+        """
+        Returns a new stream starting where this one would be after jumps
+        times 2 ** 127 draws of its bit generator, so that the substreams
+        jumped(1), jumped(2), ... of a stream do not overlap.
+        """
+        return RandomStream(bufferSize=self.bufferSize,
+                            bitGenerator=self.generator.bit_generator.jumped(
+                                jumps),
+                            antithetic=self.antithetic)
+
+    def __getstate__(self):
+        return {"bufferSize": self.bufferSize, "state": self.getState()}
+
+    def __setstate__(self, values):
+        self.bufferSize = values["bufferSize"]
+        self.setState(values["state"])
+
+
+def _generator(rng):
+    """
+    Returns the numpy.random.Generator a vectorized engine draws from: rng
+    itself, the generator of a RandomStream, or if rng is None a generator
+    seeded from the random module.
+    """
+    if rng is None:
+        return numpy.random.default_rng(random.getrandbits(64))
+    if isinstance(rng, RandomStream):
+        return rng.getGenerator()
+    return rng
+
+
 #
 # PROBLEM 1
 #
@@ -28,6 +403,8 @@ class SimpleVirus(object):
     """
     Representation of a simple virus (does not model drug effects/resistance).
     """
+    __slots__ = ("maxBirthProb", "clearProb")
+
     def __init__(self, maxBirthProb, clearProb):
         """
         Initialize a SimpleVirus instance, saves all parameters as attributes
@@ -51,16 +428,45 @@ class SimpleVirus(object):
         """
         return self.clearProb
 
-    def doesClear(self):
+    def doesClear(self, rng=random):
         """ Stochastically determines whether this virus particle is cleared from the
         patient's body at a time step. 
+        rng: where the random number is drawn from, the random module or a
+        RandomStream
         returns: True with probability self.getClearProb and otherwise returns
         False.
         """
-        clear = random.random()
-        return clear < self.getClearProb()
+        clear = rng.random()
+        return clear < self.clearProb
+
+    def tryReproduce(self, popDensity, rng=random):
+        """
+        Same as reproduce(), but returns None instead of raising a
+        NoChildException when this virus particle does not reproduce. This is
+        the method used by Patient.update(); subclasses that change how a
+        virus reproduces should override it.
+
+        popDensity: the population density (a float)
+
+        rng: where the random number is drawn from, see doesClear()
+
+        returns: a new instance of the SimpleVirus class, or None.
+        """
+        if rng.random() < self.maxBirthProb * (1 - popDensity):
+            return self.makeChild(rng)
+        return None
 
-    def reproduce(self, popDensity):
+    def makeChild(self, rng=random):
+        """
+        Returns the offspring of this virus particle. This is the last step
+        of tryReproduce(), called once the particle is known to reproduce;
+        subclasses that change what the offspring is should override it.
+
+        rng: where the random numbers are drawn from, see doesClear()
+        """
+        return SimpleVirus(self.maxBirthProb, self.clearProb)
+
+    def reproduce(self, popDensity, rng=random):
         """
         Stochastically determines whether this virus particle reproduces at a
         time step. Called by the update() method in the Patient and
@@ -73,6 +479,8 @@ class SimpleVirus(object):
 
         popDensity: the population density (a float), defined as the current
         virus population divided by the maximum population.         
+
+        rng: where the random number is drawn from, see doesClear()
         
         returns: a new instance of the SimpleVirus class representing the
         offspring of this virus particle. The child should have the same
@@ -80,12 +488,10 @@ class SimpleVirus(object):
         NoChildException if this virus particle does not reproduce.               
         """
 
-        ran = random.random()
-        if ran < self.getMaxBirthProb() * (1 - popDensity):
-            child = SimpleVirus(self.getMaxBirthProb(), self.getClearProb())
-            return child
-        else:
+        child = self.tryReproduce(popDensity, rng)
+        if child is None:
             raise NoChildException()
+        return child
 
 
 class Patient(object):
@@ -93,7 +499,7 @@ class Patient(object):
     Representation of a simplified patient. The patient does not take any drugs
     and his/her virus populations have no drug resistance.
     """    
-    def __init__(self, viruses, maxPop):
+    def __init__(self, viruses, maxPop, rng=None):
         """
         Initialization function, saves the viruses and maxPop parameters as
         attributes.
@@ -102,15 +508,109 @@ class Patient(object):
         SimpleVirus instances)
 
         maxPop: the maximum virus population for this patient (an integer)
+
+        rng: the RandomStream this patient draws from. If None, a new stream
+        is seeded from the random module, so that random.seed() makes the
+        patient reproducible.
         """
         self.viruses = viruses
         self.maxPop = maxPop
+        if rng is None:
+            rng = RandomStream()
+        self.rng = rng
+        self.counters = None
+
+    def getRandom(self):
+        """
+        Returns the RandomStream this patient draws its random numbers from.
+        """
+        return self.rng
+
+    def setCounters(self, counters):
+        """
+        Enables the instrumentation of update(): every following update()
+        measures its phases and adds them to counters. Passing None disables
+        the instrumentation again, which then costs a single attribute check
+        per update().
+
+        counters: an UpdateCounters instance, or None
+        """
+        self.counters = counters
+
+    def getCounters(self):
+        """
+        Returns the UpdateCounters instrumenting update(), or None.
+        """
+        return self.counters
+
+    def getState(self):
+        """
+        Returns the state of this patient as a dictionary that fromState()
+        and snapshotPatient() accept: the population as a table of
+        genotypes (see virusGenotype()) plus the genotype of every particle
+        in order, maxPop, and the state of the RandomStream of the patient
+        (its buffered numbers as the array "streamBuffer").
+        """
+        genotypes = []
+        simple = []
+        index = {}
+        particles = numpy.empty(len(self.viruses), dtype=numpy.int64)
+        for i in range(len(self.viruses)):
+            v = self.viruses[i]
+            key = (v.maxBirthProb, v.clearProb, getattr(v, "mutProb", 0.0),
+                   getattr(v, "resistances", None))
+            if key not in index:
+                index[key] = len(genotypes)
+                genotypes.append(virusGenotype(v))
+                simple.append(not isinstance(v, ResistantVirus))
+            particles[i] = index[key]
+        state = encodeGenotypes(genotypes)
+        state["class"] = type(self).__name__
+        state["maxPop"] = self.maxPop
+        state["simple"] = numpy.array(simple, dtype=bool)
+        state["particles"] = particles
+        stream = self.rng.getState()
+        state["streamBuffer"] = stream.pop("buffer")
+        state["stream"] = stream
+        return state
+
+    @classmethod
+    def fromState(cls, state, restoreRandom=True):
+        """
+        Creates a patient from a dictionary returned by getState().
+
+        restoreRandom: whether to restore the state of the patient's
+        RandomStream, so that the patient continues exactly as the saved one
+        would have; otherwise the patient gets a new stream seeded from the
+        random module
+        """
+        viruses = []
+        genotypes = decodeGenotypes(state)
+        for i in range(len(genotypes)):
+            birthProb, clearProb, mutProb, traits, resist = genotypes[i]
+            if state["simple"][i]:
+                viruses.append(SimpleVirus(birthProb, clearProb))
+            else:
+                viruses.append(ResistantVirus(
+                    birthProb, clearProb,
+                    drugRegistry.toDict(traits, resist), mutProb))
+        # particles of a genotype share one (immutable) virus object
+        viruses = [viruses[k] for k in state["particles"].tolist()]
+        rng = None
+        if restoreRandom:
+            rng = RandomStream.fromState(dict(state["stream"],
+                                              buffer=state["streamBuffer"]))
+        patient = cls(viruses, state["maxPop"], rng=rng)
+        for drug in state.get("drugs", ()):
+            patient.addPrescription(drug)
+        return patient
         
     def getViruses(self):
         """
-        Returns the viruses in this Patient.
+        Returns the viruses in this Patient, as a new list: changing it does
+        not change the patient.
         """
-        return self.viruses
+        return list(self.viruses)
 
     def getMaxPop(self):
         """
@@ -140,66 +640,91 @@ class Patient(object):
           virus particle should reproduce and add offspring virus particles to 
           the list of viruses in this patient.                    
 
+        Every particle is cleared by its doesClear() and reproduces by its
+        tryReproduce(), both drawing from the patient's RandomStream.
+
         returns: The total virus population at the end of the update (an
         integer)
         """
+        counters = self.counters
+        if counters is not None:
+            record = counters.newRecord()
+            clock = time.perf_counter
+            start = clock()
+        rng = self.rng
         virusList = []
         for v in self.viruses:
-            if v.doesClear() == False:
+            if not v.doesClear(rng):
                 virusList.append(v)
-        self.viruses = virusList
-        popDen = (1.0 * self.getTotalPop()) / self.getMaxPop()
+        if counters is not None:
+            cleared = clock()
+        popDen = (1.0 * len(virusList)) / self.getMaxPop()
+        if counters is not None:
+            density = clock()
 
-        for v in self.viruses[:]:
-            try:
-                child = v.reproduce(popDen)
-                self.viruses.append(child)
-            except NoChildException:
-                pass            
+        children = []
+        for v in virusList:
+            child = v.tryReproduce(popDen, rng)
+            if child is not None:
+                children.append(child)
+        if counters is not None:
+            record["clearances"] = len(self.viruses) - len(virusList)
+        virusList.extend(children)
+        self.viruses = virusList
+        if counters is not None:
+            record["births"] = len(children)
+            record["population"] = len(virusList)
+            record["clearance"] = cleared - start
+            record["density"] = density - cleared
+            record["reproduction"] = clock() - density
+            counters.addRecord(self, record)
         return self.getTotalPop()
         
 #
 # PROBLEM 2
 #
-def simulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb,
-                          numTrials):
+def computeWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb, numTrials,
+                       patientClass=Patient, seed=None, numWorkers=1):
     """
-    Run the simulation and plot the graph for problem 2 (no drugs are used,
-    viruses do not have any drug resistance).    
-    For each of numTrials trial, instantiates a patient, runs a simulation
-    for 300 timesteps, and plots the average virus population size as a
-    function of time.
+    Runs the simulation for problem 2 (no drugs are used, viruses do not have
+    any drug resistance) without plotting anything.
+    For each of numTrials trial, instantiates a patient and runs a simulation
+    for 300 timesteps.
 
     numViruses: number of SimpleVirus to create for patient (an integer)
     maxPop: maximum virus population for patient (an integer)
-    maxBirthProb: Maximum reproduction probability (a float between 0-1)        
+    maxBirthProb: Maximum reproduction probability (a float between 0-1)
     clearProb: Maximum clearance probability (a float between 0-1)
     numTrials: number of simulation runs to execute (an integer)
-    """
-    virusList = []
-    progressList = []
-    for x in range(0, 300):
-        progressList.append(0.0)  
+    patientClass: the patient implementation to simulate (Patient,
+                  ArrayPatient or GenotypePatient)
+    seed: the seed of the run (an integer), see runTrials()
+    numWorkers: number of worker processes to run the trials on (an integer)
 
-    for v in range(0, numViruses):
-        flu = SimpleVirus(maxBirthProb, clearProb)
-        virusList.append(flu)  
+    returns: the TrialSummary of the trials
+    """
+    scenario = Scenario(numViruses, maxPop, maxBirthProb, clearProb,
+                        numSteps=300, patientClass=patientClass)
+    return runTrials(scenario, numTrials, seed, numWorkers)
 
-    for t in range(0, numTrials):    
-        jacek = Patient(virusList, maxPop)
-        for a in range(0, 300):
-            jacek.update()
-            progressList[a] += jacek.getTotalPop()
 
-    for a in range(0, 300):
-        progressList[a] /= float(numTrials)
+def simulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb,
+                          numTrials, patientClass=Patient, seed=None,
+                          numWorkers=1):
+    """
+    Run the simulation and plot the graph for problem 2 (no drugs are used,
+    viruses do not have any drug resistance).    
+    For each of numTrials trial, instantiates a patient, runs a simulation
+    for 300 timesteps, and plots the average virus population size as a
+    function of time. The arguments are those of computeWithoutDrug().
 
-    pylab.plot(range(0, 300), progressList, label = "Virus population")
-    pylab.title("Mean number of viruses over time")
-    pylab.xlabel("Time steps")
-    pylab.ylabel("Number of virus particles")
-    pylab.legend(loc = "best")
-    pylab.show()
+    returns: the TrialSummary of the trials
+    """
+    summary = computeWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb,
+                                 numTrials, patientClass, seed, numWorkers)
+    plotSummary(summary, "Mean number of viruses over time",
+                totalLabel="Virus population", grid=False)
+    return summary
 
 # Uncomment to see this function in action:
 #simulationWithoutDrug(15, 100, 0.5, 0.2, 100)
@@ -211,6 +736,10 @@ class ResistantVirus(SimpleVirus):
     """
     Representation of a virus which can have drug resistance.
     """   
+    __slots__ = ("resistances", "mutProb")
+    # log(1 - mutProb) for every mutation probability seen, see makeChild()
+    logKeep = {}
+
     def __init__(self, maxBirthProb, clearProb, resistances, mutProb):
         """
         Initialize a ResistantVirus instance, saves all parameters as attributes
@@ -227,14 +756,16 @@ class ResistantVirus(SimpleVirus):
 
         mutProb: Mutation probability for this virus particle (a float). This is
         the probability of the offspring acquiring or losing resistance to a drug.
+
+        The resistances are stored as a shared, immutable Genotype.
         """
         SimpleVirus.__init__(self, maxBirthProb, clearProb)
-        self.resistances = resistances
+        self.resistances = Genotype.intern(resistances)
         self.mutProb = mutProb
 
     def getResistances(self):
         """
-        Returns the resistances for this virus.
+        Returns the resistances for this virus (a read-only Genotype mapping).
         """
         return self.resistances
 
@@ -257,7 +788,7 @@ class ResistantVirus(SimpleVirus):
         """
         return self.resistances.get(drug, False)
 
-    def reproduce(self, popDensity, activeDrugs):
+    def reproduce(self, popDensity, activeDrugs, rng=random):
         """
         Stochastically determines whether this virus particle reproduces at a
         time step. Called by the update() method in the TreatedPatient class.
@@ -296,33 +827,82 @@ class ResistantVirus(SimpleVirus):
         activeDrugs: a list of the drug names acting on this virus particle
         (a list of strings).
 
+        rng: where the random numbers are drawn from, see
+        SimpleVirus.doesClear()
+
         returns: a new instance of the ResistantVirus class representing the
         offspring of this virus particle. The child should have the same
         maxBirthProb and clearProb values as this virus. Raises a
         NoChildException if this virus particle does not reproduce.
         """
-        res = {}
-        ran = random.random()
+        child = self.tryReproduce(popDensity, activeDrugs, rng)
+        if child is None:
+            raise NoChildException()
+        return child
+
+    def tryReproduce(self, popDensity, activeDrugs=(), rng=random):
+        """
+        Same as reproduce(), but returns None instead of raising a
+        NoChildException when this virus particle does not reproduce. This is
+        the method used by TreatedPatient.update() (and, without drugs, by
+        Patient.update()).
+
+        The resistances are only checked against activeDrugs and mutated once
+        the particle is known to reproduce, and an offspring that does not
+        mutate shares its parent's Genotype.
+
+        popDensity: the population density (a float)
+
+        activeDrugs: a list of the drug names acting on this virus particle
+        (a list of strings).
+
+        rng: where the random numbers are drawn from, see
+        SimpleVirus.doesClear()
+
+        returns: a new instance of the ResistantVirus class, or None.
+        """
+        resistances = self.resistances
         for d in activeDrugs:
-            if self.isResistantTo(d) == False:
-                raise NoChildException()
+            if not resistances.get(d, False):
+                return None
+        if rng.random() >= self.maxBirthProb * (1 - popDensity):
+            return None
+        return self.makeChild(rng)
 
-        for k in self.resistances:   
-            if self.resistances[k] == True:
-                if random.random() <= 1 - self.getMutProb():
-                    res[k] = True
-                else:
-                    res[k] = False
-            elif self.resistances[k] == False:
-                if random.random() <= 1 - self.getMutProb():
-                    res[k] = False
-                else:
-                    res[k] = True
-                
-        if ran < self.getMaxBirthProb() * (1 - popDensity):
-            return ResistantVirus(self.getMaxBirthProb(), self.getClearProb(), res, self.getMutProb())
-        else:
-            raise NoChildException()
+    def makeChild(self, rng=random):
+        """
+        Returns the offspring of this virus particle, switching each of its
+        resistance traits with probability mutProb. This is the mutation step
+        of tryReproduce(), called once the particle is known to reproduce.
+
+        Rather than drawing one random number per trait, the number of traits
+        kept before the next switched one is drawn from a geometric
+        distribution, so a child costs one draw plus one per mutation
+        whatever the number of drugs.
+
+        rng: where the random numbers are drawn from, see
+        SimpleVirus.doesClear()
+        """
+        resistances = self.resistances
+        mutProb = self.mutProb
+        if mutProb > 0:
+            drugs = resistances.drugs
+            if mutProb < 1:
+                logKeep = ResistantVirus.logKeep.get(mutProb)
+                if logKeep is None:
+                    logKeep = math.log1p(-mutProb)
+                    ResistantVirus.logKeep[mutProb] = logKeep
+                flipped = []
+                i = int(math.log(1.0 - rng.random()) / logKeep)
+                while i < len(drugs):
+                    flipped.append(drugs[i])
+                    i += 1 + int(math.log(1.0 - rng.random()) / logKeep)
+            else:
+                flipped = drugs
+            if flipped:
+                resistances = resistances.mutate(flipped)
+        return ResistantVirus(self.maxBirthProb, self.clearProb, resistances,
+                              mutProb)
 
 
 class TreatedPatient(Patient):
@@ -330,7 +910,7 @@ class TreatedPatient(Patient):
     Representation of a patient. The patient is able to take drugs and his/her
     virus population can acquire resistance to the drugs he/she takes.
     """
-    def __init__(self, viruses, maxPop):
+    def __init__(self, viruses, maxPop, rng=None):
         """
         Initialization function, saves the viruses and maxPop parameters as
         attributes. Also initializes the list of drugs being administered
@@ -340,11 +920,42 @@ class TreatedPatient(Patient):
         virus instances)
 
         maxPop: The  maximum virus population for this patient (an integer)
+
+        rng: the RandomStream this patient draws from, see Patient.__init__()
         """
-        Patient.__init__(self, viruses, maxPop)
+        Patient.__init__(self, viruses, maxPop, rng)
         drugs = []
         self.drugs = drugs
-        
+        self.rebuildResistIndex()
+
+    def rebuildResistIndex(self):
+        """
+        Recounts the resistance index from the list of viruses. update()
+        keeps the index current, and it is recounted whenever the viruses
+        attribute is replaced by another list or changes length; this is
+        only needed after changing an element of that list in place.
+
+        The index maps every resistance bitmask (see Genotype) present in the
+        population to the number of particles carrying it.
+        """
+        index = {}
+        for v in self.viruses:
+            r = v.resistances.resist
+            index[r] = index.get(r, 0) + 1
+        self.resistIndex = index
+        self.resistCache = {}
+        self.indexedViruses = self.viruses
+        self.indexedPop = len(self.viruses)
+
+    def _checkResistIndex(self):
+        """
+        Recounts the resistance index if the viruses attribute was replaced
+        or resized since it was last indexed.
+        """
+        if (self.indexedViruses is not self.viruses or
+                self.indexedPop != len(self.viruses)):
+            self.rebuildResistIndex()
+
     def addPrescription(self, newDrug):
         """
         Administer a drug to this patient. After a prescription is added, the
@@ -358,6 +969,16 @@ class TreatedPatient(Patient):
         if newDrug not in self.drugs:
             self.drugs.append(newDrug)
 
+    def removePrescription(self, drug):
+        """
+        Stop administering a drug to this patient. If the drug is not
+        prescribed to this patient, the method has no effect.
+
+        drug: The name of the drug to stop (a string).
+        """
+        if drug in self.drugs:
+            self.drugs.remove(drug)
+
     def getPrescriptions(self):
         """
         Returns the drugs that are being administered to this patient.
@@ -367,6 +988,21 @@ class TreatedPatient(Patient):
         """
         return self.drugs
 
+    def getState(self):
+        """
+        Returns the state of this patient, see Patient.getState(). The
+        prescriptions are included.
+        """
+        state = Patient.getState(self)
+        state["drugs"] = list(self.drugs)
+        return state
+
+    def _activeMask(self):
+        """
+        Returns the bitmask of the drugs being administered.
+        """
+        return drugRegistry.getMask(self.drugs)
+
     def getResistPop(self, drugResist):
         """
         Get the population of virus particles resistant to the drugs listed in
@@ -378,18 +1014,15 @@ class TreatedPatient(Patient):
         returns: The population of viruses (an integer) with resistances to all
         drugs in the drugResist list.
         """
-        virusNr = 0
-        viruses = self.getViruses()
-        
-        for v in viruses:
-            count = 0
-            for d in drugResist:
-                if v.isResistantTo(d) == True:
-                    count += 1
-                else:
-                    break
-            if count == len(drugResist):
-                virusNr += 1
+        self._checkResistIndex()
+        mask = drugRegistry.getMask(drugResist)
+        virusNr = self.resistCache.get(mask)
+        if virusNr is None:
+            virusNr = 0
+            for r, count in self.resistIndex.items():
+                if r & mask == mask:
+                    virusNr += count
+            self.resistCache[mask] = virusNr
         return virusNr
                 
     def update(self):
@@ -412,83 +1045,138 @@ class TreatedPatient(Patient):
         returns: The total virus population at the end of the update (an
         integer)
         """
+        counters = self.counters
+        if counters is not None:
+            record = counters.newRecord()
+            clock = time.perf_counter
+            start = clock()
+        self._checkResistIndex()
+        index = self.resistIndex
+        rng = self.rng
         virusList = []
-       
         for v in self.viruses:
-            if v.doesClear() == False:
+            if not v.doesClear(rng):
                 virusList.append(v)
+            else:
+                r = v.resistances.resist
+                index[r] -= 1
+                if not index[r]:
+                    del index[r]
+        if counters is not None:
+            cleared = clock()
+        popDen = (1.0 * len(virusList)) / self.getMaxPop()
+        drugs = self.drugs
+        if counters is not None:
+            density = clock()
+            # the survivors not resistant to all active drugs cannot
+            # reproduce
+            mask = self._activeMask()
+            blocked = 0
+            for r, count in index.items():
+                if r & mask != mask:
+                    blocked += count
+            mutating = 0.0
+            flips = {}
+
+        # the calls that produce offspring are timed as the mutation phase
+        children = []
+        for v in virusList:
+            if counters is None:
+                child = v.tryReproduce(popDen, drugs, rng)
+                if child is None:
+                    continue
+            else:
+                callStart = clock()
+                child = v.tryReproduce(popDen, drugs, rng)
+                if child is None:
+                    continue
+                mutating += clock() - callStart
+                flipped = child.resistances.resist ^ v.resistances.resist
+                if flipped:
+                    flips[flipped] = flips.get(flipped, 0) + 1
+            children.append(child)
+            r = child.resistances.resist
+            index[r] = index.get(r, 0) + 1
+        if counters is not None:
+            record["clearances"] = len(self.viruses) - len(virusList)
+        virusList.extend(children)
         self.viruses = virusList
-        popDen = (1.0 * self.getTotalPop()) / self.getMaxPop()
+        self.resistCache = {}
+        self.indexedViruses = virusList
+        self.indexedPop = len(virusList)
 
-        for v in self.viruses[:]:
-            try:
-                child = v.reproduce(popDen, self.getPrescriptions())
-                self.viruses.append(child)
-            except NoChildException:
-                pass        
+        if counters is not None:
+            mutations = record["mutations"]
+            for flipped, count in flips.items():
+                for d in drugRegistry.getNames(flipped):
+                    mutations[d] = mutations.get(d, 0) + count
+            record["births"] = len(children)
+            record["blocked"] = blocked
+            record["population"] = len(virusList)
+            record["clearance"] = cleared - start
+            record["density"] = density - cleared
+            record["mutation"] = mutating
+            record["reproduction"] = clock() - density - mutating
+            counters.addRecord(self, record)
         return self.getTotalPop()
 
 #
 # PROBLEM 4
 #
-def simulationWithDrug(numViruses, maxPop, maxBirthProb, clearProb, resistances,
-                       mutProb, numTrials):
+def computeWithDrug(numViruses, maxPop, maxBirthProb, clearProb, resistances,
+                    mutProb, numTrials, patientClass=TreatedPatient, seed=None,
+                    numWorkers=1):
     """
-    Runs simulations and plots graphs for problem 4.
+    Runs the simulations for problem 4 without plotting anything.
 
     For each of numTrials trials, instantiates a patient, runs a simulation for
     150 timesteps, adds guttagonol, and runs the simulation for an additional
-    150 timesteps.  At the end plots the average virus population size
-    (for both the total virus population and the guttagonol-resistant virus
-    population) as a function of time.
+    150 timesteps, recording the total virus population and the
+    guttagonol-resistant virus population.
 
     numViruses: number of ResistantVirus to create for patient (an integer)
     maxPop: maximum virus population for patient (an integer)
-    maxBirthProb: Maximum reproduction probability (a float between 0-1)        
+    maxBirthProb: Maximum reproduction probability (a float between 0-1)
     clearProb: maximum clearance probability (a float between 0-1)
     resistances: a dictionary of drugs that each ResistantVirus is resistant to
                  (e.g., {'guttagonol': False})
     mutProb: mutation probability for each ResistantVirus particle
-             (a float between 0-1). 
+             (a float between 0-1).
     numTrials: number of simulation runs to execute (an integer)
-    
-    """
-    virusList = []
-    
-    flu = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)
-    for i in range(0, numViruses):
-        virusList.append(flu)
-    
-    progressList = []
-    progressList2 = []
-    for x in range(0, 300):
-        progressList.append(0.0)
-        progressList2.append(0.0)
-    
-    cured = 0
-    for i in range(0, numTrials):
-        jacek = TreatedPatient(virusList, maxPop)
-        for a in range(0, 300):
-            if a == 150:
-                jacek.addPrescription("guttagonol")
-            jacek.update()
-            progressList[a] += jacek.getTotalPop()
-            progressList2[a] += jacek.getResistPop(["guttagonol"])
-        if jacek.getTotalPop() <= 50:
-            cured += 1
-
-    for i in range(0, 300):
-        progressList[i] /= float(numTrials)
-        progressList2[i] /= float(numTrials)
-        
-    pylab.plot(range(0, 300), progressList, label="Total virus population")
-    pylab.plot(range(0, 300), progressList2, label="Resistant virus population")
-    pylab.title("Influence of a drug treatment on a virus population")
-    pylab.xlabel("Time steps")
-    pylab.ylabel("Number of virus particles")
-    pylab.legend(loc="best")
-    pylab.grid()
-    pylab.show()
+    patientClass: the patient implementation to simulate (TreatedPatient,
+                  ArrayTreatedPatient or GenotypeTreatedPatient)
+    seed: the seed of the run (an integer), see runTrials()
+    numWorkers: number of worker processes to run the trials on (an integer)
+
+    returns: the TrialSummary of the trials
+    """
+    scenario = Scenario(numViruses, maxPop, maxBirthProb, clearProb,
+                        resistances, mutProb, numSteps=300,
+                        prescriptions=[(150, "guttagonol")],
+                        resistDrugs=["guttagonol"], patientClass=patientClass)
+    return runTrials(scenario, numTrials, seed, numWorkers)
+
+
+def simulationWithDrug(numViruses, maxPop, maxBirthProb, clearProb, resistances,
+                       mutProb, numTrials, patientClass=TreatedPatient,
+                       seed=None, numWorkers=1):
+    """
+    Runs simulations and plots graphs for problem 4.
+
+    For each of numTrials trials, instantiates a patient, runs a simulation for
+    150 timesteps, adds guttagonol, and runs the simulation for an additional
+    150 timesteps.  At the end plots the average virus population size
+    (for both the total virus population and the guttagonol-resistant virus
+    population) as a function of time. The arguments are those of
+    computeWithDrug().
+
+    returns: the TrialSummary of the trials
+    """
+    summary = computeWithDrug(numViruses, maxPop, maxBirthProb, clearProb,
+                              resistances, mutProb, numTrials, patientClass,
+                              seed, numWorkers)
+    plotSummary(summary, "Influence of a drug treatment on a virus population")
+    return summary
 
 # Uncomment to see this function in action:
 #example1:
@@ -497,58 +1185,4317 @@ def simulationWithDrug(numViruses, maxPop, maxBirthProb, clearProb, resistances,
 #simulationWithDrug(15, 200, 0.06, 0.05, {"guttagonol": False, "grimpex" : True}, 0.05, 50)
 
 
-def simulationWithDrugs(numViruses, maxPop, maxBirthProb, clearProb, resistances,
-                       mutProb, numTrials):
+def computeWithDrugs(numViruses, maxPop, maxBirthProb, clearProb, resistances,
+                     mutProb, numTrials, patientClass=TreatedPatient, seed=None,
+                     numWorkers=1):
     """
     For each of numTrials trials, instantiates a patient, runs a simulation for
     150 timesteps, adds guttagonol, runs the simulation for an additional
     75 timesteps, adds grimpex, and runs the simulation for 150 time steps.
-    At the end plots the average virus population size as a function of time.
+    Nothing is plotted.
 
     numViruses: number of ResistantVirus to create for patient (an integer)
     maxPop: maximum virus population for patient (an integer)
-    maxBirthProb: Maximum reproduction probability (a float between 0-1)        
+    maxBirthProb: Maximum reproduction probability (a float between 0-1)
     clearProb: maximum clearance probability (a float between 0-1)
     resistances: a dictionary of drugs that each ResistantVirus is resistant to
                  (e.g., {'guttagonol': False})
     mutProb: mutation probability for each ResistantVirus particle
-             (a float between 0-1). 
+             (a float between 0-1).
     numTrials: number of simulation runs to execute (an integer)
+    patientClass: the patient implementation to simulate (TreatedPatient,
+                  ArrayTreatedPatient or GenotypeTreatedPatient)
+    seed: the seed of the run (an integer), see runTrials()
+    numWorkers: number of worker processes to run the trials on (an integer)
+
+    returns: the TrialSummary of the trials
     """
     guttagonolStep = 150
     grimpexStep = 225
-    virusList = []
-    progressList = []
-    virus = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)
-
-    for i in range(0, numViruses):
-        virusList.append(virus)
-    for i in range(0, 375):
-        progressList.append(0.0)
-    
-    cured = 0    
-    for i in range(0, numTrials):
-        jacek = TreatedPatient(virusList, maxPop)
-        for a in range(0, 375):
-            if a == guttagonolStep:
-                jacek.addPrescription("guttagonol")
-            if a == grimpexStep:
-                jacek.addPrescription("grimpex")
-            jacek.update()
-            progressList[a] += jacek.getTotalPop()
-        if jacek.getTotalPop() <= 50:
-            cured += 1
-
-    for i in range(0, 375):
-        progressList[i] /= float(numTrials)
-        
-    pylab.plot(range(0, 375), progressList, label="Total virus population")
-    pylab.title("Influence of a drug treatment on a virus population")
-    pylab.xlabel("Time steps")
-    pylab.ylabel("Number of virus particles")
-    pylab.legend(loc="best")
-    pylab.grid()
-    pylab.show()
+    scenario = Scenario(numViruses, maxPop, maxBirthProb, clearProb,
+                        resistances, mutProb, numSteps=375,
+                        prescriptions=[(guttagonolStep, "guttagonol"),
+                                       (grimpexStep, "grimpex")],
+                        patientClass=patientClass)
+    return runTrials(scenario, numTrials, seed, numWorkers)
+
+
+def simulationWithDrugs(numViruses, maxPop, maxBirthProb, clearProb, resistances,
+                       mutProb, numTrials, patientClass=TreatedPatient,
+                       seed=None, numWorkers=1):
+    """
+    For each of numTrials trials, instantiates a patient, runs a simulation for
+    150 timesteps, adds guttagonol, runs the simulation for an additional
+    75 timesteps, adds grimpex, and runs the simulation for 150 time steps.
+    At the end plots the average virus population size as a function of time.
+    The arguments are those of computeWithDrugs().
+
+    returns: the TrialSummary of the trials
+    """
+    summary = computeWithDrugs(numViruses, maxPop, maxBirthProb, clearProb,
+                               resistances, mutProb, numTrials, patientClass,
+                               seed, numWorkers)
+    plotSummary(summary, "Influence of a drug treatment on a virus population")
+    return summary
 
 # Uncomment below to see this function at work:
 #simulationWithDrugs(15, 300, 0.2, 0.15, {"guttagonol" : False, "grimpex" : False}, 0.01, 100)
+
+
+#
+# VECTORIZED ENGINE
+#
+def virusGenotype(virus):
+    """
+    Returns the genotype of a virus particle: the tuple (maxBirthProb,
+    clearProb, mutProb, traits, resist) where traits and resist are the
+    bitmasks returned by DrugRegistry.toMasks(). A SimpleVirus has no traits
+    and a mutProb of 0.
+    """
+    if hasattr(virus, "getResistances"):
+        traits, resist = drugRegistry.toMasks(virus.getResistances())
+        return (virus.getMaxBirthProb(), virus.getClearProb(),
+                virus.getMutProb(), traits, resist)
+    return (virus.getMaxBirthProb(), virus.getClearProb(), 0.0, 0, 0)
+
+
+def _toWords(mask, numWords):
+    """
+    Splits a bitmask (an integer) into an array of numWords 64-bit words.
+    Returns None if the mask has bits set beyond the last word.
+    """
+    if mask >> (64 * numWords):
+        return None
+    return numpy.array([(mask >> (64 * w)) & 0xFFFFFFFFFFFFFFFF
+                        for w in range(numWords)], dtype=numpy.uint64)
+
+
+def _fromWords(words):
+    """
+    Joins an array of 64-bit words back into a bitmask (an integer).
+    """
+    mask = 0
+    for w in range(len(words)):
+        mask |= int(words[w]) << (64 * w)
+    return mask
+
+
+def _drawFlips(rng, mutProbs, numTraits):
+    """
+    Draws the resistance traits switched in offspring, each trait of a child
+    with the mutation probability of the child.
+
+    rng: the numpy.random.Generator to draw from
+    mutProbs: the mutation probability of every child (an array)
+    numTraits: the number of traits
+
+    returns: (rows, columns), the child and the index of the trait of every
+    switch (two arrays without repeated pairs)
+    """
+    k = len(mutProbs)
+    mutProb = mutProbs[0]
+    if (mutProbs == mutProb).all():
+        # one probability: draw the number of switches, then their positions
+        # among the k * numTraits (child, trait) pairs
+        if mutProb <= 0:
+            return (numpy.zeros(0, dtype=numpy.int64),
+                    numpy.zeros(0, dtype=numpy.int64))
+        count = int(rng.binomial(k * numTraits, min(mutProb, 1.0)))
+        positions = rng.choice(k * numTraits, count, replace=False)
+        return numpy.divmod(positions, numTraits)
+    return numpy.nonzero(rng.random((k, numTraits)) < mutProbs[:, None])
+
+
+def _drawFlipWords(rng, mutProbs, traitBits, numWords):
+    """
+    Draws the resistance traits switched in offspring, see _drawFlips().
+
+    traitBits: the bit positions of the traits (a list of integers)
+    numWords: the number of 64-bit words of a bitmask
+
+    returns: the switched traits of every child as packed bitmask words (an
+    array of shape (children, numWords))
+    """
+    bits = numpy.array(traitBits, dtype=numpy.int64)
+    flipWords = numpy.zeros((len(mutProbs), numWords), dtype=numpy.uint64)
+    rows, columns = _drawFlips(rng, mutProbs, len(traitBits))
+    numpy.bitwise_or.at(
+        flipWords, (rows, bits[columns] // 64),
+        numpy.left_shift(numpy.uint64(1),
+                         (bits[columns] % 64).astype(numpy.uint64)))
+    return flipWords
+
+
+class ArrayPatient(object):
+    """
+    Representation of a patient whose virus population is kept as a set of
+    preallocated NumPy arrays (one entry per virus particle) instead of a list
+    of virus objects. Behaves like Patient, but clearance, the population
+    density and reproduction are computed as vectorized masks over the whole
+    population, which makes large values of maxPop practical.
+    """
+    def __init__(self, viruses, maxPop, rng=None):
+        """
+        Initialization function, copies the parameters of the viruses into
+        the population arrays.
+
+        viruses: the list representing the virus population (a list of
+        SimpleVirus or ResistantVirus instances)
+
+        maxPop: the maximum virus population for this patient (an integer)
+
+        rng: the numpy.random.Generator or RandomStream to draw from. If None,
+        a generator is seeded from the random module, so that random.seed()
+        makes the run reproducible.
+        """
+        self.rng = _generator(rng)
+        self.maxPop = maxPop
+        self.drugs = []
+        self.counters = None
+
+        genotypes = []
+        index = {}
+        particles = numpy.empty(len(viruses), dtype=numpy.int64)
+        last = None
+        for i in range(len(viruses)):
+            # the initial population usually repeats a single virus object
+            if viruses[i] is not last:
+                last = viruses[i]
+                genotype = virusGenotype(last)
+            if genotype not in index:
+                index[genotype] = len(genotypes)
+                genotypes.append(genotype)
+            particles[i] = index[genotype]
+        self._load(genotypes, particles)
+
+    def _load(self, genotypes, particles, allTraits=0):
+        """
+        Replaces the population arrays.
+
+        genotypes: a list of genotypes (see virusGenotype())
+        particles: an array holding the index in genotypes of every particle
+        allTraits: a bitmask of traits to draw mutations for, in addition to
+                   the traits of the genotypes
+        """
+        for genotype in genotypes:
+            allTraits |= genotype[3]
+        self.numWords = max(1, (allTraits.bit_length() + 63) // 64)
+        self.traitBits = drugRegistry.getBits(allTraits)
+
+        self.size = len(particles)
+        capacity = max(2 * self.maxPop, 2 * self.size, 16)
+        self.birthProbs = numpy.zeros(capacity)
+        self.clearProbs = numpy.zeros(capacity)
+        self.mutProbs = numpy.zeros(capacity)
+        self.traits = numpy.zeros((capacity, self.numWords), dtype=numpy.uint64)
+        self.resist = numpy.zeros((capacity, self.numWords), dtype=numpy.uint64)
+        if not genotypes:
+            return
+        n = self.size
+        self.birthProbs[:n] = numpy.array([g[0] for g in genotypes])[particles]
+        self.clearProbs[:n] = numpy.array([g[1] for g in genotypes])[particles]
+        self.mutProbs[:n] = numpy.array([g[2] for g in genotypes])[particles]
+        self.traits[:n] = numpy.array([_toWords(g[3], self.numWords)
+                                       for g in genotypes])[particles]
+        self.resist[:n] = numpy.array([_toWords(g[4], self.numWords)
+                                       for g in genotypes])[particles]
+
+    def getViruses(self):
+        """
+        Returns the viruses in this Patient, as a new list of SimpleVirus
+        instances.
+        """
+        n = self.size
+        return [SimpleVirus(float(self.birthProbs[i]), float(self.clearProbs[i]))
+                for i in range(n)]
+
+    def getMaxPop(self):
+        """
+        Returns the max population.
+        """
+        return self.maxPop
+
+    def getTotalPop(self):
+        """
+        Gets the size of the current total virus population.
+        returns: The total virus population (an integer)
+        """
+        return self.size
+
+    def setCounters(self, counters):
+        """
+        Enables the instrumentation of update() (see Patient.setCounters()).
+
+        counters: an UpdateCounters instance, or None
+        """
+        self.counters = counters
+
+    def getCounters(self):
+        """
+        Returns the UpdateCounters instrumenting update(), or None.
+        """
+        return self.counters
+
+    def getState(self):
+        """
+        Returns the state of this patient as a dictionary that fromState()
+        and snapshotPatient() accept: the population as a table of
+        genotypes plus the genotype of every particle in order, maxPop, the
+        prescriptions and the state of the generator.
+        """
+        n = self.size
+        rows = numpy.column_stack(
+            [self.birthProbs[:n].view(numpy.uint64),
+             self.clearProbs[:n].view(numpy.uint64),
+             self.mutProbs[:n].view(numpy.uint64),
+             self.traits[:n], self.resist[:n]])
+        table, particles = numpy.unique(rows, axis=0, return_inverse=True)
+        w = self.numWords
+        floats = table[:, :3].copy().view(numpy.float64)
+        genotypes = [(float(floats[i, 0]), float(floats[i, 1]),
+                      float(floats[i, 2]), _fromWords(table[i, 3:3 + w]),
+                      _fromWords(table[i, 3 + w:]))
+                     for i in range(len(table))]
+        allTraits = 0
+        for bit in self.traitBits:
+            allTraits |= 1 << bit
+        state = encodeGenotypes(genotypes, allTraits)
+        state["class"] = type(self).__name__
+        state["maxPop"] = self.maxPop
+        state["drugs"] = list(self.drugs)
+        state["particles"] = particles.reshape(-1).astype(numpy.int64)
+        state["rng"] = self.rng.bit_generator.state
+        state["antithetic"] = isinstance(self.rng, AntitheticGenerator)
+        return state
+
+    @classmethod
+    def fromState(cls, state, restoreRandom=True):
+        """
+        Creates a patient from a dictionary returned by getState().
+
+        restoreRandom: whether to restore the state of the generator, so that
+        the patient continues exactly as the saved one would have
+        """
+        rng = None
+        if restoreRandom:
+            rng = _restoreGenerator(state["rng"],
+                                    state.get("antithetic", False))
+        patient = cls([], state["maxPop"], rng)
+        allTraits = drugRegistry.getMask(state["traitNames"])
+        patient._load(decodeGenotypes(state), state["particles"], allTraits)
+        for drug in state.get("drugs", ()):
+            patient.drugs.append(drug)
+        return patient
+
+    def _columns(self):
+        """
+        Returns the list of population arrays, one per particle attribute.
+        """
+        return [self.birthProbs, self.clearProbs, self.mutProbs,
+                self.traits, self.resist]
+
+    def _reserve(self, size):
+        """
+        Grows the population arrays so that they hold at least size particles.
+        """
+        capacity = len(self.birthProbs)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        grown = []
+        for col in self._columns():
+            new = numpy.zeros((capacity,) + col.shape[1:], dtype=col.dtype)
+            new[:self.size] = col[:self.size]
+            grown.append(new)
+        self.birthProbs, self.clearProbs, self.mutProbs, \
+            self.traits, self.resist = grown
+
+    def _resistantMask(self, mask):
+        """
+        Returns a boolean array telling for every particle whether it is
+        resistant to all the drugs in mask (an integer bitmask).
+        """
+        n = self.size
+        if mask == 0:
+            return numpy.ones(n, dtype=bool)
+        words = _toWords(mask, self.numWords)
+        if words is None:
+            return numpy.zeros(n, dtype=bool)
+        return ((self.resist[:n] & words) == words).all(axis=1)
+
+    def _activeMask(self):
+        """
+        Returns the bitmask of the drugs acting on the virus population.
+        """
+        return 0
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, in the same order as Patient.update():
+
+        - Clear every particle with probability clearProb and compact the
+          population arrays.
+
+        - Compute the population density.
+
+        - Let every survivor that is resistant to all active drugs reproduce
+          with probability maxBirthProb * (1 - popDensity), flipping each of
+          the offspring's resistance traits with probability mutProb.
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        counters = self.counters
+        if counters is not None:
+            record = counters.newRecord()
+            clock = time.perf_counter
+            start = clock()
+        n = self.size
+        survive = self.rng.random(n) >= self.clearProbs[:n]
+        m = int(numpy.count_nonzero(survive))
+        if m < n:
+            for col in self._columns():
+                col[:m] = col[:n][survive]
+        self.size = m
+        if counters is not None:
+            cleared = clock()
+        popDen = (1.0 * m) / self.getMaxPop()
+        if counters is not None:
+            density = clock()
+
+        born = self.rng.random(m) < self.birthProbs[:m] * (1 - popDen)
+        mask = self._activeMask()
+        if mask:
+            resistant = self._resistantMask(mask)
+            born &= resistant
+            if counters is not None:
+                record["blocked"] = m - int(numpy.count_nonzero(resistant))
+        parents = numpy.flatnonzero(born)
+        k = len(parents)
+        if k:
+            self._reserve(m + k)
+            for col in self._columns():
+                col[m:m + k] = col[parents]
+        if counters is not None:
+            reproduced = clock()
+        if k and self.traitBits:
+            flipWords = self._drawFlips(self.mutProbs[parents])
+            flipWords &= self.traits[m:m + k]
+            self.resist[m:m + k] ^= flipWords
+            if counters is not None:
+                mutations = record["mutations"]
+                for bit in self.traitBits:
+                    count = int(numpy.count_nonzero(
+                        flipWords[:, bit // 64] >> numpy.uint64(bit % 64)
+                        & numpy.uint64(1)))
+                    if count:
+                        drug = drugRegistry.names[bit]
+                        mutations[drug] = mutations.get(drug, 0) + count
+        self.size = m + k
+
+        if counters is not None:
+            record["clearances"] = n - m
+            record["births"] = k
+            record["population"] = self.size
+            record["clearance"] = cleared - start
+            record["density"] = density - cleared
+            record["reproduction"] = reproduced - density
+            record["mutation"] = clock() - reproduced
+            counters.addRecord(self, record)
+        return self.size
+
+
+    def _drawFlips(self, mutProbs):
+        """
+        Draws the resistance traits switched in the offspring of a time step,
+        see _drawFlipWords().
+        """
+        return _drawFlipWords(self.rng, mutProbs, self.traitBits,
+                              self.numWords)
+
+
+class ArrayTreatedPatient(ArrayPatient):
+    """
+    Representation of a patient that takes drugs, with the virus population
+    kept as NumPy arrays. Behaves like TreatedPatient; each particle's
+    resistances are stored as a packed bitmask column (see DrugRegistry).
+    """
+    def __init__(self, viruses, maxPop, rng=None):
+        """
+        Initialization function, see ArrayPatient.__init__(). Also initializes
+        the list of drugs being administered (which initially includes no
+        drugs).
+
+        viruses: The list representing the virus population (a list of
+        ResistantVirus instances)
+
+        maxPop: The maximum virus population for this patient (an integer)
+
+        rng: the numpy.random.Generator or RandomStream to draw from
+        (optional)
+        """
+        ArrayPatient.__init__(self, viruses, maxPop, rng)
+
+    def getViruses(self):
+        """
+        Returns the viruses in this Patient, as a new list of ResistantVirus
+        instances.
+        """
+        viruses = []
+        for i in range(self.size):
+            resistances = drugRegistry.toDict(_fromWords(self.traits[i]),
+                                              _fromWords(self.resist[i]))
+            viruses.append(ResistantVirus(float(self.birthProbs[i]),
+                                          float(self.clearProbs[i]),
+                                          resistances,
+                                          float(self.mutProbs[i])))
+        return viruses
+
+    def addPrescription(self, newDrug):
+        """
+        Administer a drug to this patient. If the newDrug is already
+        prescribed to this patient, the method has no effect.
+
+        newDrug: The name of the drug to administer to the patient (a string).
+        """
+        if newDrug not in self.drugs:
+            self.drugs.append(newDrug)
+
+    def removePrescription(self, drug):
+        """
+        Stop administering a drug to this patient. If the drug is not
+        prescribed to this patient, the method has no effect.
+
+        drug: The name of the drug to stop (a string).
+        """
+        if drug in self.drugs:
+            self.drugs.remove(drug)
+
+    def getPrescriptions(self):
+        """
+        Returns the drugs that are being administered to this patient.
+
+        returns: The list of drug names (strings) being administered to this
+        patient.
+        """
+        return self.drugs
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist.
+
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'srinol'])
+
+        returns: The population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        mask = drugRegistry.getMask(drugResist)
+        return int(numpy.count_nonzero(self._resistantMask(mask)))
+
+    def _activeMask(self):
+        """
+        Returns the bitmask of the drugs being administered.
+        """
+        return drugRegistry.getMask(self.drugs)
+
+
+#
+# JIT ENGINE
+#
+_numba = []
+
+
+def _importNumba():
+    """
+    Imports numba the first time it is needed, since importing it takes
+    several times as long as importing this module.
+
+    returns: the numba module, or None if it is not installed
+    """
+    if not _numba:
+        try:
+            import numba
+        except ImportError:
+            numba = None
+        _numba.append(numba)
+    return _numba[0]
+
+
+def _jit(function):
+    """
+    Returns a version of function that is compiled with numba on its first
+    call if numba is installed, caching the machine code on disk (next to
+    this module, or in NUMBA_CACHE_DIR) so that new processes do not
+    compile it again. Without numba the function itself is called.
+    """
+    compiled = []
+
+    def call(*args):
+        if not compiled:
+            numba = _importNumba()
+            if numba is None:
+                compiled.append(function)
+            else:
+                compiled.append(numba.njit(cache=True, nogil=True)(function))
+        return compiled[0](*args)
+    call.__name__ = function.__name__
+    call.__doc__ = function.__doc__
+    return call
+
+
+@_jit
+def _clearKernel(size, draws, birthProbs, clearProbs, mutProbs, traits,
+                 resist):
+    """
+    Removes the particles whose draw is below their clearance probability,
+    keeping the order of the survivors, and returns their number.
+    """
+    m = 0
+    for i in range(size):
+        if draws[i] >= clearProbs[i]:
+            if m != i:
+                birthProbs[m] = birthProbs[i]
+                clearProbs[m] = clearProbs[i]
+                mutProbs[m] = mutProbs[i]
+                for w in range(traits.shape[1]):
+                    traits[m, w] = traits[i, w]
+                    resist[m, w] = resist[i, w]
+            m += 1
+    return m
+
+
+@_jit
+def _birthKernel(size, draws, popDen, needed, birthProbs, clearProbs,
+                 mutProbs, traits, resist):
+    """
+    Appends a copy of every particle whose draw is below its birth
+    probability and that is resistant to the drugs in the words needed, in
+    order, after the first size particles, and returns the number of copies.
+    """
+    k = 0
+    for i in range(size):
+        if draws[i] < birthProbs[i] * (1 - popDen):
+            resistant = True
+            for w in range(needed.shape[0]):
+                if resist[i, w] & needed[w] != needed[w]:
+                    resistant = False
+                    break
+            if resistant:
+                j = size + k
+                birthProbs[j] = birthProbs[i]
+                clearProbs[j] = clearProbs[i]
+                mutProbs[j] = mutProbs[i]
+                for w in range(traits.shape[1]):
+                    traits[j, w] = traits[i, w]
+                    resist[j, w] = resist[i, w]
+                k += 1
+    return k
+
+
+@_jit
+def _flipKernel(start, rows, bits, traits, resist):
+    """
+    Switches the resistance bit bits[i] of particle start + rows[i] for
+    every i, if the particle has that trait.
+    """
+    for i in range(rows.shape[0]):
+        j = start + rows[i]
+        w = bits[i] // 64
+        bit = numpy.uint64(1) << numpy.uint64(bits[i] % 64)
+        if traits[j, w] & bit:
+            resist[j, w] ^= bit
+
+
+class JitPatient(ArrayPatient):
+    """
+    Version of ArrayPatient whose update() runs as compiled loops (see
+    _jit()) instead of NumPy masks: clearance compacts the arrays in place,
+    reproduction appends the offspring in one pass, and mutations are
+    applied without building packed words for every child. The random
+    numbers are drawn exactly as in ArrayPatient.update(), so the results
+    are identical to ArrayPatient's.
+
+    Without numba, or with counters set, update() is ArrayPatient.update().
+    """
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, see ArrayPatient.update().
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        if _importNumba() is None or self.counters is not None:
+            return ArrayPatient.update(self)
+        n = self.size
+        m = _clearKernel(n, self.rng.random(n), self.birthProbs,
+                         self.clearProbs, self.mutProbs, self.traits,
+                         self.resist)
+        self.size = m
+        popDen = (1.0 * m) / self.getMaxPop()
+
+        draws = self.rng.random(m)
+        needed = _toWords(self._activeMask(), self.numWords)
+        if needed is None:
+            return self.size
+        self._reserve(2 * m)
+        k = _birthKernel(m, draws, popDen, needed, self.birthProbs,
+                         self.clearProbs, self.mutProbs, self.traits,
+                         self.resist)
+        if k and self.traitBits:
+            rows, columns = _drawFlips(self.rng, self.mutProbs[m:m + k],
+                                       len(self.traitBits))
+            bits = numpy.array(self.traitBits, dtype=numpy.int64)[columns]
+            _flipKernel(m, rows.astype(numpy.int64), bits, self.traits,
+                        self.resist)
+        self.size = m + k
+        return self.size
+
+
+class JitTreatedPatient(JitPatient, ArrayTreatedPatient):
+    """
+    Representation of a patient that takes drugs, with the virus population
+    updated by the compiled loops of JitPatient. Behaves like
+    TreatedPatient, with results identical to ArrayTreatedPatient's.
+    """
+
+
+#
+# GENOTYPE-COUNT ENGINE
+#
+class GenotypePatient(object):
+    """
+    Representation of a patient whose virus population is kept as a count of
+    particles per genotype instead of one object per particle. Particles with
+    the same maxBirthProb, clearProb, mutProb and resistances are
+    indistinguishable, so clearance, births and mutations are drawn with
+    binomial sampling once per genotype. The cost of update() depends on the
+    number of genotypes present, not on the population size.
+
+    A genotype is a tuple (maxBirthProb, clearProb, mutProb, traits, resist)
+    where traits and resist are bitmasks as returned by
+    DrugRegistry.toMasks(), see virusGenotype().
+    """
+    def __init__(self, viruses, maxPop, rng=None):
+        """
+        Initialization function, counts the viruses per genotype.
+
+        viruses: the list representing the virus population (a list of
+        SimpleVirus or ResistantVirus instances)
+
+        maxPop: the maximum virus population for this patient (an integer)
+
+        rng: the numpy.random.Generator or RandomStream to draw from. If None,
+        a generator is seeded from the random module.
+        """
+        self.rng = _generator(rng)
+        self.maxPop = maxPop
+        self.drugs = []
+        self.counters = None
+        self.counts = {}
+        for v in viruses:
+            genotype = virusGenotype(v)
+            self.counts[genotype] = self.counts.get(genotype, 0) + 1
+        self.total = len(viruses)
+
+    @classmethod
+    def fromCounts(cls, counts, maxPop, rng=None):
+        """
+        Creates a patient directly from genotype counts, without building a
+        virus object per particle.
+
+        counts: a dictionary mapping genotypes to particle counts (integers)
+
+        maxPop: the maximum virus population for this patient (an integer)
+        """
+        patient = cls([], maxPop, rng)
+        patient.counts = dict((g, c) for g, c in counts.items() if c > 0)
+        patient.total = sum(patient.counts.values())
+        return patient
+
+    def getState(self):
+        """
+        Returns the state of this patient as a dictionary that fromState()
+        and snapshotPatient() accept: the genotype table with the count of
+        every genotype, maxPop, the prescriptions and the state of the
+        generator.
+        """
+        genotypes = list(self.counts.keys())
+        state = encodeGenotypes(genotypes)
+        state["class"] = type(self).__name__
+        state["maxPop"] = self.maxPop
+        state["drugs"] = list(self.drugs)
+        state["counts"] = numpy.array([self.counts[g] for g in genotypes],
+                                      dtype=numpy.int64)
+        state["rng"] = self.rng.bit_generator.state
+        state["antithetic"] = isinstance(self.rng, AntitheticGenerator)
+        return state
+
+    @classmethod
+    def fromState(cls, state, restoreRandom=True):
+        """
+        Creates a patient from a dictionary returned by getState().
+
+        restoreRandom: whether to restore the state of the generator, so that
+        the patient continues exactly as the saved one would have
+        """
+        rng = None
+        if restoreRandom:
+            rng = _restoreGenerator(state["rng"],
+                                    state.get("antithetic", False))
+        genotypes = decodeGenotypes(state)
+        counts = dict(zip(genotypes, state["counts"].tolist()))
+        patient = cls.fromCounts(counts, state["maxPop"], rng)
+        for drug in state.get("drugs", ()):
+            patient.drugs.append(drug)
+        return patient
+
+    def getCounts(self):
+        """
+        Returns the dictionary mapping genotypes to particle counts.
+        """
+        return self.counts
+
+    def getViruses(self):
+        """
+        Returns the viruses in this Patient, as a new list of SimpleVirus
+        instances (one per particle).
+        """
+        viruses = []
+        for genotype, count in self.counts.items():
+            for i in range(int(round(count))):
+                viruses.append(SimpleVirus(genotype[0], genotype[1]))
+        return viruses
+
+    def getMaxPop(self):
+        """
+        Returns the max population.
+        """
+        return self.maxPop
+
+    def getTotalPop(self):
+        """
+        Gets the size of the current total virus population.
+        returns: The total virus population (an integer)
+        """
+        return self.total
+
+    def setCounters(self, counters):
+        """
+        Enables the instrumentation of update() (see Patient.setCounters()).
+
+        counters: an UpdateCounters instance, or None
+        """
+        self.counters = counters
+
+    def getCounters(self):
+        """
+        Returns the UpdateCounters instrumenting update(), or None.
+        """
+        return self.counters
+
+    def _activeMask(self):
+        """
+        Returns the bitmask of the drugs acting on the virus population.
+        """
+        return 0
+
+    def _mutate(self, count, genotype, newCounts, mutations=None):
+        """
+        Distributes count offspring of a genotype over the genotypes reachable
+        by mutation and adds them to newCounts. Each resistance trait flips
+        independently with probability mutProb; the offspring are split with
+        one binomial draw per trait and per distinct partial outcome, so the
+        cost is bounded by both 2**traits and count.
+
+        mutations: if given, a dictionary mapping drug names to mutation
+        counts, which is updated with the mutations drawn
+        """
+        birthProb, clearProb, mutProb, traits, resist = genotype
+        groups = [(count, resist)]
+        if mutProb > 0:
+            for position in drugRegistry.getBits(traits):
+                bit = 1 << position
+                split = []
+                for c, r in groups:
+                    flipped = int(self.rng.binomial(c, mutProb))
+                    if c - flipped:
+                        split.append((c - flipped, r))
+                    if flipped:
+                        split.append((flipped, r ^ bit))
+                        if mutations is not None:
+                            drug = drugRegistry.names[position]
+                            mutations[drug] = mutations.get(drug, 0) + flipped
+                groups = split
+        for c, r in groups:
+            child = (birthProb, clearProb, mutProb, traits, r)
+            newCounts[child] = newCounts.get(child, 0) + c
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, in the same order as Patient.update():
+
+        - Draw the survivors of every genotype from a binomial distribution.
+
+        - Compute the population density.
+
+        - Draw the offspring of every genotype that is resistant to all
+          active drugs from a binomial distribution with probability
+          maxBirthProb * (1 - popDensity), and distribute them over mutant
+          genotypes.
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        counters = self.counters
+        mutations = None
+        if counters is not None:
+            record = counters.newRecord()
+            mutations = record["mutations"]
+            clock = time.perf_counter
+            start = clock()
+        survivors = {}
+        total = 0
+        for genotype, count in self.counts.items():
+            kept = int(self.rng.binomial(count, 1 - genotype[1]))
+            if kept:
+                survivors[genotype] = kept
+                total += kept
+        if counters is not None:
+            cleared = clock()
+        popDen = (1.0 * total) / self.getMaxPop()
+        if counters is not None:
+            density = clock()
+
+        mask = self._activeMask()
+        newCounts = dict(survivors)
+        survived = total
+        blocked = 0
+        mutating = 0.0
+        for genotype, count in survivors.items():
+            if genotype[4] & mask != mask:
+                blocked += count
+                continue
+            prob = genotype[0] * (1 - popDen)
+            if prob <= 0:
+                continue
+            born = int(self.rng.binomial(count, min(prob, 1.0)))
+            if born:
+                total += born
+                if counters is None:
+                    self._mutate(born, genotype, newCounts)
+                else:
+                    mutationStart = clock()
+                    self._mutate(born, genotype, newCounts, mutations)
+                    mutating += clock() - mutationStart
+        if counters is not None:
+            record["clearances"] = self.total - survived
+            record["births"] = total - survived
+            record["blocked"] = blocked
+            record["population"] = total
+            record["clearance"] = cleared - start
+            record["density"] = density - cleared
+            record["mutation"] = mutating
+            record["reproduction"] = clock() - density - mutating
+            counters.addRecord(self, record)
+        self.counts = newCounts
+        self.total = total
+        return self.total
+
+
+class GenotypeTreatedPatient(GenotypePatient):
+    """
+    Representation of a patient that takes drugs, with the virus population
+    kept as counts per genotype. Behaves like TreatedPatient.
+    """
+    def getViruses(self):
+        """
+        Returns the viruses in this Patient, as a new list of ResistantVirus
+        instances (one per particle).
+        """
+        viruses = []
+        for genotype, count in self.counts.items():
+            birthProb, clearProb, mutProb, traits, resist = genotype
+            for i in range(int(round(count))):
+                viruses.append(ResistantVirus(
+                    birthProb, clearProb,
+                    drugRegistry.toDict(traits, resist), mutProb))
+        return viruses
+
+    def addPrescription(self, newDrug):
+        """
+        Administer a drug to this patient. If the newDrug is already
+        prescribed to this patient, the method has no effect.
+
+        newDrug: The name of the drug to administer to the patient (a string).
+        """
+        if newDrug not in self.drugs:
+            self.drugs.append(newDrug)
+
+    def removePrescription(self, drug):
+        """
+        Stop administering a drug to this patient. If the drug is not
+        prescribed to this patient, the method has no effect.
+
+        drug: The name of the drug to stop (a string).
+        """
+        if drug in self.drugs:
+            self.drugs.remove(drug)
+
+    def getPrescriptions(self):
+        """
+        Returns the drugs that are being administered to this patient.
+
+        returns: The list of drug names (strings) being administered to this
+        patient.
+        """
+        return self.drugs
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist.
+
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'srinol'])
+
+        returns: The population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        mask = drugRegistry.getMask(drugResist)
+        return sum(c for g, c in self.counts.items() if g[4] & mask == mask)
+
+    def _activeMask(self):
+        """
+        Returns the bitmask of the drugs being administered.
+        """
+        return drugRegistry.getMask(self.drugs)
+
+
+#
+# HYBRID ENGINE
+#
+class HybridPatient(GenotypePatient):
+    """
+    Approximate version of GenotypePatient for very large values of maxPop.
+    Genotypes with at least threshold particles are updated with their
+    expected (mean-field) clearance and births, and hold fractional counts.
+    Rarer genotypes stay stochastic and integer, as in GenotypePatient, so
+    that the emergence and extinction of rare resistant genotypes are
+    modelled exactly. Mutants flowing from an abundant genotype into a rare
+    one arrive as a Poisson draw with the expected number of mutants (a
+    tau-leap over one time step). An abundant genotype that falls below the
+    threshold is rounded stochastically back to an integer count.
+
+    The offspring of the abundant genotypes of a strain are pooled before
+    they are split over mutants, so the cost of a step grows with the number
+    of genotypes rather than its square. This only pays off when many
+    genotypes are abundant: with 8 to 10 drugs, a mutProb of 0.02 and a
+    maxPop of 1e7, a threshold of 1000 is 3 to 4 times faster than
+    GenotypePatient. With few drugs GenotypePatient, whose cost does not
+    grow with the population, is as fast.
+
+    threshold trades accuracy for speed: with an infinite threshold this is
+    exactly GenotypePatient, and the lower the threshold the fewer random
+    draws are made. Thresholds from MIN_THRESHOLD up gave mean populations
+    within noise of the exact model in validateApproximation(); smaller
+    ones biased them by 3 standard errors and are rejected.
+    """
+    MIN_THRESHOLD = 500
+
+    def __init__(self, viruses, maxPop, rng=None, threshold=10000,
+                 minFlow=1e-9):
+        """
+        Initialization function, see GenotypePatient.__init__().
+
+        threshold: the count from which a genotype is updated by its mean
+                   (a number, at least MIN_THRESHOLD)
+        minFlow: expected mutant flows smaller than this are dropped (a
+                 float)
+        """
+        if threshold < self.MIN_THRESHOLD:
+            raise ValueError("threshold must be at least %d, smaller "
+                             "thresholds bias the results"
+                             % self.MIN_THRESHOLD)
+        GenotypePatient.__init__(self, viruses, maxPop, rng)
+        self.threshold = threshold
+        self.minFlow = minFlow
+
+    def getTotalPop(self):
+        """
+        Gets the size of the current total virus population, rounded to an
+        integer.
+        """
+        return int(round(self.total))
+
+    def getState(self):
+        """
+        Returns the state of this patient, see GenotypePatient.getState().
+        The counts are stored as floats, with the threshold and minFlow.
+        """
+        state = GenotypePatient.getState(self)
+        state["counts"] = numpy.array(
+            [self.counts[g] for g in self.counts], dtype=float)
+        state["threshold"] = self.threshold
+        state["minFlow"] = self.minFlow
+        return state
+
+    @classmethod
+    def fromState(cls, state, restoreRandom=True):
+        """
+        Creates a patient from a dictionary returned by getState().
+        """
+        patient = GenotypePatient.fromState.__func__(cls, state, restoreRandom)
+        patient.threshold = state["threshold"]
+        patient.minFlow = state["minFlow"]
+        return patient
+
+    def _flow(self, strain, births, abundant, newCounts, mutations=None):
+        """
+        Adds the expected offspring of the abundant genotypes of one strain
+        to newCounts, distributed over mutants like GenotypePatient._mutate()
+        but with expected values. The flows are split one trait at a time, so
+        that the cost grows with the number of genotypes rather than its
+        square. Flows into genotypes that are not abundant are replaced by
+        Poisson draws.
+
+        strain: the genotype without its resistances, (maxBirthProb,
+                clearProb, mutProb, traits)
+        births: a dictionary mapping resistances (an integer bitmask) to the
+                expected number of offspring born with them (a float)
+        abundant: the abundant genotypes (a set)
+        mutations: if given, a dictionary mapping drug names to mutation
+        counts, which is updated with the expected mutations
+        """
+        birthProb, clearProb, mutProb, traits = strain
+        if mutProb > 0:
+            for position in drugRegistry.getBits(traits):
+                bit = 1 << position
+                split = {}
+                flipped = 0.0
+                for r, c in births.items():
+                    if c * (1 - mutProb) >= self.minFlow:
+                        split[r] = split.get(r, 0) + c * (1 - mutProb)
+                    if c * mutProb >= self.minFlow:
+                        split[r ^ bit] = split.get(r ^ bit, 0) + c * mutProb
+                        flipped += c * mutProb
+                births = split
+                if mutations is not None and flipped:
+                    drug = drugRegistry.names[position]
+                    mutations[drug] = mutations.get(drug, 0) + flipped
+        for r, c in births.items():
+            child = strain + (r,)
+            if child in abundant or newCounts.get(child, 0) >= self.threshold:
+                newCounts[child] = newCounts.get(child, 0) + c
+            else:
+                arrivals = int(self.rng.poisson(c))
+                if arrivals:
+                    newCounts[child] = newCounts.get(child, 0) + arrivals
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, in the same order as GenotypePatient.update(), using the
+        expected clearance and births for every genotype with at least
+        threshold particles.
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        counters = self.counters
+        if counters is not None:
+            record = counters.newRecord()
+            clock = time.perf_counter
+            start = clock()
+        threshold = self.threshold
+        abundant = set()
+        survivors = {}
+        total = 0
+        for genotype, count in self.counts.items():
+            if count >= threshold:
+                abundant.add(genotype)
+                kept = count * (1 - genotype[1])
+            else:
+                kept = int(self.rng.binomial(count, 1 - genotype[1]))
+            if kept > 0:
+                survivors[genotype] = kept
+                total += kept
+        if counters is not None:
+            cleared = clock()
+        popDen = (1.0 * total) / self.getMaxPop()
+        if counters is not None:
+            density = clock()
+
+        mask = self._activeMask()
+        newCounts = dict(survivors)
+        survived = total
+        blocked = 0
+        flows = {}
+        mutations = None
+        if counters is not None:
+            # expected mutations of the flows are fractional, rounded below
+            mutations = {}
+            mutating = 0.0
+        for genotype, count in survivors.items():
+            if genotype[4] & mask != mask:
+                blocked += count
+                continue
+            prob = genotype[0] * (1 - popDen)
+            if prob <= 0:
+                continue
+            if genotype in abundant:
+                born = count * min(prob, 1.0)
+                births = flows.setdefault(genotype[:4], {})
+                births[genotype[4]] = births.get(genotype[4], 0) + born
+            else:
+                born = int(self.rng.binomial(count, min(prob, 1.0)))
+                if born:
+                    if counters is None:
+                        self._mutate(born, genotype, newCounts)
+                    else:
+                        mutationStart = clock()
+                        self._mutate(born, genotype, newCounts, mutations)
+                        mutating += clock() - mutationStart
+            total += born
+        for strain in flows:
+            if counters is None:
+                self._flow(strain, flows[strain], abundant, newCounts)
+            else:
+                mutationStart = clock()
+                self._flow(strain, flows[strain], abundant, newCounts,
+                           mutations)
+                mutating += clock() - mutationStart
+
+        for genotype in list(newCounts):
+            count = newCounts[genotype]
+            if count < threshold and count != int(count):
+                whole = int(count)
+                count = whole + int(self.rng.random() < count - whole)
+                if count:
+                    newCounts[genotype] = count
+                else:
+                    del newCounts[genotype]
+        if counters is not None:
+            record["clearances"] = int(round(self.total - survived))
+            record["births"] = int(round(total - survived))
+            record["blocked"] = int(round(blocked))
+            record["population"] = int(round(total))
+            for drug, count in mutations.items():
+                if int(round(count)):
+                    record["mutations"][drug] = int(round(count))
+            record["clearance"] = cleared - start
+            record["density"] = density - cleared
+            record["mutation"] = mutating
+            record["reproduction"] = clock() - density - mutating
+            counters.addRecord(self, record)
+        self.counts = newCounts
+        self.total = sum(newCounts.values())
+        return self.getTotalPop()
+
+
+class HybridTreatedPatient(HybridPatient, GenotypeTreatedPatient):
+    """
+    Representation of a patient that takes drugs, with the virus population
+    updated by the hybrid stochastic / mean-field method of HybridPatient.
+    Behaves like TreatedPatient.
+    """
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist, rounded to an integer. See TreatedPatient.getResistPop().
+        """
+        return int(round(GenotypeTreatedPatient.getResistPop(self,
+                                                             drugResist)))
+
+
+#
+# INSTRUMENTATION
+#
+class UpdateCounters(object):
+    """
+    Counters filled by the update() method of a patient whose instrumentation
+    is enabled with setCounters(). Every update() produces a record, a
+    dictionary with:
+
+    - "clearance", "density", "reproduction", "mutation": the wall time (in
+      seconds) spent in each phase of the update. Mutation time is not
+      included in the reproduction time; for TreatedPatient it is the time
+      of the tryReproduce() calls that produced offspring.
+
+    - "clearances", "births": the number of particles cleared and born.
+
+    - "blocked": the number of particles that could not reproduce because
+      they are not resistant to all the active drugs.
+
+    - "mutations": a dictionary mapping drug names to the number of
+      offspring whose resistance to that drug switched (for the mean-field
+      flows of HybridPatient, the expected number, rounded).
+
+    - "population": the total population at the end of the update.
+
+    The records are added up over all updates, and passed to an optional
+    observer as they are produced.
+    """
+    PHASES = ("clearance", "density", "reproduction", "mutation")
+    COUNTS = ("clearances", "births", "blocked")
+
+    def __init__(self, observer=None):
+        """
+        observer: a function called as observer(patient, record) after every
+        instrumented update, or None
+        """
+        self.observer = observer
+        self.steps = 0
+        self.totals = self.newRecord()
+
+    def newRecord(self):
+        """
+        Returns an empty record.
+        """
+        record = dict((phase, 0.0) for phase in self.PHASES)
+        for count in self.COUNTS:
+            record[count] = 0
+        record["mutations"] = {}
+        record["population"] = 0
+        return record
+
+    def addRecord(self, patient, record):
+        """
+        Adds the record of one update of patient to the totals and passes it
+        to the observer.
+        """
+        self.steps += 1
+        totals = self.totals
+        for key in self.PHASES + self.COUNTS:
+            totals[key] += record[key]
+        for drug, count in record["mutations"].items():
+            totals["mutations"][drug] = totals["mutations"].get(drug, 0) + count
+        totals["population"] = record["population"]
+        if self.observer is not None:
+            self.observer(patient, record)
+
+    def getSteps(self):
+        """
+        Returns the number of instrumented updates.
+        """
+        return self.steps
+
+    def getTotals(self):
+        """
+        Returns the record holding the sums of all records ("population" is
+        the population after the last update).
+        """
+        return self.totals
+
+    def summary(self):
+        """
+        Returns a report of the counters (a multi-line string).
+        """
+        totals = self.totals
+        elapsed = sum(totals[phase] for phase in self.PHASES)
+        lines = ["%d updates, %.6f s" % (self.steps, elapsed)]
+        for phase in self.PHASES:
+            share = 100.0 * totals[phase] / elapsed if elapsed else 0.0
+            lines.append("  %-14s %12.6f s %6.1f%%" % (phase, totals[phase],
+                                                      share))
+        for count in self.COUNTS:
+            lines.append("  %-14s %12d" % (count, totals[count]))
+        for drug in sorted(totals["mutations"]):
+            lines.append("  mutations of %s: %d" % (drug,
+                                                   totals["mutations"][drug]))
+        return "\n".join(lines)
+
+
+#
+# TREATMENT SCHEDULES
+#
+class TreatmentSchedule(object):
+    """
+    A treatment regimen: which drugs are administered at every time step.
+    Drugs are started and stopped at given steps, or given in pulses, and
+    later changes override earlier ones. compile() turns the schedule into
+    one drug bitmask (see DrugRegistry) per time step, so a trial only
+    compares two integers per step to find out whether the prescriptions
+    change, and the patients check resistance against the bitmask.
+
+    The changes are kept as a list of JSON-compatible lists, see toList().
+    """
+    def __init__(self, changes=()):
+        """
+        changes: a list of changes as returned by toList()
+        """
+        self.changes = []
+        for change in changes:
+            if change[0] == "start":
+                self.startDrug(change[1], change[2])
+            elif change[0] == "stop":
+                self.stopDrug(change[1], change[2])
+            elif change[0] == "pulse":
+                self.addPulses(*change[1:])
+            else:
+                raise ValueError("unknown treatment change: %s" % change[0])
+
+    def startDrug(self, drug, step):
+        """
+        Administers drug from time step step on (the drug is added before
+        the update of that step).
+        """
+        if step < 0:
+            raise ValueError("treatment changes need step >= 0")
+        self.changes.append(["start", drug, int(step)])
+
+    def stopDrug(self, drug, step):
+        """
+        Stops administering drug from time step step on.
+        """
+        if step < 0:
+            raise ValueError("treatment changes need step >= 0")
+        self.changes.append(["stop", drug, int(step)])
+
+    def addPulses(self, drug, start, onSteps, offSteps, stop=None):
+        """
+        Administers drug in pulses from time step start on: onSteps steps
+        with the drug, then offSteps steps without it, repeated until the
+        step stop (or the end of the trial if stop is None), from which the
+        drug is not administered.
+        """
+        if start < 0:
+            raise ValueError("treatment changes need step >= 0")
+        if onSteps < 1 or offSteps < 0:
+            raise ValueError("pulses need onSteps >= 1 and offSteps >= 0")
+        if stop is not None and stop < start:
+            raise ValueError("pulses cannot stop before they start")
+        self.changes.append(["pulse", drug, int(start), int(onSteps),
+                             int(offSteps), None if stop is None else int(stop)])
+
+    def getDrugs(self):
+        """
+        Returns the drugs the schedule administers (a list of strings).
+        """
+        drugs = []
+        for change in self.changes:
+            if change[1] not in drugs:
+                drugs.append(change[1])
+        return drugs
+
+    def getLastStep(self):
+        """
+        Returns the last time step at which a change starts, or -1 if the
+        schedule has no changes.
+        """
+        return max([change[2] for change in self.changes] + [-1])
+
+    def compile(self, numSteps):
+        """
+        Returns the bitmasks of the drugs administered at time steps 0 to
+        numSteps - 1 (a list of integers, see DrugRegistry.getMask()).
+        Raises ValueError if a change starts at step numSteps or later, as
+        it would never take effect.
+        """
+        if self.getLastStep() >= numSteps:
+            raise ValueError("a treatment change at step %d is past the %d "
+                             "steps of the trial"
+                             % (self.getLastStep(), numSteps))
+        active = {}
+        for change in self.changes:
+            drug = change[1]
+            if drug not in active:
+                active[drug] = numpy.zeros(numSteps, dtype=bool)
+            steps = active[drug]
+            if change[0] == "start":
+                steps[change[2]:] = True
+            elif change[0] == "stop":
+                steps[change[2]:] = False
+            else:
+                start, onSteps, offSteps, stop = change[2:]
+                stop = numSteps if stop is None else min(stop, numSteps)
+                period = onSteps + offSteps
+                pulse = (numpy.arange(max(stop - start, 0)) % period) < onSteps
+                steps[start:stop] = pulse
+                steps[stop:] = False
+        masks = [0] * numSteps
+        for drug in active:
+            bit = drugRegistry.getMask([drug])
+            for a in numpy.flatnonzero(active[drug]).tolist():
+                masks[a] |= bit
+        return masks
+
+    def getActiveDrugs(self, step):
+        """
+        Returns the drugs administered at a time step (a list of strings).
+        """
+        numSteps = max(step, self.getLastStep()) + 1
+        return drugRegistry.getNames(self.compile(numSteps)[step])
+
+    def toList(self):
+        """
+        Returns the changes of the schedule, in order, as JSON-compatible
+        lists: ["start", drug, step], ["stop", drug, step] or ["pulse", drug,
+        start, onSteps, offSteps, stop].
+        """
+        return [list(change) for change in self.changes]
+
+
+#
+# TRIAL RUNNER
+#
+PATIENT_CLASSES = dict((cls.__name__, cls) for cls in (
+    Patient, TreatedPatient, ArrayPatient, ArrayTreatedPatient,
+    GenotypePatient, GenotypeTreatedPatient, HybridPatient,
+    HybridTreatedPatient, JitPatient, JitTreatedPatient))
+
+
+class Scenario(object):
+    """
+    Description of one simulated treatment scenario: the initial virus
+    population, the patient, the drugs administered and what is recorded.
+    Every trial of a scenario starts from the same state.
+    """
+    def __init__(self, numViruses, maxPop, maxBirthProb, clearProb,
+                 resistances=None, mutProb=0.0, numSteps=300,
+                 prescriptions=(), resistDrugs=None, patientClass=None,
+                 cureThreshold=50, patientOptions=None, schedule=()):
+        """
+        numViruses: number of viruses to create for patient (an integer)
+        maxPop: maximum virus population for patient (an integer)
+        maxBirthProb: Maximum reproduction probability (a float between 0-1)
+        clearProb: maximum clearance probability (a float between 0-1)
+        resistances: a dictionary of drugs that each ResistantVirus is
+                     resistant to, or None to simulate SimpleVirus instances
+        mutProb: mutation probability for each ResistantVirus particle
+        numSteps: number of time steps per trial (an integer)
+        prescriptions: a list of (step, drug) pairs; the drug is added before
+                       the update of that time step
+        resistDrugs: the drugs whose resistant population is recorded at
+                     every time step (a list of strings), or None
+        patientClass: the patient implementation to simulate. If None,
+                      Patient or TreatedPatient is used.
+        cureThreshold: a trial counts as cured if the final total population
+                       is at most this value (an integer)
+        patientOptions: extra keyword arguments for the patient class, e.g.
+                        {"threshold": 1000} for HybridPatient (a dictionary)
+        schedule: further treatment changes applied after prescriptions, a
+                  TreatmentSchedule or a list as returned by
+                  TreatmentSchedule.toList()
+        """
+        self.numViruses = numViruses
+        self.maxPop = maxPop
+        self.maxBirthProb = maxBirthProb
+        self.clearProb = clearProb
+        self.resistances = resistances
+        self.mutProb = mutProb
+        self.numSteps = numSteps
+        self.prescriptions = [(int(step), drug) for step, drug in prescriptions]
+        self.resistDrugs = resistDrugs
+        if patientClass is None:
+            if resistances is None:
+                patientClass = Patient
+            else:
+                patientClass = TreatedPatient
+        self.patientClass = patientClass
+        self.cureThreshold = cureThreshold
+        self.patientOptions = dict(patientOptions or {})
+        if isinstance(schedule, TreatmentSchedule):
+            schedule = schedule.toList()
+        self.schedule = TreatmentSchedule(schedule).toList()
+
+    def toDict(self):
+        """
+        Returns the scenario as a dictionary of JSON-compatible values. The
+        patient class is stored by name.
+        """
+        return {"numViruses": self.numViruses, "maxPop": self.maxPop,
+                "maxBirthProb": self.maxBirthProb, "clearProb": self.clearProb,
+                "resistances": self.resistances, "mutProb": self.mutProb,
+                "numSteps": self.numSteps,
+                "prescriptions": [[step, drug]
+                                  for step, drug in self.prescriptions],
+                "resistDrugs": self.resistDrugs,
+                "patientClass": self.patientClass.__name__,
+                "cureThreshold": self.cureThreshold,
+                "patientOptions": self.patientOptions,
+                "schedule": self.schedule}
+
+    @classmethod
+    def fromDict(cls, values):
+        """
+        Creates a scenario from a dictionary as returned by toDict(). Only
+        numViruses, maxPop, maxBirthProb and clearProb are required.
+        """
+        values = dict(values)
+        name = values.pop("patientClass", None)
+        if name is not None:
+            if name not in PATIENT_CLASSES:
+                raise ValueError("unknown patient class: %s" % name)
+            values["patientClass"] = PATIENT_CLASSES[name]
+        return cls(**values)
+
+    def makePatient(self, rng=None):
+        """
+        Returns a new patient carrying the initial virus population.
+
+        rng: the RandomStream the patient draws from, or None for the
+        default of the patient class (a stream or generator seeded from the
+        random module). Trials pass a stream seeded from the trial seed.
+        """
+        if self.resistances is None:
+            viruses = [SimpleVirus(self.maxBirthProb, self.clearProb)
+                       for v in range(self.numViruses)]
+        else:
+            virus = ResistantVirus(self.maxBirthProb, self.clearProb,
+                                   self.resistances, self.mutProb)
+            viruses = [virus] * self.numViruses
+        options = self.patientOptions
+        if rng is not None:
+            options = dict(options, rng=rng)
+        return self.patientClass(viruses, self.maxPop, **options)
+
+    def getSchedule(self):
+        """
+        Returns the TreatmentSchedule of the scenario: its prescriptions,
+        then the changes of its schedule.
+        """
+        schedule = TreatmentSchedule()
+        for step, drug in self.prescriptions:
+            schedule.startDrug(drug, step)
+        schedule.changes.extend(TreatmentSchedule(self.schedule).changes)
+        return schedule
+
+    def getMasks(self):
+        """
+        Returns the compiled schedule, the bitmask of the drugs administered
+        at every time step (see TreatmentSchedule.compile()).
+        """
+        return self.getSchedule().compile(self.numSteps)
+
+    def makeSummary(self):
+        """
+        Returns an empty TrialSummary for trials of this scenario.
+        """
+        # after clearance the population only grows while it is below maxPop,
+        # and at most doubles in a time step
+        maxValue = max(2 * self.maxPop, self.numViruses)
+        return TrialSummary(self.numSteps, self.resistDrugs is not None,
+                            maxValue)
+
+    def getSeriesNames(self):
+        """
+        Returns the names of the series recorded for every trial into a
+        TrajectoryStore (a list of strings): "total", "resist" if resistDrugs
+        is set, and "resist:<drug>" for the population resistant to each drug
+        in resistances.
+        """
+        names = ["total"]
+        if self.resistDrugs is not None:
+            names.append("resist")
+        for drug in self.resistances or ():
+            names.append("resist:" + drug)
+        return names
+
+
+class StepStatistics(object):
+    """
+    Online statistics of one population series, kept separately for every
+    time step: mean and variance, minimum, maximum and a quantile sketch.
+    Memory use depends on the number of time steps, not on the number of
+    trials added, and two StepStatistics can be merged.
+
+    The populations are integers, and the mean and variance are computed
+    from their exact sums and sums of squares, so the statistics do not
+    depend on how the trials were split into merged parts.
+
+    The quantile sketch stores counts in logarithmically spaced buckets, so
+    every reported quantile is within a relative error of accuracy of a
+    value in the data.
+    """
+    def __init__(self, numSteps, maxValue, accuracy=0.01):
+        """
+        numSteps: number of time steps per trial (an integer)
+        maxValue: the largest population the series can reach (an integer);
+                  larger values fall in the last bucket
+        accuracy: relative accuracy of the quantile sketch (a float)
+        """
+        self.numSteps = numSteps
+        self.count = 0
+        self.sum = numpy.zeros(numSteps, dtype=numpy.int64)
+        # Python integers, which do not overflow
+        self.sumSquares = numpy.zeros(numSteps, dtype=object)
+        self.min = numpy.full(numSteps, numpy.inf)
+        self.max = numpy.full(numSteps, -numpy.inf)
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        numBuckets = int(numpy.ceil(numpy.log(max(maxValue, 2)) /
+                                    numpy.log(self.gamma))) + 2
+        self.buckets = numpy.zeros((numSteps, numBuckets), dtype=numpy.int64)
+
+    def _bucketIndex(self, values):
+        """
+        Returns the sketch bucket of every value. Bucket 0 holds zero and
+        bucket i > 0 holds values in (gamma**(i - 2), gamma**(i - 1)], so a
+        population of 1 is in bucket 1. Values beyond the last bucket fall
+        in it.
+        """
+        values = numpy.asarray(values, dtype=float)
+        index = numpy.zeros(len(values), dtype=numpy.int64)
+        positive = values > 0
+        index[positive] = numpy.ceil(numpy.log(values[positive]) /
+                                     numpy.log(self.gamma)).astype(numpy.int64) + 1
+        return numpy.clip(index, 0, self.buckets.shape[1] - 1)
+
+    def add(self, values):
+        """
+        Adds the trajectory of one trial.
+
+        values: the population at every time step (an array of integers)
+        """
+        values = numpy.asarray(values)
+        integers = values.astype(numpy.int64)
+        if (integers != values).any():
+            raise ValueError("populations must be integers")
+        self.count += 1
+        self.sum += integers
+        integers = integers.astype(object)
+        self.sumSquares += integers * integers
+        values = integers.astype(float)
+        numpy.minimum(self.min, values, out=self.min)
+        numpy.maximum(self.max, values, out=self.max)
+        self.buckets[numpy.arange(self.numSteps), self._bucketIndex(values)] += 1
+
+    def merge(self, other):
+        """
+        Adds the trials of another StepStatistics to this one.
+        """
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.sumSquares += other.sumSquares
+        numpy.minimum(self.min, other.min, out=self.min)
+        numpy.maximum(self.max, other.max, out=self.max)
+        self.buckets += other.buckets
+
+    def getCount(self):
+        """
+        Returns the number of trials added.
+        """
+        return self.count
+
+    def getMean(self):
+        """
+        Returns the mean at every time step (an array).
+        """
+        if self.count == 0:
+            return numpy.zeros(self.numSteps)
+        return self.sum / self.count
+
+    def getVariance(self):
+        """
+        Returns the sample variance at every time step (an array).
+        """
+        if self.count < 2:
+            return numpy.zeros(self.numSteps)
+        n = self.count
+        sums = self.sum.astype(object)
+        # exact integers until the final, correctly rounded division
+        return ((n * self.sumSquares - sums * sums) /
+                (n * (n - 1))).astype(float)
+
+    def getStd(self):
+        """
+        Returns the sample standard deviation at every time step (an array).
+        """
+        return numpy.sqrt(self.getVariance())
+
+    def getMin(self):
+        """
+        Returns the minimum at every time step (an array).
+        """
+        return self.min.copy()
+
+    def getMax(self):
+        """
+        Returns the maximum at every time step (an array).
+        """
+        return self.max.copy()
+
+    def getQuantile(self, q):
+        """
+        Returns the estimated q-quantile at every time step (an array).
+
+        q: the quantile (a float between 0-1), e.g. 0.5 for the median
+        """
+        if self.count == 0:
+            return numpy.full(self.numSteps, numpy.nan)
+        rank = q * (self.count - 1)
+        cumulative = numpy.cumsum(self.buckets, axis=1)
+        index = (cumulative <= rank).sum(axis=1)
+        values = 2 * self.gamma ** index / (self.gamma + 1) / self.gamma
+        values[index == 0] = 0
+        return numpy.clip(values, self.min, self.max)
+
+    def __getstate__(self):
+        # most buckets are empty: pickle the others only
+        state = dict(self.__dict__)
+        buckets = state.pop("buckets")
+        index = numpy.flatnonzero(buckets)
+        state["bucketShape"] = buckets.shape
+        state["bucketIndex"] = index
+        state["bucketCounts"] = buckets.ravel()[index]
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        buckets = numpy.zeros(state.pop("bucketShape"), dtype=numpy.int64)
+        buckets.ravel()[state.pop("bucketIndex")] = state.pop("bucketCounts")
+        state["buckets"] = buckets
+        self.__dict__.update(state)
+
+
+class TrialSummary(object):
+    """
+    Per-time-step totals and statistics accumulated over a number of trials.
+    Summaries of disjoint sets of trials can be merged, which is how results
+    of parallel runs are combined.
+    """
+    def __init__(self, numSteps, recordResist=False, maxValue=None):
+        """
+        numSteps: number of time steps per trial (an integer)
+        recordResist: whether a resistant population series is recorded
+        maxValue: the largest population a trial can reach (an integer), used
+                  to size the quantile sketches
+        """
+        if maxValue is None:
+            maxValue = 2 ** 32
+        self.numSteps = numSteps
+        self.numTrials = 0
+        self.cured = 0
+        self.totals = numpy.zeros(numSteps, dtype=numpy.int64)
+        self.totalStats = StepStatistics(numSteps, maxValue)
+        self.resists = None
+        self.resistStats = None
+        if recordResist:
+            self.resists = numpy.zeros(numSteps, dtype=numpy.int64)
+            self.resistStats = StepStatistics(numSteps, maxValue)
+
+    def addTrial(self, totals, resists=None, cured=False):
+        """
+        Adds the trajectory of one trial.
+
+        totals: the total population at every time step (an array)
+        resists: the resistant population at every time step (an array), if
+                 recorded
+        cured: whether the trial ended cured (a boolean)
+        """
+        self.numTrials += 1
+        self.totals += totals
+        self.totalStats.add(totals)
+        if self.resists is not None:
+            self.resists += resists
+            self.resistStats.add(resists)
+        if cured:
+            self.cured += 1
+
+    def merge(self, other):
+        """
+        Adds the trials of another TrialSummary to this one.
+        """
+        self.numTrials += other.numTrials
+        self.cured += other.cured
+        self.totals += other.totals
+        self.totalStats.merge(other.totalStats)
+        if self.resists is not None:
+            self.resists += other.resists
+            self.resistStats.merge(other.resistStats)
+
+    def getNumTrials(self):
+        """
+        Returns the number of trials in this summary.
+        """
+        return self.numTrials
+
+    def getCured(self):
+        """
+        Returns the number of cured trials.
+        """
+        return self.cured
+
+    def getMeanTotals(self):
+        """
+        Returns the mean total population at every time step (an array).
+        """
+        return self.totals / float(max(self.numTrials, 1))
+
+    def getMeanResists(self):
+        """
+        Returns the mean resistant population at every time step (an array),
+        or None if it was not recorded.
+        """
+        if self.resists is None:
+            return None
+        return self.resists / float(max(self.numTrials, 1))
+
+    def getArrays(self, quantiles=(0.05, 0.5, 0.95)):
+        """
+        Returns the results as a dictionary of NumPy arrays: the mean,
+        standard deviation, minimum, maximum and quantiles of every recorded
+        series at every time step, plus the number of trials and cured trials.
+
+        quantiles: the quantiles to include (a sequence of floats)
+        """
+        arrays = {"numTrials": numpy.array(self.numTrials),
+                  "cured": numpy.array(self.cured)}
+        series = [("total", self.totalStats)]
+        if self.resistStats is not None:
+            series.append(("resist", self.resistStats))
+        for name, stats in series:
+            arrays[name + "Mean"] = stats.getMean()
+            arrays[name + "Std"] = stats.getStd()
+            arrays[name + "Min"] = stats.getMin()
+            arrays[name + "Max"] = stats.getMax()
+            for q in quantiles:
+                arrays["%sQ%g" % (name, 100 * q)] = stats.getQuantile(q)
+        return arrays
+
+    def getCureInterval(self, confidence=0.95):
+        """
+        Returns the Wilson score interval (low, high) of the cure fraction at
+        the given confidence level (a float between 0-1).
+        """
+        n = self.numTrials
+        if n == 0:
+            return 0.0, 1.0
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        p = 1.0 * self.cured / n
+        center = (p + z * z / (2 * n)) / (1 + z * z / n)
+        half = (z / (1 + z * z / n)) * (p * (1 - p) / n + z * z / (4 * n * n)) ** 0.5
+        return max(0.0, center - half), min(1.0, center + half)
+
+    def getMeanInterval(self, confidence=0.95, series="total"):
+        """
+        Returns the normal confidence interval (low, high) of the mean
+        population at every time step (two arrays).
+
+        series: "total" or "resist"
+        """
+        stats = self.totalStats if series == "total" else self.resistStats
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        half = z * stats.getStd() / max(self.numTrials, 1) ** 0.5
+        return stats.getMean() - half, stats.getMean() + half
+
+    def getTotalStatistics(self):
+        """
+        Returns the StepStatistics of the total population.
+        """
+        return self.totalStats
+
+    def getResistStatistics(self):
+        """
+        Returns the StepStatistics of the resistant population, or None if it
+        was not recorded.
+        """
+        return self.resistStats
+
+
+def trialSeed(seed, trial):
+    """
+    Returns the seed (an integer) of one trial. It only depends on the run's
+    seed and the trial's index, so a trial draws the same random numbers
+    whichever process runs it.
+    """
+    sequence = numpy.random.SeedSequence(seed, spawn_key=(trial,))
+    return int(sequence.generate_state(1, numpy.uint64)[0])
+
+
+def runTrial(scenario, seed, masks=None):
+    """
+    Runs one trial of a scenario, with the patient drawing from a
+    RandomStream seeded with seed, so the trial is reproducible for every
+    patient class. The random module is not used.
+
+    returns: (totals, resists) where totals and resists are arrays holding
+    the total and resistant population at every time step (resists is None
+    if the scenario does not record it).
+
+    masks: scenario.getMasks(), if it was already compiled
+    """
+    if masks is None:
+        masks = scenario.getMasks()
+    totals, resists = newTrajectory(scenario)
+    patient = scenario.makePatient(RandomStream(seed))
+    advanceTrial(patient, scenario, masks, totals, resists, 0,
+                 scenario.numSteps)
+    return totals, resists
+
+
+def newTrajectory(scenario):
+    """
+    Returns (totals, resists), the zero-filled arrays runTrial() records a
+    trial of scenario into (resists is None if it is not recorded).
+    """
+    totals = numpy.zeros(scenario.numSteps, dtype=numpy.int64)
+    resists = None
+    if scenario.resistDrugs is not None:
+        resists = numpy.zeros(scenario.numSteps, dtype=numpy.int64)
+    return totals, resists
+
+
+def advanceTrial(patient, scenario, masks, totals, resists, start, stop,
+                 drugResists=None):
+    """
+    Runs time steps start to stop - 1 of a trial, updating the prescriptions
+    before the update of every step at which the compiled schedule masks (see
+    Scenario.getMasks()) changes, and recording the populations into totals
+    and resists. The patient must have the prescriptions of masks[start - 1].
+
+    drugResists: if given, a dictionary mapping drugs to arrays the
+    population resistant to each drug is recorded into
+
+    Extinction is absorbing: once the population is 0 it stays 0, so the
+    remaining steps are left at the 0 the arrays were filled with instead of
+    being simulated.
+    """
+    active = masks[start - 1] if start > 0 else 0
+    for a in range(start, stop):
+        if masks[a] != active:
+            for drug in drugRegistry.getNames(masks[a] & ~active):
+                patient.addPrescription(drug)
+            for drug in drugRegistry.getNames(active & ~masks[a]):
+                patient.removePrescription(drug)
+            active = masks[a]
+        totals[a] = patient.update()
+        if resists is not None:
+            resists[a] = patient.getResistPop(scenario.resistDrugs)
+        if drugResists is not None:
+            for drug in drugResists:
+                drugResists[drug][a] = patient.getResistPop([drug])
+        if totals[a] == 0:
+            break
+
+
+def _runChunk(scenario, seed, start, stop):
+    """
+    Runs trials start to stop - 1 of a scenario and returns their
+    TrialSummary.
+    """
+    summary = scenario.makeSummary()
+    masks = scenario.getMasks()
+    for t in range(start, stop):
+        totals, resists = runTrial(scenario, trialSeed(seed, t), masks)
+        summary.addTrial(totals, resists,
+                         totals[-1] <= scenario.cureThreshold)
+    return summary
+
+
+def _runStoredChunk(scenario, seed, start, stop):
+    """
+    Runs trials start to stop - 1 of a scenario like _runChunk(), also
+    recording every series of scenario.getSeriesNames().
+
+    returns: (summary, block) where block is an array of shape (stop - start,
+    numSteps, number of series) holding the trajectories
+    """
+    summary = scenario.makeSummary()
+    names = scenario.getSeriesNames()
+    block = numpy.zeros((stop - start, scenario.numSteps, len(names)),
+                        dtype=numpy.int64)
+    masks = scenario.getMasks()
+    for t in range(start, stop):
+        totals, resists = newTrajectory(scenario)
+        row = block[t - start]
+        drugResists = dict((name[len("resist:"):], row[:, column])
+                           for column, name in enumerate(names)
+                           if name.startswith("resist:"))
+        patient = scenario.makePatient(RandomStream(trialSeed(seed, t)))
+        advanceTrial(patient, scenario, masks, totals, resists, 0,
+                     scenario.numSteps, drugResists)
+        row[:, 0] = totals
+        if resists is not None:
+            row[:, 1] = resists
+        summary.addTrial(totals, resists,
+                         totals[-1] <= scenario.cureThreshold)
+    return summary, block
+
+
+def _runChunks(scenario, seed, chunks, numWorkers, store=None):
+    """
+    Runs the trials of chunks (see _mapChunks()) and yields the TrialSummary
+    of every chunk in chunk order. If store (a TrajectoryStore) is given,
+    the trajectories of the trials are appended to it.
+    """
+    if store is None:
+        for summary in _mapChunks(_runChunk, (scenario, seed), chunks,
+                                  numWorkers):
+            yield summary
+        return
+
+    if (store.getSeriesNames() != scenario.getSeriesNames() or
+            store.getNumSteps() != scenario.numSteps):
+        raise ValueError("the trajectory store does not match the scenario")
+    for summary, block in _mapChunks(_runStoredChunk, (scenario, seed),
+                                     chunks, numWorkers):
+        store.append(block)
+        yield summary
+
+
+def _chunks(numTrials, chunkSize=None, numWorkers=1):
+    """
+    Splits range(numTrials) into a list of (start, stop) pairs. The default
+    chunk size gives about four chunks per worker, few enough that handing
+    out and merging the chunks stays cheap. The chunking does not change the
+    results, see StepStatistics.
+
+    numWorkers: the number of workers (an integer), or None for one per CPU
+    """
+    if chunkSize is None:
+        numWorkers = numWorkers or os.cpu_count() or 1
+        chunkSize = max(1, -(-numTrials // (4 * numWorkers)))
+    return [(start, min(start + chunkSize, numTrials))
+            for start in range(0, numTrials, chunkSize)]
+
+
+def _mapChunks(function, args, chunks, numWorkers):
+    """
+    Calls function(*args, start, stop) for every (start, stop) pair of
+    chunks, in this process or on a pool of numWorkers processes, and yields
+    the results in chunk order.
+    """
+    if numWorkers == 1:
+        for start, stop in chunks:
+            yield function(*(tuple(args) + (start, stop)))
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(numWorkers) as pool:
+        columns = [[arg] * len(chunks) for arg in args]
+        columns.append([start for start, stop in chunks])
+        columns.append([stop for start, stop in chunks])
+        for result in pool.map(function, *columns):
+            yield result
+
+
+def estimateCureRate(scenario, ciWidth=0.05, meanWidth=None, confidence=0.95,
+                     minTrials=20, maxTrials=100000, seed=None, numWorkers=1,
+                     chunkSize=8, store=None):
+    """
+    Runs trials of a scenario in batches until the confidence interval of
+    the cure fraction is at most ciWidth wide (and, if meanWidth is given,
+    the confidence interval of the mean population of every recorded series
+    at every time step is at most meanWidth wide), or maxTrials trials have
+    run. Easy scenarios therefore stop after a few trials while hard ones
+    get more.
+
+    Trial t is seeded with trialSeed(seed, t) as in runTrials(), and every
+    batch is a whole number of chunks of chunkSize trials, so the result
+    does not depend on numWorkers.
+
+    ciWidth: the target width of the cure fraction interval (a float)
+    meanWidth: the target width of the mean population intervals (a float),
+               or None
+    confidence: the confidence level of the intervals (a float between 0-1)
+    minTrials, maxTrials: bounds on the number of trials (integers)
+    store: a TrajectoryStore the trajectories of the trials are appended
+           to, or None
+
+    returns: the TrialSummary of the trials run, see
+    TrialSummary.getCureInterval()
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    summary = scenario.makeSummary()
+    batch = max(minTrials, 1)
+    while True:
+        stop = min(summary.getNumTrials() + batch, maxTrials)
+        stop = min(-(-stop // chunkSize) * chunkSize, maxTrials)
+        chunks = [(start, min(start + chunkSize, stop)) for start in
+                  range(summary.getNumTrials(), stop, chunkSize)]
+        for chunkSummary in _runChunks(scenario, seed, chunks, numWorkers,
+                                       store):
+            summary.merge(chunkSummary)
+        n = summary.getNumTrials()
+        if n >= maxTrials:
+            return summary
+
+        # the widths shrink like 1 / sqrt(n): estimate the trials needed
+        low, high = summary.getCureInterval(confidence)
+        ratio = (high - low) / ciWidth
+        if meanWidth is not None:
+            series = ["total"]
+            if summary.getResistStatistics() is not None:
+                series.append("resist")
+            for name in series:
+                low, high = summary.getMeanInterval(confidence, name)
+                ratio = max(ratio, numpy.max(high - low) / meanWidth)
+        if ratio <= 1:
+            return summary
+        batch = max(chunkSize, min(int(n * (ratio * ratio - 1)) + 1, n))
+
+
+def runTrials(scenario, numTrials, seed=None, numWorkers=1, chunkSize=None,
+              checkpoint=None, store=None):
+    """
+    Runs numTrials independent trials of a scenario and returns their
+    TrialSummary.
+
+    Trial t is seeded with trialSeed(seed, t), and the trials are split into
+    chunks whose summaries are merged in chunk order, so the result is the
+    same for any number of workers.
+
+    scenario: the Scenario to simulate
+    numTrials: number of simulation runs to execute (an integer)
+    seed: the seed of the run (an integer). If None, it is drawn from the
+          random module.
+    numWorkers: number of worker processes (an integer). 1 runs the trials in
+                this process; None uses one worker per CPU.
+    chunkSize: number of trials handed to a worker at a time (an integer);
+               by default about four chunks per worker
+    checkpoint: if given, the path of a file the progress is saved to after
+                every chunk. A run started again with the same arguments
+                (including the seed, but possibly with another number of
+                workers) resumes from it; the file is removed when the run
+                completes.
+    store: a TrajectoryStore the trajectories of the trials are appended to
+           in trial order (see Scenario.getSeriesNames()), or None. When a
+           run resumes from a checkpoint, trials the store holds beyond the
+           checkpoint are discarded.
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    summary = scenario.makeSummary()
+    chunks = _chunks(numTrials, chunkSize, numWorkers)
+    done = 0
+    key = None
+    if checkpoint is not None:
+        key = json.dumps([scenario.toDict(), seed, numTrials, chunkSize])
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint, "rb") as f:
+            saved = pickle.load(f)
+        if saved["key"] == key:
+            # keep the chunks of the interrupted run
+            chunks = saved["chunks"]
+            summary = saved["summary"]
+            done = saved["done"]
+            if store is not None and saved.get("stored") is not None:
+                store.truncate(saved["stored"])
+
+    for chunkSummary in _runChunks(scenario, seed, chunks[done:], numWorkers,
+                                   store):
+        summary.merge(chunkSummary)
+        done += 1
+        if checkpoint is not None:
+            stored = store.getNumTrials() if store is not None else None
+            _writeAtomically(checkpoint, pickle.dumps(
+                {"key": key, "chunks": chunks, "done": done,
+                 "summary": summary, "stored": stored}))
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return summary
+
+
+EXACT_CLASSES = {HybridPatient: GenotypePatient,
+                 HybridTreatedPatient: GenotypeTreatedPatient}
+
+
+def validateApproximation(scenario, numTrials=200, seed=0, numWorkers=1):
+    """
+    Compares a scenario simulated with an approximate patient class (see
+    EXACT_CLASSES) against the same scenario simulated with the exact
+    genotype-count model. Meant for a small maxPop, at which the exact model
+    is cheap, to choose the options (e.g. the threshold of HybridPatient) to
+    use at a large maxPop.
+
+    returns: a dictionary with
+        "maxZ": the largest difference between the mean total populations
+                at any time step, in standard errors of the difference (a
+                float; values well below 4 are consistent with noise)
+        "maxError": the largest difference between the mean total
+                    populations, relative to the largest exact mean (a
+                    float)
+        "cureRates": the exact and approximate cure rates (two floats)
+        "exact", "approximate": the TrialSummary of each model
+    """
+    if scenario.patientClass not in EXACT_CLASSES:
+        raise ValueError("not an approximate patient class: %s"
+                         % scenario.patientClass.__name__)
+    values = scenario.toDict()
+    values["patientClass"] = EXACT_CLASSES[scenario.patientClass].__name__
+    values["patientOptions"] = {}
+    exact = runTrials(Scenario.fromDict(values), numTrials, seed, numWorkers)
+    approximate = runTrials(scenario, numTrials, seed, numWorkers)
+
+    first = exact.getTotalStatistics()
+    second = approximate.getTotalStatistics()
+    difference = numpy.abs(first.getMean() - second.getMean())
+    error = numpy.sqrt((first.getVariance() + second.getVariance())
+                       / numTrials)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        z = numpy.where(difference > 0, difference / error, 0.0)
+    return {"maxZ": float(z.max()),
+            "maxError": float(difference.max()
+                              / max(first.getMean().max(), 1)),
+            "cureRates": (exact.cured / float(numTrials),
+                          approximate.cured / float(numTrials)),
+            "exact": exact, "approximate": approximate}
+
+
+#
+# TRAJECTORY STORE
+#
+class TrajectoryStore(object):
+    """
+    A file of the trajectories of individual trials, for analysing runs too
+    large to keep in memory. The file starts with a header describing the
+    trials (the parameters of the run, the number of time steps and the
+    names of the series recorded), followed by an int64 array of shape
+    (trials, steps, series). The array is memory-mapped: slices are views
+    of the file, read on demand without loading the rest of it.
+
+    Trials are appended in order. The trial count in the header is only
+    updated once their rows are flushed, so a store reopened after a crash
+    holds every trial appended until then.
+
+    The header is MAGIC, its size (a little-endian 64-bit integer) and JSON
+    padded with spaces.
+    """
+    MAGIC = b"PS8BTRAJ"
+
+    def __init__(self, path, writable=False):
+        """
+        Opens an existing store.
+
+        path: the name of the file (a string)
+        writable: whether trials can be appended (a boolean)
+        """
+        self.path = path
+        self.writable = writable
+        with open(path, "rb") as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError("not a trajectory store: %s" % path)
+            self.headerSize = int(numpy.frombuffer(f.read(8), dtype="<u8")[0])
+            self.header = json.loads(f.read(
+                self.headerSize - len(self.MAGIC) - 8).decode("utf-8"))
+        self._map()
+
+    @classmethod
+    def create(cls, path, numSteps, seriesNames, params=None, capacity=0):
+        """
+        Creates an empty store, replacing any existing file, and returns it
+        opened for appending.
+
+        numSteps: the number of time steps of every trial (an integer)
+        seriesNames: the names of the series recorded (a list of strings)
+        params: JSON-compatible values describing the run, or None
+        capacity: the number of trials to preallocate space for (an
+                  integer); the file grows as needed
+        """
+        header = {"version": 1, "numSteps": numSteps,
+                  "series": list(seriesNames), "dtype": "<i8",
+                  "numTrials": 0, "capacity": capacity, "params": params}
+        text = json.dumps(header).encode("utf-8")
+        # leave room for the counts to grow when the header is rewritten
+        headerSize = -(-(len(cls.MAGIC) + 8 + len(text) + 256) // 4096) * 4096
+        rowSize = numSteps * len(header["series"]) * 8
+        with open(path, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(numpy.array([headerSize], dtype="<u8").tobytes())
+            f.write(text.ljust(headerSize - len(cls.MAGIC) - 8))
+            f.truncate(headerSize + capacity * rowSize)
+        return cls(path, writable=True)
+
+    @classmethod
+    def forScenario(cls, path, scenario, params=None, capacity=0):
+        """
+        Creates an empty store for trials of a scenario (see create()). The
+        header holds the scenario (see Scenario.toDict()) and params.
+        """
+        values = {"scenario": scenario.toDict()}
+        values.update(params or {})
+        return cls.create(path, scenario.numSteps, scenario.getSeriesNames(),
+                          values, capacity)
+
+    def _map(self):
+        """
+        Maps the array of trajectories (up to the capacity of the file).
+        """
+        shape = (self.header["capacity"], self.header["numSteps"],
+                 len(self.header["series"]))
+        if shape[0] == 0:
+            self.data = numpy.zeros(shape, dtype=self.header["dtype"])
+        else:
+            self.data = numpy.memmap(self.path, dtype=self.header["dtype"],
+                                     mode="r+" if self.writable else "r",
+                                     offset=self.headerSize, shape=shape)
+
+    def _writeHeader(self):
+        """
+        Writes the header to the file.
+        """
+        text = json.dumps(self.header).encode("utf-8")
+        size = self.headerSize - len(self.MAGIC) - 8
+        if len(text) > size:
+            raise ValueError("the header of %s is full" % self.path)
+        with open(self.path, "r+b") as f:
+            f.seek(len(self.MAGIC) + 8)
+            f.write(text.ljust(size))
+
+    def getParams(self):
+        """
+        Returns the parameters stored with the trials.
+        """
+        return self.header["params"]
+
+    def getNumSteps(self):
+        """
+        Returns the number of time steps of every trial.
+        """
+        return self.header["numSteps"]
+
+    def getSeriesNames(self):
+        """
+        Returns the names of the series recorded (a list of strings).
+        """
+        return list(self.header["series"])
+
+    def getNumTrials(self):
+        """
+        Returns the number of trials in the store.
+        """
+        return self.header["numTrials"]
+
+    def getTrials(self, start=0, stop=None):
+        """
+        Returns the trajectories of trials start to stop - 1, an array of
+        shape (trials, steps, series) that is a view of the file.
+        """
+        stop = self.getNumTrials() if stop is None else min(
+            stop, self.getNumTrials())
+        return self.data[start:stop]
+
+    def getSeries(self, name, start=0, stop=None):
+        """
+        Returns one series of trials start to stop - 1, an array of shape
+        (trials, steps) that is a view of the file.
+        """
+        return self.getTrials(start, stop)[:, :, self.getSeriesNames().index(
+            name)]
+
+    def getFirstPassage(self, name, level, start=0, batchSize=4096):
+        """
+        Returns, for every trial, the first time step from step start on at
+        which the series name is at least level, or -1 if there is none (an
+        array). For instance getFirstPassage("resist:guttagonol", 1, 150) -
+        150 is the delay until resistance to guttagonol emerges after the
+        drug is added at step 150. The trials are read batchSize at a time,
+        so the store does not have to fit in memory.
+        """
+        column = self.getSeriesNames().index(name)
+        result = numpy.empty(self.getNumTrials(), dtype=numpy.int64)
+        for first in range(0, len(result), batchSize):
+            reached = self.getTrials(first, first + batchSize)[:, start:,
+                                                              column] >= level
+            result[first:first + len(reached)] = numpy.where(
+                reached.any(axis=1), reached.argmax(axis=1) + start, -1)
+        return result
+
+    def append(self, block):
+        """
+        Appends the trajectories of trials to the store, growing the file if
+        needed.
+
+        block: an array of shape (trials, steps, series)
+        """
+        if not self.writable:
+            raise ValueError("the trajectory store is read-only")
+        block = numpy.asarray(block)
+        if block.shape[1:] != self.data.shape[1:]:
+            raise ValueError("trajectories of shape %s do not fit the store"
+                             % (block.shape,))
+        n = self.getNumTrials()
+        if n + len(block) > self.header["capacity"]:
+            self._grow(max(n + len(block), 2 * self.header["capacity"]))
+        self.data[n:n + len(block)] = block
+        self.header["numTrials"] = n + len(block)
+        self.flush()
+
+    def _grow(self, capacity):
+        """
+        Extends the file to hold capacity trials.
+        """
+        self.flush()
+        self.data = None
+        rowSize = self.getNumSteps() * len(self.header["series"]) * 8
+        with open(self.path, "r+b") as f:
+            f.truncate(self.headerSize + capacity * rowSize)
+        self.header["capacity"] = capacity
+        self._writeHeader()
+        self._map()
+
+    def truncate(self, numTrials):
+        """
+        Discards the trials from index numTrials on.
+        """
+        if not self.writable:
+            raise ValueError("the trajectory store is read-only")
+        if numTrials > self.getNumTrials():
+            raise ValueError("the store holds only %d trials"
+                             % self.getNumTrials())
+        self.header["numTrials"] = numTrials
+        self._writeHeader()
+
+    def flush(self):
+        """
+        Writes the appended trials, then the header, to the file.
+        """
+        if self.writable:
+            if isinstance(self.data, numpy.memmap):
+                self.data.flush()
+            self._writeHeader()
+
+    def close(self):
+        """
+        Flushes and closes the store.
+        """
+        if self.data is not None:
+            self.flush()
+            self.data = None
+
+
+#
+# STREAMING
+#
+def iterTrial(scenario, seed, masks=None):
+    """
+    Runs one trial of a scenario like runTrial(), as a generator yielding
+    (step, total, resist) after every time step (resist is None if the
+    scenario does not record it). Nothing is simulated until the next value
+    is requested, and closing the generator abandons the trial.
+
+    The patient draws from its own RandomStream, so code run between two
+    steps, including other trials, does not change the trial.
+    """
+    if masks is None:
+        masks = scenario.getMasks()
+    totals, resists = newTrajectory(scenario)
+    patient = scenario.makePatient(RandomStream(seed))
+    for a in range(scenario.numSteps):
+        if a == 0 or totals[a - 1] > 0:
+            advanceTrial(patient, scenario, masks, totals, resists, a, a + 1)
+        yield a, int(totals[a]), None if resists is None else int(resists[a])
+
+
+def _runTrajectoryChunk(scenario, seed, start, stop):
+    """
+    Runs trials start to stop - 1 of a scenario and returns their (totals,
+    resists) trajectories (a list).
+    """
+    masks = scenario.getMasks()
+    return [runTrial(scenario, trialSeed(seed, t), masks)
+            for t in range(start, stop)]
+
+
+def _streamChunks(function, args, chunks, numWorkers, maxPending=None):
+    """
+    Like _mapChunks() with a pool of numWorkers processes, but only keeps
+    maxPending chunks (by default two per worker) submitted ahead of the
+    one being consumed, so chunks are computed no faster than their results
+    are consumed. Closing the generator cancels the chunks not yet started.
+    """
+    if maxPending is None:
+        maxPending = 2 * (numWorkers or os.cpu_count() or 1)
+    chunks = iter(chunks)
+    pending = collections.deque()
+    pool = concurrent.futures.ProcessPoolExecutor(numWorkers)
+    try:
+        for start, stop in itertools.islice(chunks, maxPending):
+            pending.append(pool.submit(function, *(tuple(args) +
+                                                   (start, stop))))
+        while pending:
+            result = pending.popleft().result()
+            for start, stop in itertools.islice(chunks, 1):
+                pending.append(pool.submit(function, *(tuple(args) +
+                                                       (start, stop))))
+            yield result
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def streamTrials(scenario, numTrials, seed=None, numWorkers=1,
+                 chunkSize=None, steps=True):
+    """
+    Runs numTrials trials of a scenario like runTrials(), as a generator of
+    snapshots for monitoring a run while it progresses. Trial t is seeded
+    with trialSeed(seed, t), so the final summary equals the one returned
+    by runTrials().
+
+    Every snapshot is a dictionary with a "kind":
+        "step": the population after one time step of a trial, with the
+                keys "trial", "step", "total" and "resist" (None if it is
+                not recorded)
+        "trial": a completed trial, with the keys "trial", "totals",
+                 "resists" (its trajectories) and "cured"
+    and a "summary": the TrialSummary of the trials completed so far, in
+    trial order. The summary is updated in place; merge it into an empty
+    one (see Scenario.makeSummary()) to keep a copy.
+
+    With numWorkers 1 the step snapshots are produced live, one time step
+    at a time. Otherwise the trials run on a pool of worker processes in
+    chunks of chunkSize, and the steps of every trial are reported once its
+    chunk is done. Either way the simulation only runs ahead of the consumer
+    by a bounded amount (two chunks per worker), and closing the generator
+    stops it.
+
+    steps: whether to produce step snapshots (a boolean); if False, only
+           trial snapshots are produced
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    summary = scenario.makeSummary()
+    if numWorkers == 1:
+        masks = scenario.getMasks()
+        for t in range(numTrials):
+            totals, resists = newTrajectory(scenario)
+            for a, total, resist in iterTrial(scenario, trialSeed(seed, t),
+                                              masks):
+                totals[a] = total
+                if resists is not None:
+                    resists[a] = resist
+                if steps:
+                    yield {"kind": "step", "trial": t, "step": a,
+                           "total": total, "resist": resist,
+                           "summary": summary}
+            cured = bool(totals[-1] <= scenario.cureThreshold)
+            summary.addTrial(totals, resists, cured)
+            yield {"kind": "trial", "trial": t, "totals": totals,
+                   "resists": resists, "cured": cured, "summary": summary}
+        return
+
+    t = 0
+    for trajectories in _streamChunks(_runTrajectoryChunk, (scenario, seed),
+                                      _chunks(numTrials, chunkSize,
+                                              numWorkers),
+                                      numWorkers):
+        for totals, resists in trajectories:
+            if steps:
+                for a in range(scenario.numSteps):
+                    yield {"kind": "step", "trial": t, "step": a,
+                           "total": int(totals[a]),
+                           "resist": None if resists is None else int(
+                               resists[a]),
+                           "summary": summary}
+            cured = bool(totals[-1] <= scenario.cureThreshold)
+            summary.addTrial(totals, resists, cured)
+            yield {"kind": "trial", "trial": t, "totals": totals,
+                   "resists": resists, "cured": cured, "summary": summary}
+            t += 1
+
+
+async def streamTrialsAsync(scenario, numTrials, seed=None, numWorkers=1,
+                            chunkSize=None, steps=True):
+    """
+    Asynchronous iterator version of streamTrials(), for use in an asyncio
+    event loop: the simulation runs in a separate thread, one snapshot at a
+    time, so the loop is never blocked, and it only advances when the next
+    snapshot is awaited. Cancelling the consuming task (or calling aclose())
+    stops the simulation.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    stream = streamTrials(scenario, numTrials, seed, numWorkers, chunkSize,
+                          steps)
+    # a single thread, so that closing the stream waits for a running step
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    try:
+        while True:
+            snapshot = await loop.run_in_executor(executor, next, stream,
+                                                  None)
+            if snapshot is None:
+                return
+            yield snapshot
+    finally:
+        executor.submit(stream.close)
+        executor.shutdown(wait=False)
+
+
+#
+# COHORTS
+#
+class Cohort(object):
+    """
+    A cohort of patients, one per Scenario, simulated together. The virus
+    particles of all patients are kept in one set of NumPy arrays with a
+    column holding the patient of every particle, so a time step is one
+    vectorized pass over the whole cohort, however many patients it has.
+    The parameters that differ between patients (maxPop, the virus
+    parameters, the initial resistances and the treatment schedule) are
+    per-patient arrays indexed by that column.
+
+    Every patient behaves like an ArrayTreatedPatient running its scenario,
+    but the cohort shares its random draws, so a patient's trajectory is not
+    the one runTrial() gives for its scenario (it has the same
+    distribution).
+    """
+    def __init__(self, scenarios, rng=None):
+        """
+        scenarios: one Scenario per patient (a list). They must have the same
+                   numSteps and resistDrugs.
+        rng: the numpy.random.Generator or RandomStream to draw from. If
+             None, a generator is seeded from the random module.
+        """
+        first = scenarios[0]
+        for scenario in scenarios:
+            if (scenario.numSteps != first.numSteps or
+                    scenario.resistDrugs != first.resistDrugs):
+                raise ValueError("the scenarios of a cohort must have the "
+                                 "same numSteps and resistDrugs")
+        self.rng = _generator(rng)
+        self.numSteps = first.numSteps
+        self.numPatients = len(scenarios)
+        self.maxPops = numpy.array([s.maxPop for s in scenarios], dtype=float)
+        self.birthProbs = numpy.array([s.maxBirthProb for s in scenarios])
+        self.clearProbs = numpy.array([s.clearProb for s in scenarios])
+        self.mutProbs = numpy.array([s.mutProb for s in scenarios])
+
+        genotypes = [drugRegistry.toMasks(s.resistances or {})
+                     for s in scenarios]
+        schedules = {}
+        for s in scenarios:
+            key = json.dumps(s.getSchedule().toList())
+            if key not in schedules:
+                schedules[key] = s.getMasks()
+        allTraits = 0
+        for traits, resist in genotypes:
+            allTraits |= traits
+        allDrugs = allTraits
+        for masks in schedules.values():
+            for mask in masks:
+                allDrugs |= mask
+        self.numWords = max(1, (allDrugs.bit_length() + 63) // 64)
+        self.traitBits = drugRegistry.getBits(allTraits)
+        self.traits = numpy.array([_toWords(g[0], self.numWords)
+                                   for g in genotypes])
+        initial = numpy.array([_toWords(g[1], self.numWords)
+                               for g in genotypes])
+
+        # the drugs active at every step for every patient, compiled once per
+        # distinct schedule
+        for key in schedules:
+            schedules[key] = numpy.array([_toWords(mask, self.numWords)
+                                          for mask in schedules[key]])
+        self.masks = numpy.zeros((self.numSteps, self.numPatients,
+                                  self.numWords), dtype=numpy.uint64)
+        for p in range(self.numPatients):
+            key = json.dumps(scenarios[p].getSchedule().toList())
+            self.masks[:, p] = schedules[key]
+        self.treated = self.masks.any(axis=(1, 2))
+
+        self.patients = numpy.repeat(
+            numpy.arange(self.numPatients),
+            [s.numViruses for s in scenarios])
+        self.resist = initial[self.patients]
+
+    def getNumPatients(self):
+        """
+        Returns the number of patients in the cohort.
+        """
+        return self.numPatients
+
+    def getTotalPops(self):
+        """
+        Returns the virus population of every patient (an array).
+        """
+        return numpy.bincount(self.patients, minlength=self.numPatients)
+
+    def getResistPops(self, drugResist):
+        """
+        Returns the population of virus particles resistant to all the drugs
+        in drugResist (a list of strings) of every patient (an array).
+        """
+        words = _toWords(drugRegistry.getMask(drugResist), self.numWords)
+        if words is None:
+            return numpy.zeros(self.numPatients, dtype=numpy.int64)
+        resistant = ((self.resist & words) == words).all(axis=1)
+        return numpy.bincount(self.patients[resistant],
+                              minlength=self.numPatients)
+
+    def update(self, step):
+        """
+        Updates every patient for a single time step, in the same order as
+        ArrayPatient.update(), with the drugs of its schedule at step.
+
+        returns: the virus population of every patient at the end of the
+        update (an array)
+        """
+        patients = self.patients
+        survive = self.rng.random(len(patients)) >= self.clearProbs[patients]
+        patients = patients[survive]
+        resist = self.resist[survive]
+        pops = numpy.bincount(patients, minlength=self.numPatients)
+        birthProbs = self.birthProbs * (1 - pops / self.maxPops)
+
+        born = self.rng.random(len(patients)) < birthProbs[patients]
+        if self.treated[step]:
+            needed = self.masks[step][patients]
+            born &= ((resist & needed) == needed).all(axis=1)
+        parents = numpy.flatnonzero(born)
+        children = patients[parents]
+        childResist = resist[parents]
+        if len(parents) and self.traitBits:
+            flipWords = _drawFlipWords(self.rng, self.mutProbs[children],
+                                       self.traitBits, self.numWords)
+            childResist ^= flipWords & self.traits[children]
+        self.patients = numpy.concatenate((patients, children))
+        self.resist = numpy.concatenate((resist, childResist))
+        return pops + numpy.bincount(children, minlength=self.numPatients)
+
+
+class CohortSummary(object):
+    """
+    The trajectories and outcomes of the patients of a cohort simulated by
+    runCohort(), for the whole cohort and per stratum.
+    """
+    def __init__(self, scenarios, totals, resists, strata=None):
+        """
+        scenarios: the Scenario of every patient (a list)
+        totals, resists: the total and resistant population of every
+                         patient at every time step (arrays of shape
+                         (patients, steps)); resists may be None
+        strata: the stratum of every patient (a list of hashable labels), or
+                None
+        """
+        self.totals = totals
+        self.resists = resists
+        self.cured = totals[:, -1] <= numpy.array(
+            [s.cureThreshold for s in scenarios])
+        self.strata = list(strata) if strata is not None else (
+            [None] * len(scenarios))
+        if len(self.strata) != len(scenarios):
+            raise ValueError("one stratum is needed per patient")
+        self.maxValues = [max(2 * s.maxPop, s.numViruses) for s in scenarios]
+
+    def getTotals(self):
+        """
+        Returns the total population of every patient at every time step (an
+        array of shape (patients, steps)).
+        """
+        return self.totals
+
+    def getResists(self):
+        """
+        Returns the resistant population of every patient at every time step
+        (an array of shape (patients, steps)), or None if it was not
+        recorded.
+        """
+        return self.resists
+
+    def getCured(self):
+        """
+        Returns whether every patient is cured (an array of booleans).
+        """
+        return self.cured
+
+    def getCureRate(self):
+        """
+        Returns the fraction of the cohort that is cured.
+        """
+        return float(self.cured.mean())
+
+    def _summarize(self, members):
+        """
+        Returns the TrialSummary of the patients with indices in members.
+        """
+        summary = TrialSummary(self.totals.shape[1], self.resists is not None,
+                               max([self.maxValues[p] for p in members] +
+                                   [1]))
+        for p in members:
+            summary.addTrial(self.totals[p], None if self.resists is None
+                             else self.resists[p], self.cured[p])
+        return summary
+
+    def getSummary(self):
+        """
+        Returns the TrialSummary of the whole cohort.
+        """
+        return self._summarize(range(len(self.strata)))
+
+    def getStrata(self):
+        """
+        Returns a dictionary mapping every stratum to the TrialSummary of its
+        patients (see TrialSummary.getCureInterval() for the cure rate).
+        """
+        members = {}
+        for p in range(len(self.strata)):
+            members.setdefault(self.strata[p], []).append(p)
+        return dict((stratum, self._summarize(members[stratum]))
+                    for stratum in members)
+
+
+def runCohort(scenarios, strata=None, seed=None):
+    """
+    Simulates a cohort of patients, one per Scenario, together (see Cohort).
+
+    scenarios: the Scenario of every patient (a list); they must have the
+               same numSteps and resistDrugs
+    strata: the stratum of every patient (a list of hashable labels, e.g.
+            the treatment start or an age group), or None
+    seed: the seed of the cohort's generator (an integer). If None, it is
+          drawn from the random module.
+
+    returns: a CohortSummary
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    cohort = Cohort(scenarios, numpy.random.default_rng(seed))
+    numSteps = cohort.numSteps
+    resistDrugs = scenarios[0].resistDrugs
+    totals = numpy.zeros((len(scenarios), numSteps), dtype=numpy.int64)
+    resists = None
+    if resistDrugs is not None:
+        resists = numpy.zeros((len(scenarios), numSteps), dtype=numpy.int64)
+    for a in range(numSteps):
+        totals[:, a] = cohort.update(a)
+        if resists is not None:
+            resists[:, a] = cohort.getResistPops(resistDrugs)
+        if not totals[:, a].any():
+            break
+    return CohortSummary(scenarios, totals, resists, strata)
+
+
+#
+# CHECKPOINTS
+#
+def encodeGenotypes(genotypes, allTraits=0):
+    """
+    Encodes a list of genotypes (see virusGenotype()) as arrays that do not
+    depend on the bit positions of the drug registry, so that they can be
+    decoded in another process.
+
+    allTraits: a bitmask of drugs to include even if no genotype has them
+
+    returns: a dictionary with "traitNames" (the list of drug names),
+    "birthProbs", "clearProbs", "mutProbs" (one float per genotype) and
+    "genes", an array of one row per genotype and one column per drug name
+    holding 0 if the genotype has no resistance trait for the drug, 1 if it
+    is not resistant and 2 if it is resistant.
+    """
+    for genotype in genotypes:
+        allTraits |= genotype[3]
+    names = drugRegistry.getNames(allTraits)
+    bits = [drugRegistry.getBit(d) for d in names]
+    genes = numpy.zeros((len(genotypes), len(names)), dtype=numpy.int8)
+    for i in range(len(genotypes)):
+        traits, resist = genotypes[i][3], genotypes[i][4]
+        for j in range(len(bits)):
+            if traits >> bits[j] & 1:
+                genes[i, j] = 1 + (resist >> bits[j] & 1)
+    return {"traitNames": names,
+            "birthProbs": numpy.array([g[0] for g in genotypes], dtype=float),
+            "clearProbs": numpy.array([g[1] for g in genotypes], dtype=float),
+            "mutProbs": numpy.array([g[2] for g in genotypes], dtype=float),
+            "genes": genes}
+
+
+def decodeGenotypes(state):
+    """
+    Returns the list of genotypes encoded by encodeGenotypes() in state.
+    """
+    bits = [1 << drugRegistry.getBit(d) for d in state["traitNames"]]
+    genotypes = []
+    genes = state["genes"].tolist()
+    for i in range(len(genes)):
+        traits = 0
+        resist = 0
+        for j in range(len(bits)):
+            if genes[i][j]:
+                traits |= bits[j]
+                if genes[i][j] == 2:
+                    resist |= bits[j]
+        genotypes.append((float(state["birthProbs"][i]),
+                          float(state["clearProbs"][i]),
+                          float(state["mutProbs"][i]), traits, resist))
+    return genotypes
+
+
+def _restoreGenerator(state, antithetic=False):
+    """
+    Returns a numpy.random.Generator whose bit generator is in state (a
+    dictionary as returned by bit_generator.state), wrapped in an
+    AntitheticGenerator if antithetic.
+    """
+    bitGenerator = getattr(numpy.random, state["bit_generator"])()
+    bitGenerator.state = state
+    generator = numpy.random.Generator(bitGenerator)
+    if antithetic:
+        generator = AntitheticGenerator(generator)
+    return generator
+
+
+def _writeAtomically(path, data):
+    """
+    Writes data (bytes) to path, so that path holds either its old contents
+    or all of data, even if the process dies while writing.
+    """
+    # one temporary file per writer, so concurrent writers never share one
+    temporary = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def snapshotPatient(patient):
+    """
+    Returns a compact binary snapshot (bytes) of a patient's state: its
+    class, population, genotypes, prescriptions and random number generator
+    state. The arrays of getState() are stored in a compressed .npz archive,
+    the other values as JSON.
+    """
+    arrays = {}
+    meta = {}
+    state = patient.getState()
+    for key in state:
+        if isinstance(state[key], numpy.ndarray):
+            arrays[key] = state[key]
+        else:
+            meta[key] = state[key]
+    meta = numpy.frombuffer(json.dumps(meta).encode("utf-8"), dtype=numpy.uint8)
+    buffer = io.BytesIO()
+    numpy.savez_compressed(buffer, meta=meta, **arrays)
+    return buffer.getvalue()
+
+
+def restorePatient(snapshot, restoreRandom=True):
+    """
+    Creates a patient from a snapshot returned by snapshotPatient().
+
+    restoreRandom: whether to restore the random number generator state, so
+    that the patient continues exactly as the saved one would have
+    """
+    with numpy.load(io.BytesIO(snapshot)) as archive:
+        state = dict((key, archive[key]) for key in archive.files)
+    state.update(json.loads(state.pop("meta").tobytes().decode("utf-8")))
+    if state["class"] not in PATIENT_CLASSES:
+        raise ValueError("unknown patient class: %s" % state["class"])
+    return PATIENT_CLASSES[state["class"]].fromState(state, restoreRandom)
+
+
+def saveCheckpoint(patient, path):
+    """
+    Saves a snapshot of a patient to a file (see snapshotPatient()). The
+    file is replaced atomically.
+    """
+    _writeAtomically(path, snapshotPatient(patient))
+
+
+def loadCheckpoint(path, restoreRandom=True):
+    """
+    Loads a patient saved by saveCheckpoint(), see restorePatient().
+    """
+    with open(path, "rb") as f:
+        return restorePatient(f.read(), restoreRandom)
+
+
+def forkPatient(patient):
+    """
+    Returns an independent copy of a patient that continues exactly as the
+    patient would from its current state (for patients drawing from a NumPy
+    generator, the copy gets its own copy of the generator).
+    """
+    return type(patient).fromState(patient.getState())
+
+
+def _runBranchChunk(scenario, branches, seed, start, stop):
+    """
+    Runs trials start to stop - 1 of every branch of runTreatmentBranches()
+    and returns a dictionary mapping branch names to TrialSummary instances.
+    """
+    names = sorted(branches)
+    masks = scenario.getMasks()
+    branchMasks = {}
+    prefix = scenario.numSteps
+    for name in names:
+        schedule = scenario.getSchedule()
+        for step, drug in branches[name]:
+            schedule.startDrug(drug, step)
+        branchMasks[name] = schedule.compile(scenario.numSteps)
+        for a in range(prefix):
+            if branchMasks[name][a] != masks[a]:
+                prefix = a
+                break
+    summaries = dict((name, scenario.makeSummary()) for name in names)
+    for t in range(start, stop):
+        totals, resists = newTrajectory(scenario)
+        patient = scenario.makePatient(RandomStream(trialSeed(seed, t)))
+        advanceTrial(patient, scenario, masks, totals, resists, 0, prefix)
+        state = patient.getState()
+        for name in names:
+            branch = type(patient).fromState(state)
+            branchTotals = totals.copy()
+            branchResists = None if resists is None else resists.copy()
+            advanceTrial(branch, scenario, branchMasks[name], branchTotals,
+                         branchResists, prefix, scenario.numSteps)
+            summaries[name].addTrial(
+                branchTotals, branchResists,
+                branchTotals[-1] <= scenario.cureThreshold)
+    return summaries
+
+
+def runTreatmentBranches(scenario, branches, numTrials, seed=None,
+                         numWorkers=1, chunkSize=None):
+    """
+    Runs numTrials trials of several treatment variants of a scenario,
+    simulating the steps before the schedule of any variant first differs
+    from the scenario's only once per trial. At that step every trial is
+    forked into one branch per variant,
+    each restoring the random number generator state of the fork, so every
+    branch gives exactly the trajectories runTrials() would give for the
+    scenario with the variant's prescriptions and the same seed.
+
+    scenario: the Scenario shared by the branches; its own prescriptions are
+              given to every branch
+    branches: a dictionary mapping branch names to lists of (step, drug)
+              prescriptions
+    numTrials, seed, numWorkers, chunkSize: see runTrials()
+
+    returns: a dictionary mapping branch names to TrialSummary instances
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    summaries = dict((name, scenario.makeSummary()) for name in branches)
+    for chunkSummaries in _mapChunks(_runBranchChunk,
+                                     (scenario, branches, seed),
+                                     _chunks(numTrials, chunkSize,
+                                             numWorkers),
+                                     numWorkers):
+        for name in summaries:
+            summaries[name].merge(chunkSummaries[name])
+    return summaries
+
+
+#
+# REGIMEN COMPARISON
+#
+def _regimenSchedule(scenario, regimen):
+    """
+    Returns the TreatmentSchedule of a regimen of compareRegimens(): the
+    scenario's schedule followed by the regimen's changes.
+    """
+    schedule = scenario.getSchedule()
+    if isinstance(regimen, TreatmentSchedule):
+        schedule.changes.extend(regimen.toList())
+    else:
+        for step, drug in regimen:
+            schedule.startDrug(drug, step)
+    return schedule
+
+
+def _commonPrefix(masks):
+    """
+    Returns the first time step at which the compiled schedules masks (a
+    list of lists of bitmasks) are not all the same.
+    """
+    numSteps = len(masks[0])
+    for a in range(numSteps):
+        for other in masks[1:]:
+            if other[a] != masks[0][a]:
+                return a
+    return numSteps
+
+
+def _advanceRegimen(patient, scenario, masks, totals, resists, start, stop,
+                    seed, synchronized):
+    """
+    Runs time steps start to stop - 1 of a trial like advanceTrial(). If
+    synchronized, the patient's RandomStream or generator is seeded with
+    trialSeed(seed, step) before every step, so
+    that trials of different regimens draw the same random numbers at every
+    step even after their populations differ. An antithetic stream or
+    generator stays antithetic.
+    """
+    if not synchronized:
+        advanceTrial(patient, scenario, masks, totals, resists, start, stop)
+        return
+    for a in range(start, stop):
+        if a > 0 and totals[a - 1] == 0:
+            break
+        stepSeed = trialSeed(seed, a)
+        rng = patient.rng
+        if isinstance(rng, RandomStream):
+            rng.seed(stepSeed)
+        else:
+            generator = numpy.random.default_rng(stepSeed)
+            if isinstance(rng, AntitheticGenerator):
+                generator = AntitheticGenerator(generator)
+            patient.rng = generator
+        advanceTrial(patient, scenario, masks, totals, resists, a, a + 1)
+
+
+def _runRegimenChunk(scenario, regimens, seed, options, start, stop):
+    """
+    Runs trials start to stop - 1 of every regimen of compareRegimens().
+
+    returns: (totals, resists, controls) where totals and resists map the
+    regimen names to arrays of shape (trials, passes, steps) (resists is
+    None if it is not recorded), and controls holds the total population
+    at the last step shared by all regimens, of shape (trials, passes). A
+    trial has a second, antithetic pass if options["antithetic"] is set.
+    """
+    names = sorted(regimens)
+    masks = dict((name, _regimenSchedule(scenario, regimens[name]).compile(
+        scenario.numSteps)) for name in names)
+    prefix = _commonPrefix([masks[name] for name in names])
+    passes = 2 if options["antithetic"] else 1
+    shape = (stop - start, passes, scenario.numSteps)
+    totals = dict((name, numpy.zeros(shape, dtype=numpy.int64))
+                  for name in names)
+    resists = None
+    if scenario.resistDrugs is not None:
+        resists = dict((name, numpy.zeros(shape, dtype=numpy.int64))
+                       for name in names)
+    controls = numpy.zeros((stop - start, passes))
+    for t in range(start, stop):
+        seed_t = trialSeed(seed, t)
+        for p in range(passes):
+            # both passes seed their stream alike; the antithetic pass
+            # draws 1 - u for every uniform u of the first
+            patient = scenario.makePatient(RandomStream(seed_t,
+                                                        antithetic=p == 1))
+            common, commonResists = newTrajectory(scenario)
+            _advanceRegimen(patient, scenario, masks[names[0]], common,
+                            commonResists, 0, prefix, seed_t,
+                            options["synchronized"])
+            if prefix:
+                controls[t - start, p] = common[prefix - 1]
+            state = patient.getState()
+            for name in names:
+                branch = type(patient).fromState(state)
+                branchTotals = totals[name][t - start, p]
+                branchTotals[:prefix] = common[:prefix]
+                branchResists = None
+                if resists is not None:
+                    branchResists = resists[name][t - start, p]
+                    branchResists[:prefix] = commonResists[:prefix]
+                _advanceRegimen(branch, scenario, masks[name], branchTotals,
+                                branchResists, prefix, scenario.numSteps,
+                                seed_t, options["synchronized"])
+    return totals, resists, controls
+
+
+def _runControlChunk(scenario, regimens, seed, options, start, stop):
+    """
+    Runs the steps shared by all regimens of compareRegimens() for trials
+    start to stop - 1 and returns the total population at the last of them
+    (an array).
+    """
+    names = sorted(regimens)
+    masks = [_regimenSchedule(scenario, regimens[name]).compile(
+        scenario.numSteps) for name in names]
+    prefix = _commonPrefix(masks)
+    controls = numpy.zeros(stop - start)
+    for t in range(start, stop):
+        seed_t = trialSeed(seed, t)
+        patient = scenario.makePatient(RandomStream(seed_t))
+        totals, resists = newTrajectory(scenario)
+        _advanceRegimen(patient, scenario, masks[0], totals, resists, 0,
+                        prefix, seed_t, options["synchronized"])
+        if prefix:
+            controls[t - start] = totals[prefix - 1]
+    return controls
+
+
+class RegimenComparison(object):
+    """
+    The paired trials of several treatment regimens run by
+    compareRegimens(), and estimates of the differences between each
+    regimen and the baseline regimen with their confidence intervals.
+    """
+    def __init__(self, scenario, baseline, totals, resists, controls,
+                 controlSample=None):
+        """
+        scenario: the Scenario the regimens were applied to
+        baseline: the name of the regimen the others are compared with
+        totals, resists, controls: see _runRegimenChunk(), for all trials
+        controlSample: the control value of independent trials (an array),
+                       or None to not use a control variate
+        """
+        self.scenario = scenario
+        self.baseline = baseline
+        self.totals = totals
+        self.resists = resists
+        self.controls = controls
+        self.controlSample = controlSample
+
+    def getNames(self):
+        """
+        Returns the names of the regimens (a sorted list of strings).
+        """
+        return sorted(self.totals)
+
+    def getBaseline(self):
+        """
+        Returns the name of the baseline regimen.
+        """
+        return self.baseline
+
+    def getNumTrials(self):
+        """
+        Returns the number of paired trials (an antithetic pair counts once).
+        """
+        return len(self.controls)
+
+    def getSummary(self, name):
+        """
+        Returns the TrialSummary of every trial simulated for a regimen,
+        including antithetic passes.
+        """
+        summary = self.scenario.makeSummary()
+        totals = self.totals[name]
+        for t in range(totals.shape[0]):
+            for p in range(totals.shape[1]):
+                summary.addTrial(totals[t, p], None if self.resists is None
+                                 else self.resists[name][t, p],
+                                 totals[t, p, -1] <=
+                                 self.scenario.cureThreshold)
+        return summary
+
+    def _samples(self, name, kind):
+        """
+        Returns the per-trial values of a regimen, averaged over the passes
+        of a trial: whether the trial is cured ("cure", shape (trials,)), or
+        the "total" or "resist" population (shape (trials, steps)).
+        """
+        if kind == "cure":
+            values = self.totals[name][:, :, -1] <= self.scenario.cureThreshold
+        elif kind == "total":
+            values = self.totals[name]
+        else:
+            values = self.resists[name]
+        return values.astype(float).mean(axis=1)
+
+    def _estimate(self, name, kind, confidence):
+        """
+        Returns (estimate, low, high, variance) of the mean difference
+        between a regimen and the baseline, with the control variate
+        adjustment if a control sample was drawn.
+        """
+        d = self._samples(name, kind) - self._samples(self.baseline, kind)
+        n = len(d)
+        estimate = d.mean(axis=0)
+        variance = d.var(axis=0, ddof=1) / n
+        c = self.controls.mean(axis=1)
+        if self.controlSample is not None and c.var() > 0:
+            # regression estimator: E[d] = mean(d - beta (c - E[c])), with
+            # E[c] estimated from the independent control sample
+            cc = c - c.mean()
+            if d.ndim == 1:
+                beta = (d - estimate).dot(cc) / cc.dot(cc)
+            else:
+                beta = cc.dot(d - estimate) / cc.dot(cc)
+            estimate = estimate - beta * (c.mean() - self.controlSample.mean())
+            residual = d - numpy.multiply.outer(cc, beta) if d.ndim > 1 else (
+                d - beta * cc)
+            variance = (residual.var(axis=0, ddof=1) / n + beta * beta *
+                        self.controlSample.var(ddof=1) /
+                        len(self.controlSample))
+        half = (statistics.NormalDist().inv_cdf(0.5 + confidence / 2) *
+                numpy.sqrt(variance))
+        return estimate, estimate - half, estimate + half, variance
+
+    def getCureDifference(self, name, confidence=0.95):
+        """
+        Returns the difference between the cure rates of a regimen and the
+        baseline, with its normal confidence interval: (estimate, low, high).
+        """
+        estimate, low, high, variance = self._estimate(name, "cure",
+                                                       confidence)
+        return float(estimate), float(low), float(high)
+
+    def getMeanDifference(self, name, confidence=0.95, series="total"):
+        """
+        Returns the difference between the mean populations of a regimen and
+        the baseline at every time step, with its normal confidence interval:
+        (estimate, low, high), three arrays.
+
+        series: "total" or "resist"
+        """
+        estimate, low, high, variance = self._estimate(name, series,
+                                                       confidence)
+        return estimate, low, high
+
+    def getEfficiency(self, name):
+        """
+        Returns how many times more trials independent sampling would need to
+        estimate the cure rate difference between a regimen and the baseline
+        as precisely (a float): the variance of the difference of two
+        independent samples with as many simulated trials (antithetic passes
+        included), divided by the variance of this estimate.
+        """
+        variance = self._estimate(name, "cure", 0.95)[3]
+        independent = 0.0
+        for regimen in (name, self.baseline):
+            cured = (self.totals[regimen][:, :, -1] <=
+                     self.scenario.cureThreshold).ravel()
+            independent += cured.var(ddof=1) / len(cured)
+        if variance == 0:
+            return float("inf") if independent > 0 else 1.0
+        return float(independent / variance)
+
+
+def compareRegimens(scenario, regimens, numTrials, seed=None, baseline=None,
+                    synchronized=False, antithetic=False, controlTrials=0,
+                    numWorkers=1, chunkSize=None):
+    """
+    Compares treatment regimens on common random numbers: trial t of every
+    regimen starts from the same seed (trialSeed(seed, t)), the steps before
+    the regimens first differ are simulated once and forked, and the
+    differences between regimens are estimated from the paired trials, so
+    they need far fewer trials than independent runs for the same
+    precision.
+
+    scenario: the Scenario the regimens are applied to
+    regimens: a dictionary mapping regimen names to lists of (step, drug)
+              prescriptions or to TreatmentSchedule instances, applied after
+              the scenario's own schedule
+    numTrials: number of paired trials (an integer)
+    baseline: the name of the regimen the others are compared with (by
+              default the first in sorted order)
+    synchronized: whether to reseed the random numbers at every step from
+                  the trial and the step, which keeps the regimens' draws
+                  aligned after their populations differ, but makes every
+                  step several times slower
+    antithetic: whether to run every trial a second time with every uniform
+                random number u replaced by 1 - u, and average the pair
+                (not for the genotype-count engines, whose binomial and
+                Poisson counts cannot be reflected)
+    controlTrials: if positive, the total population at the last step
+                   shared by the regimens is used as a control variate; its
+                   mean is estimated from this many extra trials, which only
+                   simulate those shared steps
+    numWorkers, chunkSize: see runTrials()
+
+    returns: a RegimenComparison
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    if baseline is None:
+        baseline = sorted(regimens)[0]
+    if baseline not in regimens:
+        raise ValueError("unknown baseline regimen: %s" % baseline)
+    if antithetic and issubclass(scenario.patientClass, GenotypePatient):
+        raise ValueError("antithetic trials need a patient class drawing "
+                         "uniform numbers, not %s"
+                         % scenario.patientClass.__name__)
+    options = {"synchronized": synchronized, "antithetic": antithetic}
+    chunks = list(_mapChunks(_runRegimenChunk,
+                             (scenario, regimens, seed, options),
+                             _chunks(numTrials, chunkSize, numWorkers),
+                             numWorkers))
+    totals = dict((name, numpy.concatenate([chunk[0][name]
+                                            for chunk in chunks]))
+                  for name in regimens)
+    resists = None
+    if scenario.resistDrugs is not None:
+        resists = dict((name, numpy.concatenate([chunk[1][name]
+                                                 for chunk in chunks]))
+                       for name in regimens)
+    controls = numpy.concatenate([chunk[2] for chunk in chunks])
+    controlSample = None
+    if controlTrials > 0:
+        # independent of the paired trials: trial indices from numTrials on
+        controlSample = numpy.concatenate(list(_mapChunks(
+            _runControlChunk, (scenario, regimens, seed, options),
+            [(numTrials + start, numTrials + stop) for start, stop
+             in _chunks(controlTrials, chunkSize, numWorkers)],
+            numWorkers)))
+    return RegimenComparison(scenario, baseline, totals, resists, controls,
+                             controlSample)
+
+
+#
+# PARAMETER SWEEPS
+#
+class ResultCache(object):
+    """
+    On-disk cache of TrialSummary instances, addressed by a hash of
+    everything that determines a result: the scenario, the number of trials,
+    the seed and SIMULATOR_VERSION. When the cache grows beyond maxBytes the
+    least recently used results are evicted.
+    """
+    def __init__(self, directory, maxBytes=2 ** 30):
+        """
+        directory: the directory holding the cached results (a string)
+        maxBytes: the maximum total size of the cached results (an integer)
+        """
+        self.directory = directory
+        self.maxBytes = maxBytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def getKey(self, scenario, numTrials, seed):
+        """
+        Returns the key (a hexadecimal string) of a result.
+        """
+        description = json.dumps({"scenario": scenario.toDict(),
+                                  "numTrials": numTrials, "seed": seed,
+                                  "version": SIMULATOR_VERSION},
+                                 sort_keys=True)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        """
+        Returns the path of the file holding the result with key.
+        """
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        """
+        Returns the cached TrialSummary with key, or None. A hit marks the
+        result as recently used. A file that cannot be unpickled (truncated,
+        corrupt or written by another version of the code) is removed and
+        counts as a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                summary = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        os.utime(path, None)
+        return summary
+
+    def put(self, key, summary):
+        """
+        Stores a TrialSummary under key, then evicts the least recently used
+        results until the cache fits in maxBytes.
+        """
+        _writeAtomically(self._path(key), pickle.dumps(summary))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache fits in
+        maxBytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pickle"):
+                info = os.stat(os.path.join(self.directory, name))
+                entries.append((info.st_mtime, info.st_size, name))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        for mtime, entrySize, name in entries:
+            if size <= self.maxBytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            size -= entrySize
+
+
+def expandGrid(base, grid):
+    """
+    Expands a parameter grid into the list of its cells.
+
+    base: a dictionary accepted by Scenario.fromDict(), shared by all cells
+    grid: a dictionary mapping parameter names to lists of values. A name
+          "doses.<drug>" sets the step at which drug is added, replacing any
+          prescription of that drug in base.
+
+    returns: a list of (cell, scenario) pairs in grid order (the last
+    parameter varies fastest), where cell maps the grid parameters to the
+    values of that cell
+    """
+    names = list(grid)
+    cells = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        cell = dict(zip(names, values))
+        parameters = dict(base)
+        prescriptions = [(step, drug) for step, drug
+                         in parameters.get("prescriptions", ())]
+        for name in names:
+            if name.startswith("doses."):
+                drug = name[len("doses."):]
+                prescriptions = [(step, d) for step, d in prescriptions
+                                 if d != drug]
+                prescriptions.append((cell[name], drug))
+            else:
+                parameters[name] = cell[name]
+        parameters["prescriptions"] = sorted(prescriptions)
+        cells.append((cell, Scenario.fromDict(parameters)))
+    return cells
+
+
+def runSweep(base, grid, numTrials, seed=0, cache=None, numWorkers=1,
+             log=None):
+    """
+    Runs numTrials trials of every cell of a parameter grid (see
+    expandGrid()). Every cell uses the same seed, so cells are compared on
+    common random numbers. Cells found in the cache are not recomputed, and
+    computed cells are added to it.
+
+    numTrials: number of trials per cell (an integer)
+    seed: the seed of every cell (an integer)
+    cache: a ResultCache, or None
+    numWorkers: number of worker processes each cell is run on
+    log: if given, a function called with a line of text after every cell
+
+    returns: a list of (cell, TrialSummary) pairs in grid order
+    """
+    results = []
+    for cell, scenario in expandGrid(base, grid):
+        summary = None
+        if cache is not None:
+            key = cache.getKey(scenario, numTrials, seed)
+            summary = cache.get(key)
+        status = "cached"
+        if summary is None:
+            status = "computed"
+            summary = runTrials(scenario, numTrials, seed, numWorkers)
+            if cache is not None:
+                cache.put(key, summary)
+        if log is not None:
+            log("%s %s: %d cured" % (status, json.dumps(cell, sort_keys=True),
+                                     summary.getCured()))
+        results.append((cell, summary))
+    return results
+
+
+#
+# DISTRIBUTED RUNS
+#
+class Coordinator(object):
+    """
+    Runs the trials of scenarios on workers that may be on other hosts (see
+    runWorker()). The coordinator listens on a socket; workers connect,
+    authenticate with a shared key and are handed chunks of trials (trial
+    index ranges, see _chunks()) one at a time. Trial t is seeded with
+    trialSeed(seed, t) and the chunk summaries are merged in chunk order, so
+    the result is exactly the one runTrials() returns with the same seed,
+    whichever workers ran the chunks.
+
+    While running a chunk, a worker sends a heartbeat every timeout / 4
+    seconds. A chunk whose worker disconnects, or is not heard from for
+    timeout seconds, is handed to another worker; the silent worker is
+    dropped. A chunk that raises an exception on its worker fails its run.
+
+    Messages are pickled, so the key must be kept secret and only trusted
+    hosts should be able to connect. Without a key, a random one is
+    generated (see getAuthkey()).
+    """
+    def __init__(self, address=("localhost", 0), authkey=None,
+                 timeout=60.0):
+        """
+        Starts listening for workers.
+
+        address: the (host, port) to listen on; port 0 picks a free port
+        authkey: the key shared with the workers (bytes), or None to
+                 generate a random key
+        timeout: the time a worker running a chunk may stay silent (seconds)
+        """
+        if authkey is None:
+            authkey = os.urandom(16).hex().encode("ascii")
+        self.authkey = authkey
+        self.listener = multiprocessing.connection.Listener(address,
+                                                            authkey=authkey)
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.queue = collections.deque()
+        self.runs = {}
+        self.numRuns = 0
+        self.numWorkers = 0
+        self.closed = False
+        self.acceptor = threading.Thread(target=self._accept, daemon=True)
+        self.acceptor.start()
+
+    def getAddress(self):
+        """
+        Returns the (host, port) workers connect to.
+        """
+        return self.listener.address
+
+    def getAuthkey(self):
+        """
+        Returns the key workers authenticate with (bytes).
+        """
+        return self.authkey
+
+    def _accept(self):
+        """
+        Accepts worker connections, serving each on its own thread, until
+        the coordinator is closed.
+        """
+        while True:
+            try:
+                connection = self.listener.accept()
+            except multiprocessing.AuthenticationError:
+                continue
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(connection,),
+                             daemon=True).start()
+
+    def _nextTask(self):
+        """
+        Waits for a chunk to run and returns it as (run, index), or returns
+        None once the coordinator is closed.
+        """
+        with self.condition:
+            while True:
+                if self.closed:
+                    return None
+                while self.queue:
+                    run, index = self.queue.popleft()
+                    # skip chunks another worker has finished meanwhile, and
+                    # the chunks of failed runs
+                    if (run in self.runs and
+                            self.runs[run]["error"] is None and
+                            index not in self.runs[run]["results"]):
+                        return run, index
+                self.condition.wait()
+
+    def _serve(self, connection):
+        """
+        Hands chunks to one worker until it is lost or the coordinator is
+        closed.
+        """
+        with self.condition:
+            self.numWorkers += 1
+        try:
+            while True:
+                task = self._nextTask()
+                if task is None:
+                    connection.send(("close",))
+                    return
+                run, index = task
+                values = self.runs.get(run)
+                if values is None:
+                    # the run failed meanwhile
+                    continue
+                start, stop = values["chunks"][index]
+                try:
+                    connection.send(("chunk", run, index, values["scenario"],
+                                     values["seed"], start, stop,
+                                     SIMULATOR_VERSION, self.timeout / 4))
+                    while True:
+                        if not connection.poll(self.timeout):
+                            raise EOFError("timed out")
+                        message = connection.recv()
+                        if message[0] != "heartbeat":
+                            break
+                except (EOFError, OSError):
+                    with self.condition:
+                        self.queue.appendleft(task)
+                        self.condition.notify_all()
+                    return
+                with self.condition:
+                    if run not in self.runs:
+                        # the run failed while this chunk was running
+                        continue
+                    if message[0] == "error":
+                        if values["error"] is None:
+                            values["error"] = ("chunk %d failed on a "
+                                               "worker:\n%s"
+                                               % (index, message[3]))
+                    elif index not in values["results"]:
+                        values["results"][index] = message[3]
+                    self.condition.notify_all()
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.condition:
+                self.numWorkers -= 1
+            connection.close()
+
+    def runTrials(self, scenario, numTrials, seed=None, chunkSize=None):
+        """
+        Runs numTrials trials of a scenario on the connected workers (waiting
+        for workers to connect if there are none) and returns their
+        TrialSummary, see runTrials(). Raises a RuntimeError if a chunk
+        fails on a worker.
+        """
+        if seed is None:
+            seed = random.getrandbits(64)
+        with self.condition:
+            chunks = _chunks(numTrials, chunkSize, max(1, self.numWorkers))
+            run = self.numRuns
+            self.numRuns += 1
+            self.runs[run] = {"scenario": scenario.toDict(), "seed": seed,
+                              "chunks": chunks, "results": {}, "error": None}
+            self.queue.extend((run, index) for index in range(len(chunks)))
+            self.condition.notify_all()
+            while len(self.runs[run]["results"]) < len(chunks):
+                if self.closed:
+                    self.runs.pop(run)
+                    raise RuntimeError("the coordinator was closed")
+                if self.runs[run]["error"] is not None:
+                    raise RuntimeError(self.runs.pop(run)["error"])
+                self.condition.wait()
+            results = self.runs.pop(run)["results"]
+        summary = scenario.makeSummary()
+        for index in range(len(chunks)):
+            summary.merge(results[index])
+        return summary
+
+    def close(self):
+        """
+        Stops listening and tells the connected workers to exit.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.listener.close()
+
+
+def _sendHeartbeats(send, finished, interval):
+    """
+    Calls send(("heartbeat",)) every interval seconds until the finished
+    event is set or the connection is lost.
+    """
+    while not finished.wait(interval):
+        try:
+            send(("heartbeat",))
+        except (EOFError, OSError):
+            return
+
+
+def runWorker(address, authkey):
+    """
+    Connects to a Coordinator and runs the chunks of trials it hands out
+    until it closes or the connection is lost. An exception raised by a
+    chunk (e.g. an invalid scenario, or a coordinator running another
+    SIMULATOR_VERSION) is sent back to the coordinator, and the worker
+    goes on with the next chunk.
+
+    address: the (host, port) of the coordinator
+    authkey: the key shared with the coordinator (bytes)
+
+    returns: the number of chunks run (an integer)
+    """
+    connection = multiprocessing.connection.Client(tuple(address),
+                                                   authkey=authkey)
+    lock = threading.Lock()
+
+    def send(message):
+        with lock:
+            connection.send(message)
+
+    done = 0
+    scenarios = {}
+    try:
+        while True:
+            message = connection.recv()
+            if message[0] == "close":
+                return done
+            run, index, values, seed, start, stop, version, interval = \
+                message[1:]
+            finished = threading.Event()
+            heartbeats = threading.Thread(target=_sendHeartbeats,
+                                          args=(send, finished, interval),
+                                          daemon=True)
+            heartbeats.start()
+            try:
+                if version != SIMULATOR_VERSION:
+                    raise ValueError("the coordinator runs simulator version "
+                                     "%s, this worker %s"
+                                     % (version, SIMULATOR_VERSION))
+                if run not in scenarios:
+                    scenarios[run] = Scenario.fromDict(values)
+                result = ("result", run, index,
+                          _runChunk(scenarios[run], seed, start, stop))
+            except Exception:
+                result = ("error", run, index, traceback.format_exc())
+            finally:
+                finished.set()
+                heartbeats.join()
+            send(result)
+            done += 1
+    except (EOFError, OSError):
+        return done
+    finally:
+        connection.close()
+
+
+#
+# PLOTTING
+#
+def plotSummary(summary, title, totalLabel="Total virus population",
+                resistLabel="Resistant virus population", grid=True,
+                path=None):
+    """
+    Plots the average virus population size (and the average resistant
+    population, if it was recorded) of a TrialSummary as a function of time.
+    matplotlib is only imported when this function is called.
+
+    summary: the TrialSummary to plot
+    title: the title of the graph (a string)
+    totalLabel, resistLabel: the legend labels of the two series (strings)
+    grid: whether to draw a grid (a boolean)
+    path: if given, the graph is saved to this file instead of being shown
+    """
+    import pylab
+    steps = range(0, summary.numSteps)
+    pylab.plot(steps, summary.getMeanTotals(), label=totalLabel)
+    if summary.getMeanResists() is not None:
+        pylab.plot(steps, summary.getMeanResists(), label=resistLabel)
+    pylab.title(title)
+    pylab.xlabel("Time steps")
+    pylab.ylabel("Number of virus particles")
+    pylab.legend(loc="best")
+    if grid:
+        pylab.grid()
+    if path is None:
+        pylab.show()
+    else:
+        pylab.savefig(path)
+        pylab.close()
+
+
+#
+# BENCHMARKS
+#
+UNTREATED_CLASSES = {TreatedPatient: Patient, ArrayTreatedPatient: ArrayPatient,
+                     GenotypeTreatedPatient: GenotypePatient,
+                     HybridTreatedPatient: HybridPatient,
+                     JitTreatedPatient: JitPatient}
+
+
+def _benchmarkPatient(patientClass, maxPop, numDrugs):
+    """
+    Returns a patient for the benchmarks: maxPop / 2 particles resistant to
+    numDrugs drugs, all of which are prescribed, so that every phase of
+    update() (clearance, reproduction, mutation) does work.
+    """
+    resistances = dict(("drug%d" % d, True) for d in range(numDrugs))
+    virus = ResistantVirus(0.1, 0.05, resistances, 0.005)
+    patient = patientClass([virus] * max(1, maxPop // 2), maxPop)
+    for drug in resistances:
+        patient.addPrescription(drug)
+    return patient
+
+
+def _peakMemory(function, setup=None):
+    """
+    Calls function() and returns the peak memory (in bytes) allocated during
+    the call, as traced by tracemalloc. If setup is given, function is
+    called with the value returned by setup() instead, and the peak counts
+    from the end of setup(): the memory its value holds is included, the
+    memory it only used while running is not.
+    """
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        if setup is None:
+            function()
+        else:
+            value = setup()
+            tracemalloc.reset_peak()
+            function(value)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmarkUpdate(patientClass, maxPop, numDrugs, numSteps=5, repeats=3):
+    """
+    Measures update() and getResistPop() of a patient class.
+
+    returns: a dictionary of two results, "update" and "resistPop". Each
+    result is a dictionary with the "latency" per call in seconds (the best
+    of repeats runs), the "throughput" in particle updates (or queries) per
+    second and the "peakMemory" in bytes: the patient and what one update()
+    allocates, not what building the patient took.
+    """
+    drugs = ["drug%d" % d for d in range(numDrugs)]
+    stepTimes = []
+    queryTimes = []
+    particles = 0
+    for r in range(repeats):
+        random.seed(r)
+        patient = _benchmarkPatient(patientClass, maxPop, numDrugs)
+        for a in range(numSteps):
+            particles += patient.getTotalPop()
+            start = time.perf_counter()
+            patient.update()
+            stepTimes.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            patient.getResistPop(drugs)
+            queryTimes.append(time.perf_counter() - start)
+
+    def setup():
+        return _benchmarkPatient(patientClass, maxPop, numDrugs)
+
+    def oneStep(patient):
+        patient.update()
+    memory = _peakMemory(oneStep, setup)
+    return {"update": {"latency": min(stepTimes),
+                       "throughput": particles / sum(stepTimes),
+                       "peakMemory": memory},
+            "resistPop": {"latency": min(queryTimes),
+                          "throughput": len(queryTimes) / sum(queryTimes),
+                          "peakMemory": memory}}
+
+
+def benchmarkSimulation(computeFunction, patientClass, maxPop, numTrials):
+    """
+    Measures one of the compute* simulation drivers, run with the example
+    parameters of its problem.
+
+    returns: a dictionary with the "latency" per trial in seconds, the
+    "throughput" in particle updates per second and the "peakMemory" of a
+    single trial in bytes.
+    """
+    if computeFunction is computeWithoutDrug:
+        def run(trials):
+            return computeWithoutDrug(15, maxPop, 0.5, 0.2, trials,
+                                      UNTREATED_CLASSES[patientClass], seed=0)
+    else:
+        def run(trials):
+            return computeFunction(15, maxPop, 0.2, 0.15,
+                                   {"guttagonol": False, "grimpex": False},
+                                   0.01, trials, patientClass, seed=0)
+    start = time.perf_counter()
+    summary = run(numTrials)
+    elapsed = time.perf_counter() - start
+    return {"latency": elapsed / numTrials,
+            "throughput": int(summary.totals.sum()) / elapsed,
+            "peakMemory": _peakMemory(lambda: run(1))}
+
+
+def runBenchmarks(patientClasses=(TreatedPatient, ArrayTreatedPatient,
+                                  GenotypeTreatedPatient),
+                  maxPops=(10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6),
+                  numDrugs=(1, 4), numTrials=(10,), simulationMaxPop=1000,
+                  numSteps=5, log=None):
+    """
+    Runs the benchmark suite: update() and getResistPop() for every patient
+    class, maxPop and number of drugs, and the three simulation drivers for
+    every patient class and number of trials.
+
+    log: if given, a function called with a line of text after every case
+
+    returns: a dictionary mapping case names (strings) to results, see
+    benchmarkUpdate() and benchmarkSimulation()
+    """
+    results = {}
+    for patientClass in patientClasses:
+        for maxPop in maxPops:
+            for drugs in numDrugs:
+                cases = benchmarkUpdate(patientClass, maxPop, drugs, numSteps)
+                for kind in cases:
+                    name = "%s/%s/maxPop=%d/drugs=%d" % (
+                        kind, patientClass.__name__, maxPop, drugs)
+                    results[name] = cases[kind]
+                    if log is not None:
+                        log(formatBenchmark(name, cases[kind]))
+        for computeFunction in (computeWithoutDrug, computeWithDrug,
+                                computeWithDrugs):
+            for trials in numTrials:
+                if computeFunction is computeWithoutDrug:
+                    className = UNTREATED_CLASSES[patientClass].__name__
+                else:
+                    className = patientClass.__name__
+                name = "%s/%s/maxPop=%d/trials=%d" % (
+                    computeFunction.__name__, className, simulationMaxPop,
+                    trials)
+                results[name] = benchmarkSimulation(
+                    computeFunction, patientClass, simulationMaxPop, trials)
+                if log is not None:
+                    log(formatBenchmark(name, results[name]))
+    return results
+
+
+def formatBenchmark(name, result):
+    """
+    Returns a line of text describing one benchmark result.
+    """
+    return "%-60s %12.3f ms %14.0f /s %10.1f MiB" % (
+        name, 1000 * result["latency"], result["throughput"],
+        result["peakMemory"] / 1048576.0)
+
+
+def compareBenchmarks(results, baseline, threshold=0.25):
+    """
+    Compares benchmark results to a baseline.
+
+    results, baseline: dictionaries as returned by runBenchmarks()
+    threshold: the tolerated relative slowdown (a float, 0.25 is 25%)
+
+    returns: a list of (name, baselineLatency, latency) tuples, one for every
+    case present in both whose latency grew by more than threshold
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]["latency"]
+        new = results[name]["latency"]
+        if new > old * (1 + threshold):
+            regressions.append((name, old, new))
+    return regressions
+
+
+#
+# COMMAND LINE
+#
+def runConfig(config, outputDir, plot=False, store=False, coordinator=None):
+    """
+    Runs every scenario of a configuration and writes one .npz file of
+    results (see TrialSummary.getArrays()) per scenario to outputDir.
+
+    config: a dictionary with a "scenarios" list. Every scenario is a
+    dictionary accepted by Scenario.fromDict() plus a "name" and a
+    "numTrials". "seed" and "numWorkers" can be set for the whole
+    configuration or per scenario. If a scenario sets "ciWidth" (and
+    optionally "meanWidth"), trials are added until the cure fraction is
+    estimated that precisely, with numTrials as the maximum (see
+    estimateCureRate()).
+
+    outputDir: the directory the results are written to (a string)
+    plot: whether to also save a graph of every scenario as a .png file
+    store: whether to also save the trajectories of every scenario as a .trj
+           TrajectoryStore
+    coordinator: if given, a Coordinator the trials are run on instead of
+                 local worker processes (scenarios may not set "ciWidth" and
+                 store must be False)
+
+    returns: a dictionary mapping scenario names to TrialSummary instances
+    """
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+    if plot:
+        import matplotlib
+        matplotlib.use("Agg")
+    summaries = {}
+    for i, values in enumerate(config["scenarios"]):
+        values = dict(values)
+        name = values.pop("name", "scenario%d" % i)
+        numTrials = values.pop("numTrials")
+        seed = values.pop("seed", config.get("seed"))
+        numWorkers = values.pop("numWorkers", config.get("numWorkers", 1))
+        ciWidth = values.pop("ciWidth", None)
+        meanWidth = values.pop("meanWidth", None)
+        scenario = Scenario.fromDict(values)
+        if coordinator is not None and (store or ciWidth is not None):
+            raise ValueError("distributed runs support neither trajectory "
+                             "stores nor ciWidth")
+        trajectories = None
+        if store:
+            if seed is None:
+                seed = random.getrandbits(64)
+            trajectories = TrajectoryStore.forScenario(
+                os.path.join(outputDir, name + ".trj"), scenario,
+                {"seed": seed}, numTrials)
+        if coordinator is not None:
+            summary = coordinator.runTrials(scenario, numTrials, seed)
+        elif ciWidth is None:
+            summary = runTrials(scenario, numTrials, seed, numWorkers,
+                                store=trajectories)
+        else:
+            summary = estimateCureRate(scenario, ciWidth, meanWidth,
+                                       maxTrials=numTrials, seed=seed,
+                                       numWorkers=numWorkers,
+                                       store=trajectories)
+        if trajectories is not None:
+            trajectories.close()
+        numpy.savez(os.path.join(outputDir, name + ".npz"),
+                    scenario=json.dumps(scenario.toDict()),
+                    **summary.getArrays())
+        if plot:
+            plotSummary(summary, name,
+                        path=os.path.join(outputDir, name + ".png"))
+        summaries[name] = summary
+    return summaries
+
+
+def main(argv=None):
+    """
+    Command line entry point, run as: python -m ps8b <command> ...
+
+    returns: the exit status (an integer)
+    """
+    parser = argparse.ArgumentParser(
+        prog="ps8b", description="Virus population dynamics simulations.")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser(
+        "run", help="run the scenarios of a JSON configuration file")
+    command.add_argument("config", help="the JSON configuration file")
+    command.add_argument("-o", "--output", default="results",
+                         help="the directory results are written to")
+    command.add_argument("--seed", type=int,
+                         help="override the seed of the configuration")
+    command.add_argument("--workers", type=int,
+                         help="override the number of worker processes")
+    command.add_argument("--plot", action="store_true",
+                         help="also save a graph of every scenario")
+    command.add_argument("--store", action="store_true",
+                         help="also save the trajectories of every trial")
+
+    command = commands.add_parser(
+        "serve", help="run the scenarios of a JSON configuration file on "
+        "remote workers (see the work command)")
+    command.add_argument("config", help="the JSON configuration file")
+    command.add_argument("-o", "--output", default="results",
+                         help="the directory results are written to")
+    command.add_argument("--seed", type=int,
+                         help="override the seed of the configuration")
+    command.add_argument("--address", default="localhost:0",
+                         help="the host:port to listen on for workers")
+    command.add_argument("--authkey",
+                         default=os.environ.get("PS8B_AUTHKEY"),
+                         help="the key shared with the workers (default: "
+                         "$PS8B_AUTHKEY, or a random key that is printed)")
+    command.add_argument("--timeout", type=float, default=60.0,
+                         help="seconds a worker may stay silent before its "
+                         "chunk is reassigned")
+
+    command = commands.add_parser(
+        "work", help="run trials for a coordinator started by serve")
+    command.add_argument("address", help="the host:port of the coordinator")
+    command.add_argument("--authkey",
+                         default=os.environ.get("PS8B_AUTHKEY"),
+                         help="the key printed by serve (default: "
+                         "$PS8B_AUTHKEY)")
+    command.add_argument("--processes", type=int, default=1,
+                         help="the number of worker processes to start")
+
+    command = commands.add_parser(
+        "bench", help="run the benchmark suite")
+    command.add_argument("--classes", nargs="+",
+                         default=["TreatedPatient", "ArrayTreatedPatient",
+                                  "GenotypeTreatedPatient"],
+                         help="the patient classes to benchmark")
+    command.add_argument("--max-pop", type=int, nargs="+",
+                         default=[10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6],
+                         help="the values of maxPop to sweep")
+    command.add_argument("--drugs", type=int, nargs="+", default=[1, 4],
+                         help="the numbers of drugs to sweep")
+    command.add_argument("--trials", type=int, nargs="+", default=[10],
+                         help="the numbers of trials of the driver benchmarks")
+    command.add_argument("--steps", type=int, default=5,
+                         help="the number of update() calls per repeat")
+    command.add_argument("-o", "--output",
+                         help="write the results to this JSON file")
+    command.add_argument("--baseline",
+                         help="compare the results to this JSON file")
+    command.add_argument("--threshold", type=float, default=0.25,
+                         help="the tolerated relative slowdown")
+
+    command = commands.add_parser(
+        "sweep", help="run a parameter grid of a JSON configuration file")
+    command.add_argument("config", help="the JSON configuration file, with "
+                         "\"base\", \"grid\", \"numTrials\" and \"seed\"")
+    command.add_argument("-o", "--output", default="sweep",
+                         help="the directory results are written to")
+    command.add_argument("--cache", default=".ps8b-cache",
+                         help="the directory of the result cache")
+    command.add_argument("--cache-size", type=int, default=1024,
+                         help="the maximum size of the cache in MiB")
+    command.add_argument("--workers", type=int, default=1,
+                         help="the number of worker processes")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        with open(args.config) as f:
+            config = json.load(f)
+        if args.seed is not None:
+            config["seed"] = args.seed
+        if args.workers is not None:
+            config["numWorkers"] = args.workers
+        summaries = runConfig(config, args.output, args.plot, args.store)
+        for name in summaries:
+            summary = summaries[name]
+            print("%s: %d trials, %d cured" % (name, summary.getNumTrials(),
+                                               summary.getCured()))
+        return 0
+    if args.command == "serve":
+        with open(args.config) as f:
+            config = json.load(f)
+        if args.seed is not None:
+            config["seed"] = args.seed
+        host, port = args.address.rsplit(":", 1)
+        authkey = None
+        if args.authkey is not None:
+            authkey = args.authkey.encode("utf-8")
+        coordinator = Coordinator((host, int(port)), authkey, args.timeout)
+        print("listening on %s:%d" % coordinator.getAddress())
+        if authkey is None:
+            print("authkey: %s" % coordinator.getAuthkey().decode("ascii"))
+        sys.stdout.flush()
+        try:
+            summaries = runConfig(config, args.output,
+                                  coordinator=coordinator)
+        finally:
+            coordinator.close()
+        for name in summaries:
+            summary = summaries[name]
+            print("%s: %d trials, %d cured" % (name, summary.getNumTrials(),
+                                               summary.getCured()))
+        return 0
+    if args.command == "work":
+        if args.authkey is None:
+            parser.error("work needs --authkey or $PS8B_AUTHKEY")
+        host, port = args.address.rsplit(":", 1)
+        address = (host, int(port))
+        authkey = args.authkey.encode("utf-8")
+        workers = [multiprocessing.Process(target=runWorker,
+                                           args=(address, authkey))
+                   for i in range(args.processes - 1)]
+        for worker in workers:
+            worker.start()
+        done = runWorker(address, authkey)
+        for worker in workers:
+            worker.join()
+        print("this process ran %d chunks" % done)
+        return 0
+    if args.command == "sweep":
+        with open(args.config) as f:
+            config = json.load(f)
+        cache = ResultCache(args.cache, args.cache_size * 1048576)
+        results = runSweep(config["base"], config["grid"],
+                           config["numTrials"], config.get("seed", 0), cache,
+                           args.workers, log=print)
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        index = []
+        for i in range(len(results)):
+            cell, summary = results[i]
+            name = "cell%d.npz" % i
+            numpy.savez(os.path.join(args.output, name), **summary.getArrays())
+            index.append({"cell": cell, "file": name})
+        with open(os.path.join(args.output, "index.json"), "w") as f:
+            json.dump(index, f, indent=1)
+        return 0
+    if args.command == "bench":
+        for name in args.classes:
+            if PATIENT_CLASSES.get(name) not in UNTREATED_CLASSES:
+                parser.error("not a treated patient class: %s" % name)
+        results = runBenchmarks([PATIENT_CLASSES[name]
+                                 for name in args.classes],
+                                args.max_pop, args.drugs, args.trials,
+                                numSteps=args.steps, log=print)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compareBenchmarks(results, baseline, args.threshold)
+            for name, old, new in regressions:
+                print("REGRESSION %s: %.3f ms -> %.3f ms" % (
+                    name, 1000 * old, 1000 * new))
+            if regressions:
+                return 1
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == "__main__":
+    # re-import under the module's own name, so that worker processes unpickle
+    # ps8b.Scenario rather than __main__.Scenario
+    import ps8b
+    sys.exit(ps8b.main())
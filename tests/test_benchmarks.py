@@ -0,0 +1,28 @@
+import ps8b
+
+
+def test_benchmarkUpdateReportsEveryMeasure():
+    results = ps8b.benchmarkUpdate(ps8b.ArrayTreatedPatient, 1000, 2,
+                                   numSteps=2, repeats=1)
+    for kind in ("update", "resistPop"):
+        assert results[kind]["latency"] > 0
+        assert results[kind]["throughput"] > 0
+        assert results[kind]["peakMemory"] > 0
+        assert ps8b.formatBenchmark(kind, results[kind]).startswith(kind)
+
+
+def test_peakMemoryExcludesSetup():
+    def setup():
+        return len(bytearray(10 ** 7))
+
+    def call(value):
+        return bytearray(value // 10)
+    assert ps8b._peakMemory(lambda: call(setup())) >= 10 ** 7
+    assert 10 ** 6 <= ps8b._peakMemory(call, setup) < 2 * 10 ** 6
+
+
+def test_compareBenchmarksFlagsSlowdowns():
+    baseline = {"a": {"latency": 1.0}, "b": {"latency": 1.0}}
+    results = {"a": {"latency": 1.2}, "b": {"latency": 1.5},
+               "c": {"latency": 9.0}}
+    assert ps8b.compareBenchmarks(results, baseline) == [("b", 1.0, 1.5)]
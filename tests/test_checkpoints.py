@@ -0,0 +1,100 @@
+import os
+import random
+
+import pytest
+
+import ps8b
+
+PATIENT_CLASSES = (ps8b.TreatedPatient, ps8b.ArrayTreatedPatient,
+                   ps8b.GenotypeTreatedPatient, ps8b.HybridTreatedPatient)
+
+
+def makeScenario(patientClass, prescriptions=()):
+    options = {}
+    if issubclass(patientClass, ps8b.HybridPatient):
+        options["threshold"] = 500
+    return ps8b.Scenario(50, 1000, 0.1, 0.05,
+                         {"guttagonol": False, "grimpex": False}, 0.01,
+                         numSteps=120, prescriptions=prescriptions,
+                         resistDrugs=["guttagonol"], patientClass=patientClass,
+                         patientOptions=options)
+
+
+def advance(patient, numSteps):
+    return [(patient.update(), patient.getResistPop(["guttagonol"]))
+            for step in range(numSteps)]
+
+
+def test_snapshotAndForkContinueIdentically(tmp_path):
+    for patientClass in PATIENT_CLASSES:
+        random.seed(3)
+        patient = makeScenario(patientClass).makePatient()
+        patient.addPrescription("grimpex")
+        advance(patient, 30)
+        path = str(tmp_path / "patient.npz")
+        ps8b.saveCheckpoint(patient, path)
+        copies = [ps8b.restorePatient(ps8b.snapshotPatient(patient)),
+                  ps8b.loadCheckpoint(path), ps8b.forkPatient(patient)]
+        expected = advance(patient, 40)
+        for copy in copies:
+            assert type(copy) is patientClass
+            assert copy.getPrescriptions() == ["grimpex"]
+            assert advance(copy, 40) == expected, patientClass.__name__
+
+
+def test_antitheticStreamSurvivesSnapshot():
+    for patientClass in (ps8b.TreatedPatient, ps8b.ArrayTreatedPatient):
+        random.seed(5)
+        patient = makeScenario(patientClass).makePatient(
+            ps8b.RandomStream(antithetic=True))
+        advance(patient, 20)
+        copy = ps8b.restorePatient(ps8b.snapshotPatient(patient))
+        assert advance(copy, 30) == advance(patient, 30), \
+            patientClass.__name__
+
+
+def test_branchesMatchRunTrials():
+    branches = {"early": [(40, "guttagonol")], "late": [(80, "guttagonol")],
+                "none": []}
+    for patientClass in PATIENT_CLASSES:
+        scenario = makeScenario(patientClass)
+        summaries = ps8b.runTreatmentBranches(scenario, branches, 6, seed=7,
+                                              chunkSize=4)
+        for name in branches:
+            expected = ps8b.runTrials(
+                makeScenario(patientClass, branches[name]), 6, seed=7)
+            assert (summaries[name].totals == expected.totals).all(), name
+            assert (summaries[name].resists == expected.resists).all(), name
+            assert summaries[name].cured == expected.cured
+
+
+def test_interruptedRunResumesFromItsCheckpoint(tmp_path, monkeypatch):
+    scenario = makeScenario(ps8b.TreatedPatient, [(60, "guttagonol")])
+    expected = ps8b.runTrials(scenario, 10, seed=9, chunkSize=2)
+    checkpoint = str(tmp_path / "run.checkpoint")
+    runChunks = ps8b._runChunks
+
+    def interrupted(*args):
+        for done, summary in enumerate(runChunks(*args)):
+            if done == 3:
+                raise KeyboardInterrupt
+            yield summary
+    monkeypatch.setattr(ps8b, "_runChunks", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        ps8b.runTrials(scenario, 10, seed=9, chunkSize=2,
+                       checkpoint=checkpoint)
+    assert os.path.exists(checkpoint)
+
+    computed = []
+
+    def counted(scenario, seed, chunks, numWorkers, store=None):
+        computed.extend(chunks)
+        return runChunks(scenario, seed, chunks, numWorkers, store)
+    monkeypatch.setattr(ps8b, "_runChunks", counted)
+    summary = ps8b.runTrials(scenario, 10, seed=9, chunkSize=2,
+                             checkpoint=checkpoint)
+    assert computed == [(6, 8), (8, 10)]
+    assert (summary.totals == expected.totals).all()
+    assert (summary.resists == expected.resists).all()
+    assert summary.getNumTrials() == 10
+    assert not os.path.exists(checkpoint)
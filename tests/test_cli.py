@@ -0,0 +1,53 @@
+import json
+import os
+
+import numpy
+
+import ps8b
+from test_runner import runScript
+
+CONFIG = {"seed": 4, "scenarios": [
+    {"name": "treated", "numTrials": 3, "numViruses": 20, "maxPop": 200,
+     "maxBirthProb": 0.1, "clearProb": 0.05, "mutProb": 0.01,
+     "numSteps": 40, "resistances": {"guttagonol": False},
+     "prescriptions": [[20, "guttagonol"]], "resistDrugs": ["guttagonol"]}]}
+
+# Run in a fresh interpreter, where nothing has imported matplotlib yet.
+HEADLESS_SCRIPT = """
+import sys
+import ps8b
+
+status = ps8b.main(["run", %r, "-o", %r])
+ps8b.computeWithDrug(10, 100, 0.1, 0.05, {"guttagonol": False}, 0.005, 1,
+                     seed=0)
+print(status, "matplotlib" in sys.modules)
+"""
+
+
+def test_runWritesResultsWithoutMatplotlib(tmp_path):
+    config = str(tmp_path / "config.json")
+    with open(config, "w") as f:
+        json.dump(CONFIG, f)
+    output = str(tmp_path / "results")
+    values = dict(CONFIG["scenarios"][0])
+    del values["name"], values["numTrials"]
+    expected = ps8b.runTrials(ps8b.Scenario.fromDict(values), 3, seed=4)
+    lines = runScript(HEADLESS_SCRIPT % (config, output)).splitlines()
+    assert lines == ["treated: 3 trials, %d cured" % expected.getCured(),
+                     "0 False"]
+    results = numpy.load(os.path.join(output, "treated.npz"))
+    assert int(results["numTrials"]) == 3
+    assert numpy.allclose(results["totalMean"], expected.getMeanTotals())
+    assert numpy.allclose(results["resistMean"], expected.getMeanResists())
+
+
+def test_computeMatchesRunTrials():
+    summary = ps8b.computeWithDrug(10, 100, 0.1, 0.05, {"guttagonol": False},
+                                   0.005, 2, seed=1)
+    scenario = ps8b.Scenario(10, 100, 0.1, 0.05, {"guttagonol": False},
+                             0.005, numSteps=300,
+                             prescriptions=[(150, "guttagonol")],
+                             resistDrugs=["guttagonol"])
+    expected = ps8b.runTrials(scenario, 2, seed=1)
+    assert (summary.totals == expected.totals).all()
+    assert (summary.resists == expected.resists).all()
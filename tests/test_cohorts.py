@@ -0,0 +1,48 @@
+import numpy
+import pytest
+
+import ps8b
+
+
+def makeScenario(clearProb=0.05, start=40, numSteps=80):
+    return ps8b.Scenario(50, 300, 0.1, clearProb, {"guttagonol": False},
+                         0.005, numSteps=numSteps,
+                         prescriptions=[(start, "guttagonol")],
+                         resistDrugs=["guttagonol"],
+                         patientClass=ps8b.ArrayTreatedPatient)
+
+
+def test_cohortMatchesIndependentTrials():
+    numTrials = 200
+    cohort = ps8b.runCohort([makeScenario()] * numTrials, seed=1)
+    reference = ps8b.runTrials(makeScenario(), numTrials, seed=2)
+    for mine, theirs in ((cohort.getSummary().totalStats,
+                          reference.totalStats),
+                         (cohort.getSummary().resistStats,
+                          reference.resistStats)):
+        difference = numpy.abs(mine.getMean() - theirs.getMean())
+        error = numpy.sqrt((mine.getVariance() + theirs.getVariance())
+                           / numTrials)
+        assert (difference <= 5 * error + 1e-9).all()
+
+
+def test_strataSplitTheCohort():
+    scenarios = [makeScenario(start=20)] * 6 + [makeScenario(0.9)] * 4
+    strata = ["early"] * 6 + ["cleared"] * 4
+    cohort = ps8b.runCohort(scenarios, strata, seed=3)
+    again = ps8b.runCohort(scenarios, strata, seed=3)
+    assert (cohort.getTotals() == again.getTotals()).all()
+    summaries = cohort.getStrata()
+    assert sorted(summaries) == ["cleared", "early"]
+    assert summaries["cleared"].getCured() == 4
+    assert summaries["early"].getNumTrials() == 6
+    assert (summaries["early"].totals + summaries["cleared"].totals ==
+            cohort.getSummary().totals).all()
+    assert cohort.getCureRate() == cohort.getCured().mean()
+
+
+def test_mismatchedScenariosAreRejected():
+    with pytest.raises(ValueError):
+        ps8b.runCohort([makeScenario(), makeScenario(numSteps=60)])
+    with pytest.raises(ValueError):
+        ps8b.runCohort([makeScenario()] * 2, strata=["a"])
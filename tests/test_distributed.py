@@ -0,0 +1,74 @@
+from test_runner import runScript
+
+# Run in a fresh interpreter so the workers are spawned, and their drug
+# registry and patient classes differ from the coordinator's.
+COORDINATOR_SCRIPT = """
+import multiprocessing
+import threading
+import ps8b
+
+def makeScenario(name, numSteps=120, maxPop=500, start=60):
+    return ps8b.Scenario.fromDict({
+        "numViruses": 50, "maxPop": maxPop, "maxBirthProb": 0.1,
+        "clearProb": 0.05, "mutProb": 0.02, "numSteps": numSteps,
+        "resistances": {"guttagonol": False, "grimpex": False},
+        "prescriptions": [[start, "guttagonol"]],
+        "resistDrugs": ["guttagonol"], "patientClass": name})
+
+class UnknownPatient(ps8b.TreatedPatient):
+    pass
+
+if __name__ == "__main__":
+    context = multiprocessing.get_context("spawn")
+    ps8b.drugRegistry.getMask(["zeta", "grimpex", "guttagonol"])
+    ps8b.PATIENT_CLASSES["UnknownPatient"] = UnknownPatient
+
+    coordinator = ps8b.Coordinator(timeout=0.5)
+    workers = [context.Process(target=ps8b.runWorker,
+                               args=(coordinator.getAddress(),
+                                     coordinator.getAuthkey()))
+               for i in range(2)]
+    for worker in workers:
+        worker.start()
+    try:
+        for name in ("TreatedPatient", "ArrayTreatedPatient",
+                     "GenotypeTreatedPatient"):
+            scenario = makeScenario(name)
+            local = ps8b.runTrials(scenario, 5, seed=3)
+            remote = coordinator.runTrials(scenario, 5, seed=3, chunkSize=2)
+            assert (local.totals == remote.totals).all(), name
+            assert (local.resists == remote.resists).all(), name
+
+        # the workers do not know this class: the run fails, the workers
+        # stay connected
+        try:
+            coordinator.runTrials(makeScenario("UnknownPatient"), 4, seed=3)
+        except RuntimeError as error:
+            assert "unknown patient class" in str(error)
+        else:
+            raise AssertionError("the failed run did not raise")
+        assert coordinator.numWorkers == 2
+
+        # chunks running longer than the timeout are kept alive by the
+        # heartbeats rather than reassigned
+        scenario = makeScenario("TreatedPatient", numSteps=1500, maxPop=2000,
+                                start=1499)
+        results = []
+        run = threading.Thread(target=lambda: results.append(
+            coordinator.runTrials(scenario, 4, seed=1, chunkSize=2)))
+        run.start()
+        run.join(300)
+        assert results, "the run did not finish"
+        assert (results[0].totals ==
+                ps8b.runTrials(scenario, 4, seed=1).totals).all()
+        assert coordinator.numWorkers == 2
+    finally:
+        coordinator.close()
+        for worker in workers:
+            worker.join()
+    print("ok")
+"""
+
+
+def test_coordinatorMatchesLocalRuns():
+    assert runScript(COORDINATOR_SCRIPT).strip() == "ok"
@@ -0,0 +1,67 @@
+import numpy
+
+import ps8b
+
+
+def makeScenario(patientClass, **options):
+    return ps8b.Scenario(50, 200, 0.1, 0.05,
+                         {"guttagonol": False, "grimpex": False}, 0.02,
+                         numSteps=80, prescriptions=[(40, "guttagonol")],
+                         resistDrugs=["guttagonol"], patientClass=patientClass,
+                         patientOptions=options)
+
+
+def maxZ(first, second, numTrials):
+    """
+    The largest difference of the step means of two StepStatistics, in
+    standard errors of the difference.
+    """
+    difference = numpy.abs(first.getMean() - second.getMean())
+    error = numpy.sqrt((first.getVariance() + second.getVariance())
+                       / numTrials)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return float(numpy.where(difference > 0, difference / error, 0.0).max())
+
+
+def test_enginesAgreeAtSmallMaxPop():
+    numTrials = 300
+    reference = ps8b.runTrials(makeScenario(ps8b.TreatedPatient), numTrials,
+                               seed=1)
+    for patientClass in (ps8b.ArrayTreatedPatient,
+                         ps8b.GenotypeTreatedPatient):
+        other = ps8b.runTrials(makeScenario(patientClass), numTrials, seed=2)
+        assert maxZ(reference.totalStats, other.totalStats, numTrials) < 5, \
+            patientClass.__name__
+        assert maxZ(reference.resistStats, other.resistStats,
+                    numTrials) < 5, patientClass.__name__
+
+
+
+def test_genotypeCountsMatchTheirViruses():
+    virus = ps8b.ResistantVirus(0.1, 0.05, {"guttagonol": True,
+                                            "grimpex": False}, 0.05)
+    patient = ps8b.GenotypeTreatedPatient([virus] * 100, 1000,
+                                          ps8b.RandomStream(3))
+    patient.addPrescription("guttagonol")
+    for step in range(50):
+        patient.update()
+        counts = patient.getCounts()
+        assert sum(counts.values()) == patient.getTotalPop()
+        viruses = patient.getViruses()
+        assert len(viruses) == patient.getTotalPop()
+        for drugs in (["guttagonol"], ["grimpex"], ["guttagonol", "grimpex"]):
+            assert patient.getResistPop(drugs) == sum(
+                1 for v in viruses if all(v.isResistantTo(d) for d in drugs))
+    # a few genotypes, however many particles
+    assert len(patient.getCounts()) <= 4
+
+
+def test_genotypeEngineHandlesHugePopulations():
+    genotype = ps8b.virusGenotype(ps8b.ResistantVirus(
+        0.1, 0.05, {"guttagonol": False}, 0.005))
+    patient = ps8b.GenotypeTreatedPatient.fromCounts({genotype: 10 ** 9},
+                                                     2 * 10 ** 9)
+    for step in range(100):
+        patient.update()
+    assert patient.getTotalPop() > 10 ** 8
+    assert len(patient.getCounts()) == 2
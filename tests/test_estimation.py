@@ -0,0 +1,47 @@
+import ps8b
+
+
+def makeScenario(clearProb, numSteps=100):
+    return ps8b.Scenario(20, 300, 0.1, clearProb, {"guttagonol": False},
+                         0.005, numSteps=numSteps,
+                         prescriptions=[(numSteps // 2, "guttagonol")],
+                         resistDrugs=["guttagonol"])
+
+
+class CountingPatient(ps8b.TreatedPatient):
+    updates = 0
+
+    def update(self):
+        CountingPatient.updates += 1
+        return ps8b.TreatedPatient.update(self)
+
+
+def test_extinctTrialsStopSimulating():
+    scenario = makeScenario(0.5)
+    scenario.patientClass = CountingPatient
+    CountingPatient.updates = 0
+    totals, resists = ps8b.runTrial(scenario, 1)
+    assert totals[-1] == 0
+    extinct = int((totals > 0).sum()) + 1
+    assert CountingPatient.updates == extinct < scenario.numSteps
+    assert not totals[extinct:].any() and not resists[extinct:].any()
+
+
+def test_estimateStopsAtTheTargetWidth():
+    scenario = makeScenario(0.05)
+    summary = ps8b.estimateCureRate(scenario, ciWidth=0.3, seed=2,
+                                    chunkSize=4)
+    low, high = summary.getCureInterval()
+    assert high - low <= 0.3
+    n = summary.getNumTrials()
+    assert 20 <= n < 100 and n % 4 == 0
+    # the trials are the first n trials of runTrials() with the same seed
+    expected = ps8b.runTrials(scenario, n, seed=2)
+    assert (summary.totals == expected.totals).all()
+    assert summary.getCured() == expected.getCured()
+
+
+def test_estimateStopsAtMaxTrials():
+    summary = ps8b.estimateCureRate(makeScenario(0.05), ciWidth=0.001,
+                                    maxTrials=30, seed=2, chunkSize=8)
+    assert summary.getNumTrials() == 30
@@ -0,0 +1,68 @@
+import gc
+import pickle
+
+import pytest
+
+import ps8b
+
+
+def manyDrugs(numDrugs):
+    return ps8b.Scenario(100, 1000, 0.1, 0.05,
+                         dict(("drug%d" % d, False) for d in range(numDrugs)),
+                         0.05, numSteps=60)
+
+
+def test_reproduceWithoutExceptions():
+    virus = ps8b.ResistantVirus(1.0, 0.0, {"guttagonol": False}, 0.0)
+    assert virus.tryReproduce(0.0, ["guttagonol"]) is None
+    with pytest.raises(ps8b.NoChildException):
+        virus.reproduce(0.0, ["guttagonol"])
+    child = virus.tryReproduce(0.0, [])
+    assert child.getResistances() is virus.getResistances()
+    assert not hasattr(child, "__dict__")
+
+
+def test_genotypesAreInterned():
+    first = ps8b.Genotype.intern({"a": True, "b": False})
+    second = ps8b.Genotype.intern({"b": False, "a": True})
+    assert first is second
+    assert pickle.loads(pickle.dumps(first)) is first
+    assert first.mutate(["a"]) is ps8b.Genotype.intern({"a": False,
+                                                         "b": False})
+
+
+def test_internTableStaysBoundedAcrossTrials():
+    scenario = manyDrugs(40)
+    sizes = []
+    for numTrials in (1, 5):
+        ps8b.runTrials(scenario, numTrials, seed=numTrials)
+        gc.collect()
+        sizes.append(len(ps8b.Genotype.table))
+    assert sizes[-1] <= sizes[0] + 10
+
+
+def test_mutantCachesHoldOnlyLiveGenotypes():
+    patient = manyDrugs(40).makePatient(ps8b.RandomStream(1))
+    for step in range(60):
+        patient.update()
+    live = set(v.getResistances() for v in patient.getViruses())
+    assert len(ps8b.Genotype.table) == len(live)
+    for genotype in live:
+        assert set((genotype.mutants or {}).values()) <= live
+
+
+def test_engineAcrossManyDrugWords():
+    # 70 drugs need two 64-bit words per bitmask
+    drugs = dict(("drug%d" % d, d % 3 == 0) for d in range(70))
+    scenario = ps8b.Scenario(60, 600, 0.1, 0.05, drugs, 0.02, numSteps=40,
+                             patientClass=ps8b.ArrayTreatedPatient)
+    patient = scenario.makePatient(ps8b.RandomStream(2))
+    patient.addPrescription("drug66")
+    for step in range(30):
+        patient.update()
+    state = patient.getState()
+    for drug in ("drug0", "drug66", "drug68", "drug69"):
+        column = state["traitNames"].index(drug)
+        resistant = state["genes"][state["particles"], column] == 2
+        assert patient.getResistPop([drug]) == resistant.sum(), drug
+    assert 0 < patient.getResistPop(["drug69"]) < patient.getTotalPop()
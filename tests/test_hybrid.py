@@ -0,0 +1,34 @@
+import pytest
+
+import ps8b
+
+
+def makeScenario(threshold=500, mutProb=0.005):
+    return ps8b.Scenario(50, 2000, 0.1, 0.05, {"guttagonol": False},
+                         mutProb, numSteps=80,
+                         patientClass=ps8b.HybridTreatedPatient,
+                         patientOptions={"threshold": threshold})
+
+
+def test_hybridMatchesExactModel():
+    result = ps8b.validateApproximation(makeScenario(), numTrials=100)
+    assert result["maxZ"] < 5
+
+
+def test_hybridRejectsBiasedThreshold():
+    with pytest.raises(ValueError):
+        makeScenario(threshold=ps8b.HybridPatient.MIN_THRESHOLD - 1
+                     ).makePatient()
+
+
+def test_hybridCountsAndTimesMutations():
+    patient = makeScenario(mutProb=0.05).makePatient(ps8b.RandomStream(1))
+    counters = ps8b.UpdateCounters()
+    patient.setCounters(counters)
+    for step in range(80):
+        patient.update()
+    totals = counters.getTotals()
+    # the mean-field flows produce 5% of the births as mutants
+    assert totals["mutations"]["guttagonol"] > 0.02 * totals["births"]
+    assert totals["mutation"] > 0
+    assert totals["reproduction"] >= 0
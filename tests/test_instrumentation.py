@@ -0,0 +1,56 @@
+import ps8b
+
+PATIENT_CLASSES = (ps8b.TreatedPatient, ps8b.ArrayTreatedPatient,
+                   ps8b.GenotypeTreatedPatient)
+
+
+def makePatient(patientClass, seed):
+    scenario = ps8b.Scenario(50, 500, 0.1, 0.05,
+                             {"guttagonol": False, "grimpex": True}, 0.02,
+                             patientClass=patientClass)
+    return scenario.makePatient(ps8b.RandomStream(seed))
+
+
+def advance(patient, numSteps):
+    """
+    Runs numSteps updates, prescribing guttagonol halfway, and returns the
+    populations.
+    """
+    populations = []
+    for step in range(numSteps):
+        if step == numSteps // 2:
+            patient.addPrescription("guttagonol")
+        populations.append(patient.update())
+    return populations
+
+
+def test_countersBalanceThePopulation():
+    for patientClass in PATIENT_CLASSES:
+        records = []
+        counters = ps8b.UpdateCounters(
+            lambda patient, record: records.append(record))
+        patient = makePatient(patientClass, 1)
+        patient.setCounters(counters)
+        population = patient.getTotalPop()
+        advance(patient, 60)
+        assert counters.getSteps() == len(records) == 60
+        for record in records:
+            assert record["population"] == (population - record["clearances"]
+                                            + record["births"])
+            population = record["population"]
+            assert min(record[phase] for phase in counters.PHASES) >= 0
+        totals = counters.getTotals()
+        assert totals["population"] == patient.getTotalPop()
+        assert totals["blocked"] > 0, patientClass.__name__
+        assert totals["births"] > 0, patientClass.__name__
+        assert set(totals["mutations"]) == {"guttagonol", "grimpex"}
+        assert "mutations of guttagonol" in counters.summary()
+
+
+def test_countersDoNotChangeTheTrial():
+    for patientClass in PATIENT_CLASSES:
+        plain = makePatient(patientClass, 2)
+        instrumented = makePatient(patientClass, 2)
+        instrumented.setCounters(ps8b.UpdateCounters())
+        assert advance(plain, 60) == advance(instrumented, 60), \
+            patientClass.__name__
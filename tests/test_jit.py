@@ -0,0 +1,56 @@
+import ps8b
+from test_runner import runScript
+
+# Run in fresh interpreters, where numba has not been imported yet.
+LAZY_SCRIPT = """
+import sys
+import ps8b
+
+before = "numba" in sys.modules
+scenario = ps8b.Scenario(20, 200, 0.1, 0.05, {"guttagonol": False}, 0.01,
+                         numSteps=5, patientClass=ps8b.JitTreatedPatient)
+ps8b.runTrials(scenario, 1, seed=0)
+print(before, "numba" in sys.modules)
+"""
+
+FALLBACK_SCRIPT = """
+import sys
+sys.modules["numba"] = None
+import ps8b
+
+def makeScenario(patientClass):
+    return ps8b.Scenario(50, 200, 0.1, 0.05, {"guttagonol": False}, 0.02,
+                         numSteps=80, prescriptions=[(40, "guttagonol")],
+                         resistDrugs=["guttagonol"], patientClass=patientClass)
+
+array = ps8b.runTrials(makeScenario(ps8b.ArrayTreatedPatient), 5, seed=4)
+jit = ps8b.runTrials(makeScenario(ps8b.JitTreatedPatient), 5, seed=4)
+assert ps8b._importNumba() is None
+assert (array.totals == jit.totals).all()
+assert (array.resists == jit.resists).all()
+print("ok")
+"""
+
+
+def makeScenario(patientClass):
+    return ps8b.Scenario(50, 200, 0.1, 0.05,
+                         {"guttagonol": False, "grimpex": False}, 0.02,
+                         numSteps=80, prescriptions=[(40, "guttagonol")],
+                         resistDrugs=["guttagonol"], patientClass=patientClass)
+
+
+def test_jitMatchesArray():
+    array = ps8b.runTrials(makeScenario(ps8b.ArrayTreatedPatient), 10, seed=4)
+    jit = ps8b.runTrials(makeScenario(ps8b.JitTreatedPatient), 10, seed=4)
+    assert (array.totals == jit.totals).all()
+    assert (array.resists == jit.resists).all()
+
+
+def test_numbaIsImportedOnTheFirstCompiledCall():
+    before, after = runScript(LAZY_SCRIPT).split()
+    assert before == "False"
+    assert after == str(ps8b._importNumba() is not None)
+
+
+def test_jitFallsBackWithoutNumba():
+    assert runScript(FALLBACK_SCRIPT).strip() == "ok"
@@ -0,0 +1,44 @@
+import pytest
+
+import ps8b
+
+REGIMENS = {"early": [(20, "guttagonol")], "late": [(50, "guttagonol")]}
+
+
+def makeScenario(prescriptions=()):
+    return ps8b.Scenario(50, 500, 0.1, 0.05, {"guttagonol": False}, 0.005,
+                         numSteps=80, prescriptions=prescriptions,
+                         resistDrugs=["guttagonol"])
+
+
+def test_regimensMatchRunTrials():
+    for antithetic in (False, True):
+        comparison = ps8b.compareRegimens(makeScenario(), REGIMENS, 8,
+                                          seed=3, antithetic=antithetic,
+                                          chunkSize=3)
+        assert comparison.getNumTrials() == 8
+        for name in REGIMENS:
+            expected = ps8b.runTrials(makeScenario(REGIMENS[name]), 8, seed=3)
+            # the first pass of every trial is the plain trial
+            totals = comparison.totals[name][:, 0]
+            assert (totals.sum(axis=0) == expected.totals).all(), name
+            resists = comparison.resists[name][:, 0]
+            assert (resists.sum(axis=0) == expected.resists).all(), name
+
+
+def test_synchronizedRegimensShareThePrefix():
+    comparison = ps8b.compareRegimens(makeScenario(), REGIMENS, 6, seed=5,
+                                      synchronized=True)
+    early = comparison.totals["early"][:, 0]
+    late = comparison.totals["late"][:, 0]
+    assert (early[:, :20] == late[:, :20]).all()
+    estimate, low, high = comparison.getCureDifference("late")
+    assert low <= estimate <= high
+
+
+def test_antitheticNeedsUniformDraws():
+    scenario = ps8b.Scenario(50, 500, 0.1, 0.05, {"guttagonol": False},
+                             numSteps=80,
+                             patientClass=ps8b.GenotypeTreatedPatient)
+    with pytest.raises(ValueError):
+        ps8b.compareRegimens(scenario, REGIMENS, 4, antithetic=True)
@@ -0,0 +1,35 @@
+import ps8b
+
+
+def bruteForce(patient, drugs):
+    return sum(all(v.isResistantTo(d) for d in drugs)
+               for v in patient.getViruses())
+
+
+def makePatient():
+    virus = ps8b.ResistantVirus(0.1, 0.05,
+                                {"guttagonol": False, "grimpex": True}, 0.05)
+    return ps8b.TreatedPatient([virus] * 100, 1000, ps8b.RandomStream(4))
+
+
+def test_indexMatchesPopulationAcrossUpdates():
+    patient = makePatient()
+    for step in range(60):
+        patient.update()
+        for drugs in ([], ["guttagonol"], ["grimpex"],
+                      ["guttagonol", "grimpex"]):
+            assert patient.getResistPop(drugs) == bruteForce(patient, drugs)
+
+
+def test_indexFollowsReplacedViruses():
+    patient = makePatient()
+    patient.getResistPop(["guttagonol"])
+    resistant = ps8b.ResistantVirus(0.1, 0.05, {"guttagonol": True}, 0.0)
+    # editing the returned list leaves the patient unchanged
+    patient.getViruses()[0] = resistant
+    assert patient.getResistPop(["guttagonol"]) == 0
+    # a list of the same length replacing the population is reindexed
+    viruses = patient.getViruses()
+    viruses[0] = resistant
+    patient.viruses = viruses
+    assert patient.getResistPop(["guttagonol"]) == 1
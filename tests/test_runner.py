@@ -0,0 +1,98 @@
+import os
+import pickle
+import random
+import subprocess
+import sys
+import threading
+
+import ps8b
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter: the start method can only be set once, and
+# the parent's drug registry must differ from the spawned workers'.
+SPAWN_SCRIPT = """
+import multiprocessing
+import ps8b
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    # the workers register the drugs in another order than this process
+    ps8b.drugRegistry.getMask(["zeta", "grimpex", "guttagonol"])
+    for name in ("TreatedPatient", "ArrayTreatedPatient",
+                 "GenotypeTreatedPatient", "HybridTreatedPatient"):
+        scenario = ps8b.Scenario.fromDict({
+            "numViruses": 50, "maxPop": 500, "maxBirthProb": 0.1,
+            "clearProb": 0.05, "mutProb": 0.02, "numSteps": 120,
+            "resistances": {"guttagonol": False, "grimpex": False},
+            "prescriptions": [[60, "guttagonol"]],
+            "resistDrugs": ["guttagonol"], "patientClass": name})
+        one = ps8b.runTrials(scenario, 4, seed=3, chunkSize=2)
+        two = ps8b.runTrials(scenario, 4, seed=3, chunkSize=2, numWorkers=2)
+        assert (one.totals == two.totals).all(), name
+        assert (one.resists == two.resists).all(), name
+    print("ok")
+"""
+
+
+def runScript(script):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, "-c", script], env=env,
+                            capture_output=True, text=True, timeout=600)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_runTrialsSpawnWorkersMatchOneWorker():
+    assert runScript(SPAWN_SCRIPT).strip() == "ok"
+
+
+def test_summaryDoesNotDependOnChunking():
+    scenario = ps8b.Scenario(30, 300, 0.1, 0.05, {"guttagonol": False}, 0.01,
+                             numSteps=100, prescriptions=[(50, "guttagonol")],
+                             resistDrugs=["guttagonol"],
+                             patientClass=ps8b.ArrayTreatedPatient)
+    one = ps8b.runTrials(scenario, 23, seed=5, chunkSize=1)
+    for chunkSize in (7, None):
+        other = ps8b.runTrials(scenario, 23, seed=5, chunkSize=chunkSize)
+        assert (other.totals == one.totals).all()
+        for stats, expected in ((other.totalStats, one.totalStats),
+                                (other.resistStats, one.resistStats)):
+            assert (stats.getMean() == expected.getMean()).all()
+            assert (stats.getVariance() == expected.getVariance()).all()
+            assert (stats.getQuantile(0.5) ==
+                    expected.getQuantile(0.5)).all()
+    copy = pickle.loads(pickle.dumps(one.totalStats))
+    assert (copy.buckets == one.totalStats.buckets).all()
+    assert (copy.getVariance() == one.totalStats.getVariance()).all()
+
+
+def test_trialsLeaveTheRandomModuleAlone():
+    scenario = ps8b.Scenario(30, 300, 0.1, 0.05, {"guttagonol": False}, 0.01,
+                             numSteps=60)
+    random.seed(11)
+    state = random.getstate()
+    first = ps8b.runTrials(scenario, 4, seed=2)
+    assert random.getstate() == state
+    random.seed(99)
+    second = ps8b.runTrials(scenario, 4, seed=2)
+    assert (first.totals == second.totals).all()
+
+
+def test_concurrentTrialsDoNotInterfere():
+    scenario = ps8b.Scenario(30, 300, 0.1, 0.05, {"guttagonol": False}, 0.01,
+                             numSteps=150)
+    expected = [ps8b.runTrial(scenario, seed)[0] for seed in range(4)]
+    results = {}
+
+    def run(seed):
+        results[seed] = ps8b.runTrial(scenario, seed)[0]
+
+    threads = [threading.Thread(target=run, args=(seed,))
+               for seed in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for seed in range(4):
+        assert (results[seed] == expected[seed]).all()
@@ -0,0 +1,41 @@
+import pytest
+
+import ps8b
+
+
+def test_compileMasksEveryStep():
+    schedule = ps8b.TreatmentSchedule()
+    schedule.startDrug("guttagonol", 2)
+    schedule.addPulses("grimpex", 1, 2, 1, stop=6)
+    schedule.stopDrug("guttagonol", 5)
+    guttagonol = ps8b.drugRegistry.getMask(["guttagonol"])
+    grimpex = ps8b.drugRegistry.getMask(["grimpex"])
+    assert schedule.compile(8) == [0, grimpex, guttagonol | grimpex,
+                                   guttagonol, guttagonol | grimpex,
+                                   grimpex, 0, 0]
+    assert sorted(schedule.getActiveDrugs(4)) == ["grimpex", "guttagonol"]
+    assert ps8b.TreatmentSchedule(schedule.toList()).compile(8) == \
+        schedule.compile(8)
+
+
+def test_negativeStepsAreRejected():
+    schedule = ps8b.TreatmentSchedule()
+    with pytest.raises(ValueError):
+        schedule.startDrug("guttagonol", -1)
+    with pytest.raises(ValueError):
+        schedule.stopDrug("guttagonol", -1)
+    with pytest.raises(ValueError):
+        schedule.addPulses("guttagonol", -1, 2, 2)
+    assert schedule.toList() == []
+
+
+def test_changesPastTheTrialAreRejected():
+    schedule = ps8b.TreatmentSchedule([["start", "guttagonol", 10]])
+    assert schedule.compile(11)[10] == ps8b.drugRegistry.getMask(
+        ["guttagonol"])
+    with pytest.raises(ValueError):
+        schedule.compile(10)
+    scenario = ps8b.Scenario(10, 100, 0.1, 0.05, {"guttagonol": False},
+                             numSteps=10, prescriptions=[(10, "guttagonol")])
+    with pytest.raises(ValueError):
+        scenario.getMasks()
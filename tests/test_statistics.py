@@ -0,0 +1,61 @@
+import pickle
+
+import numpy
+import pytest
+
+import ps8b
+
+
+def makeData(numTrials=500, numSteps=20):
+    generator = numpy.random.default_rng(0)
+    data = generator.lognormal(5, 1.5, (numTrials, numSteps)).astype(int)
+    data[::7] = 0
+    return data
+
+
+def addAll(data, maxValue=10 ** 7):
+    stats = ps8b.StepStatistics(data.shape[1], maxValue)
+    for values in data:
+        stats.add(values)
+    return stats
+
+
+def test_momentsAreExact():
+    data = makeData()
+    stats = addAll(data)
+    assert stats.getCount() == len(data)
+    assert numpy.allclose(stats.getMean(), data.mean(axis=0), rtol=1e-12)
+    assert numpy.allclose(stats.getVariance(), data.var(axis=0, ddof=1),
+                          rtol=1e-12)
+    assert (stats.getMin() == data.min(axis=0)).all()
+    assert (stats.getMax() == data.max(axis=0)).all()
+
+
+def test_quantilesAreWithinTheSketchAccuracy():
+    data = makeData()
+    stats = addAll(data)
+    for q in (0.05, 0.25, 0.5, 0.9, 0.99):
+        low = numpy.quantile(data, q, axis=0, method="lower")
+        high = numpy.quantile(data, q, axis=0, method="higher")
+        estimate = stats.getQuantile(q)
+        assert (estimate >= low * 0.98).all(), q
+        assert (estimate <= high * 1.02).all(), q
+
+
+def test_mergeAndPickleKeepTheStatistics():
+    data = makeData()
+    whole = addAll(data)
+    merged = addAll(data[:123])
+    merged.merge(addAll(data[123:]))
+    merged = pickle.loads(pickle.dumps(merged))
+    assert merged.getCount() == whole.getCount()
+    assert (merged.getMean() == whole.getMean()).all()
+    assert (merged.getVariance() == whole.getVariance()).all()
+    assert (merged.getQuantile(0.5) == whole.getQuantile(0.5)).all()
+
+
+def test_fractionalPopulationsAreRejected():
+    stats = ps8b.StepStatistics(2, 100)
+    with pytest.raises(ValueError):
+        stats.add([1.5, 2])
+    assert stats.getCount() == 0
@@ -0,0 +1,46 @@
+import asyncio
+
+import ps8b
+from test_runner import runScript
+
+
+def makeScenario():
+    return ps8b.Scenario(30, 300, 0.1, 0.05, {"guttagonol": False}, 0.01,
+                         numSteps=60, prescriptions=[(30, "guttagonol")],
+                         resistDrugs=["guttagonol"])
+
+
+def test_iterTrialMatchesRunTrial():
+    scenario = makeScenario()
+    totals, resists = ps8b.runTrial(scenario, 5)
+    steps = list(ps8b.iterTrial(scenario, 5))
+    assert [a for a, total, resist in steps] == list(range(60))
+    assert [total for a, total, resist in steps] == list(totals)
+    assert [resist for a, total, resist in steps] == list(resists)
+
+
+def test_streamSummaryMatchesRunTrials():
+    scenario = makeScenario()
+    snapshots = list(ps8b.streamTrials(scenario, 4, seed=2))
+    assert len(snapshots) == 4 * (60 + 1)
+    assert [s["trial"] for s in snapshots if s["kind"] == "trial"] == \
+        [0, 1, 2, 3]
+    expected = ps8b.runTrials(scenario, 4, seed=2)
+    assert (snapshots[-1]["summary"].totals == expected.totals).all()
+
+
+def test_asyncStreamMatchesStream():
+    scenario = makeScenario()
+
+    async def collect():
+        return [(s["kind"], s["trial"], s.get("step"), s.get("total"))
+                async for s in ps8b.streamTrialsAsync(scenario, 3, seed=8)]
+
+    expected = [(s["kind"], s["trial"], s.get("step"), s.get("total"))
+                for s in ps8b.streamTrials(scenario, 3, seed=8)]
+    assert asyncio.run(collect()) == expected
+
+
+def test_importDoesNotLoadAsyncio():
+    script = "import sys, ps8b; print('asyncio' in sys.modules)"
+    assert runScript(script).strip() == "False"
@@ -0,0 +1,58 @@
+import io
+import random
+
+import numpy
+
+import ps8b
+
+
+class NeverClear(ps8b.SimpleVirus):
+    def doesClear(self, rng=random):
+        return False
+
+
+class Sterile(ps8b.ResistantVirus):
+    def tryReproduce(self, popDensity, activeDrugs=(), rng=random):
+        return None
+
+
+def test_updateCallsOverriddenVirusMethods():
+    patient = ps8b.Patient([NeverClear(0.0, 0.9) for i in range(10)], 100)
+    patient.update()
+    assert patient.getTotalPop() == 10
+    patient = ps8b.TreatedPatient(
+        [Sterile(1.0, 0.0, {"guttagonol": True}, 0.0) for i in range(10)], 100)
+    patient.update()
+    assert patient.getTotalPop() == 10
+
+
+def test_streamReplaysAfterSetState():
+    stream = ps8b.RandomStream(3, bufferSize=16)
+    for i in range(10):
+        stream.random()
+    state = stream.getState()
+    expected = [stream.random() for i in range(40)]
+    stream.setState(state)
+    assert [stream.random() for i in range(40)] == expected
+    copy = ps8b.RandomStream.fromState(state, bufferSize=16)
+    assert [copy.random() for i in range(40)] == expected
+
+
+def test_antitheticStreamReflectsDraws():
+    plain = ps8b.RandomStream(5)
+    antithetic = ps8b.RandomStream(5, antithetic=True)
+    for i in range(100):
+        assert antithetic.random() == (1.0 - plain.random()) % 1.0
+    assert numpy.allclose(antithetic.getGenerator().random(10),
+                          (1.0 - plain.getGenerator().random(10)) % 1.0)
+
+
+def test_snapshotStoresStreamBufferAsArray():
+    patient = ps8b.TreatedPatient(
+        [ps8b.ResistantVirus(0.1, 0.05, {"guttagonol": False}, 0.01)] * 50,
+        500, ps8b.RandomStream(7))
+    patient.update()
+    with numpy.load(io.BytesIO(ps8b.snapshotPatient(patient))) as archive:
+        assert "streamBuffer" in archive.files
+        meta = archive["meta"].tobytes().decode("utf-8")
+    assert "buffer" not in meta
@@ -0,0 +1,38 @@
+import os
+
+import ps8b
+
+BASE = {"numViruses": 20, "maxPop": 200, "maxBirthProb": 0.1,
+        "clearProb": 0.05, "mutProb": 0.01, "numSteps": 40,
+        "resistances": {"guttagonol": False}}
+
+
+def test_sweepReusesCachedCells(tmp_path):
+    cache = ps8b.ResultCache(str(tmp_path))
+    grid = {"maxBirthProb": [0.1, 0.2], "doses.guttagonol": [10, 20]}
+    lines = []
+    first = ps8b.runSweep(BASE, grid, 3, seed=1, cache=cache,
+                          log=lines.append)
+    second = ps8b.runSweep(BASE, grid, 3, seed=1, cache=cache,
+                           log=lines.append)
+    assert [line.split()[0] for line in lines] == ["computed"] * 4 + \
+        ["cached"] * 4
+    for (cell, summary), (cached, copy) in zip(first, second):
+        assert cell == cached
+        assert (summary.totals == copy.totals).all()
+
+
+def test_corruptResultIsAMiss(tmp_path):
+    cache = ps8b.ResultCache(str(tmp_path))
+    scenario = ps8b.Scenario.fromDict(BASE)
+    key = cache.getKey(scenario, 2, 0)
+    cache.put(key, ps8b.runTrials(scenario, 2, 0))
+    path = cache._path(key)
+    with open(path, "rb") as f:
+        data = f.read()
+    for corrupt in (data[:len(data) // 2], b"", b"not a pickle"):
+        with open(path, "wb") as f:
+            f.write(corrupt)
+        assert cache.get(key) is None
+        assert not os.path.exists(path)
+    assert os.listdir(str(tmp_path)) == []
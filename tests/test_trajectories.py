@@ -0,0 +1,54 @@
+import numpy
+import pytest
+
+import ps8b
+
+
+def makeScenario():
+    return ps8b.Scenario(30, 300, 0.1, 0.05, {"guttagonol": False}, 0.01,
+                         numSteps=60, prescriptions=[(30, "guttagonol")],
+                         resistDrugs=["guttagonol"])
+
+
+def test_storeHoldsEveryTrial(tmp_path):
+    scenario = makeScenario()
+    path = str(tmp_path / "run.trj")
+    store = ps8b.TrajectoryStore.forScenario(path, scenario, {"seed": 6})
+    summary = ps8b.runTrials(scenario, 9, seed=6, chunkSize=2, store=store)
+    store.close()
+
+    store = ps8b.TrajectoryStore(path)
+    assert store.getNumTrials() == 9
+    assert store.getSeriesNames() == ["total", "resist", "resist:guttagonol"]
+    assert store.getParams()["seed"] == 6
+    assert store.getParams()["scenario"] == scenario.toDict()
+    assert (store.getSeries("total").sum(axis=0) == summary.totals).all()
+    for t in range(9):
+        totals, resists = ps8b.runTrial(scenario, ps8b.trialSeed(6, t))
+        assert (store.getSeries("total", t, t + 1)[0] == totals).all()
+        assert (store.getSeries("resist", t, t + 1)[0] == resists).all()
+
+    resist = store.getSeries("resist:guttagonol")
+    passage = store.getFirstPassage("resist:guttagonol", 1, 30, batchSize=4)
+    for t in range(9):
+        reached = numpy.flatnonzero(resist[t, 30:] >= 1)
+        assert passage[t] == (reached[0] + 30 if len(reached) else -1)
+    with pytest.raises(ValueError):
+        store.append(store.getTrials(0, 1))
+
+
+def test_appendGrowsAndTruncateDiscards(tmp_path):
+    path = str(tmp_path / "grow.trj")
+    store = ps8b.TrajectoryStore.create(path, 5, ["total"], capacity=1)
+    block = numpy.arange(15).reshape(3, 5, 1)
+    store.append(block)
+    store.append(block[:1])
+    assert store.getNumTrials() == 4
+    store.truncate(2)
+    store.close()
+    store = ps8b.TrajectoryStore(path)
+    assert (store.getTrials() == block[:2]).all()
+    other = tmp_path / "other.trj"
+    other.write_bytes(b"not a store")
+    with pytest.raises(ValueError):
+        ps8b.TrajectoryStore(str(other))